@@ -40,9 +40,18 @@ setup(
         'six',
     ],
 
+    extras_require={
+        'async': ['aiohttp'],
+        'zstd': ['zstandard'],
+    },
+
     package_data={},
 
     data_files=[],
 
-    entry_points={},
+    entry_points={
+        'console_scripts': [
+            'webarchiver-batch = webarchiver.batch:main',
+        ],
+    },
 )
@@ -1,14 +1,15 @@
 from os import (
-    chdir,
-    getcwd,
     makedirs,
+    unlink,
     walk,
 )
 
 from os.path import (
     abspath as path_abspath,
+    basename as path_basename,
     dirname as path_dirname,
     exists as path_exists,
+    getsize as path_getsize,
     join as path_join,
     isdir as path_isdir,
     relpath as path_relpath,
@@ -17,25 +18,54 @@ from os.path import (
 
 from re import compile as re_compile
 from shutil import rmtree
-from tarfile import open as tarfile_open
+from tempfile import SpooledTemporaryFile
+from threading import Lock
 from time import sleep
 # noinspection PyUnresolvedReferences
 from six.moves.urllib.parse import urlparse
 from zipfile import ZipFile
 
-from requests import get as requests_get
-
+from .archives import ArchiveWriter
 from .connectors import UserAgents
+from .manifest import (
+    DownloadManifest,
+    file_replace,
+)
+from .metrics import (
+    create_event,
+    emit,
+    timer,
+)
+from .sessions import (
+    get_default_session,
+    get_pooled_session,
+)
+from .workers import (
+    HostLimiter,
+    get_host,
+    run_in_threads,
+)
 
 __author__ = 'Changwoo Nam <ep6tri@hotmail.com>'
 __version__ = '1.0.0'
 
 
-def url_download(url, download_path, **kwargs):
+def url_download(url, download_path, chunk_size=65536, session=None, manifest=None, metrics=None, warc=None,
+                 **kwargs):
     """
-    Stores a remote path
+    Stores a remote path.
+    The response body is streamed chunk by chunk, so the memory usage does not depend on its size.
+    When download_path is a file path, the body is written to <download_path>.part first,
+    and renamed to download_path after the download is completed.
     :param url:           url to fetch
     :param download_path: file path or file-like objects
+    :param chunk_size:    bytes to read and write at once
+    :param session:       requests Session. The shared default session is used if omitted
+    :param manifest:      DownloadManifest of the download_path's directory.
+                          A <download_path>.part left by an interrupted download is continued by a Range request,
+                          and the completed download is recorded.
+    :param metrics:       callable taking an event dict of the download, e.g. MetricsAggregator
+    :param warc:          WarcWriter to record the request and the response
     :param kwargs:        any keywords for Request object
     :return:
     """
@@ -45,82 +75,365 @@ def url_download(url, download_path, **kwargs):
     if 'user-agent' not in kwargs['headers']:
         kwargs['headers']['user-agent'] = UserAgents.chrome()
 
-    content = requests_get(url, **kwargs).content
-    if isinstance(download_path, str):
-        with open(download_path, 'wb') as f:
-            f.write(content)
-    elif hasattr(download_path, 'write'):
-        download_path.write(content)
+    kwargs['stream'] = True
+
+    is_path = isinstance(download_path, str)
+    part_path = download_path + '.part' if is_path else None
+    offset = 0
+
+    if is_path and manifest:
+        # byte ranges are counted in the encoded body
+        kwargs['headers']['accept-encoding'] = 'identity'
+        etag = manifest.get_etag(url, download_path)
+        if etag and path_exists(part_path):
+            offset = path_getsize(part_path)
+        if offset:
+            kwargs['headers']['range'] = 'bytes=%d-' % offset
+            kwargs['headers']['if-range'] = etag
+
+    started = timer()
+    try:
+        response = (session or get_default_session()).get(url, **kwargs)
+    except Exception as e:
+        emit(metrics, create_event('download', url, total=timer() - started, error=repr(e)))
+        raise
+    received = timer()
+
+    restart = False
+    written = 0
+    error = None
+    # a copy of the body for the WARC record
+    body = SpooledTemporaryFile(16 * 1024 * 1024) if warc else None
+    try:
+        if response.status_code == 416 and offset:
+            # the partial file is not a prefix of the current content
+            restart = True
+            unlink(part_path)
+            manifest.start(url, download_path)
+            del kwargs['headers']['range'], kwargs['headers']['if-range']
+        else:
+            response.raise_for_status()
+
+        if restart:
+            pass
+        elif is_path:
+            etag = response.headers.get('etag')
+            if response.status_code == 206 and offset:
+                mode = 'ab'
+            else:
+                mode, offset = 'wb', 0
+                if manifest:
+                    manifest.start(url, download_path, etag)
+            try:
+                with open(part_path, mode) as f:
+                    written = write_chunks(response, f, chunk_size, body)
+            except Exception:
+                # a manifest resumes the partial file later
+                if not manifest and path_exists(part_path):
+                    unlink(part_path)
+                raise
+            file_replace(part_path, download_path)
+            if manifest:
+                manifest.complete(url, download_path, offset + written, etag)
+        elif hasattr(download_path, 'write'):
+            written = write_chunks(response, download_path, chunk_size, body)
+
+        if warc and not restart:
+            warc.write_response(response, body)
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        if body:
+            body.close()
+        response.close()
+        finished = timer()
+        emit(metrics, create_event(
+            'download', url, status_code=response.status_code, bytes=written, ttfb=received - started,
+            transfer=finished - received, total=finished - started, error=error
+        ))
+
+    if restart:
+        return url_download(url, download_path, chunk_size, session, manifest, metrics, warc, **kwargs)
+
 
+def write_chunks(response, f, chunk_size=65536, copy=None):
+    """
+    write a streamed response body into a file-like object
+    :param response:   requests' Response object opened with stream=True
+    :param f:          file-like object
+    :param chunk_size: bytes to read and write at once
+    :param copy:       file-like object to receive a copy of the body
+    :return:           written bytes
+    """
+    written = 0
+    for chunk in response.iter_content(chunk_size):
+        if chunk:
+            f.write(chunk)
+            if copy:
+                copy.write(chunk)
+            written += len(chunk)
+    return written
 
-def zip_recursive(archive_path, target_path):
+
+def zip_recursive(archive_path, target_path, exclude=None):
     """
     recursive zip archiving
     :param archive_path: .zip file
     :param target_path:  directory to inflate
+    :param exclude:      callable to skip a file. It takes the file path and returns True to skip
     """
     tp = path_abspath(target_path)
     if not path_isdir(tp) or not path_exists(tp):
         raise ValueError('target_path must be a existing directory')
-    current_dir = getcwd()
     root_path = path_dirname(tp)
-    chdir(root_path)
     with ZipFile(archive_path, 'w') as zf:
-        for dirpath, dirnames, filenames in walk(target_path):
+        for dirpath, dirnames, filenames in walk(tp):
             rel_dir = path_relpath(dirpath, root_path)
             for entry in filenames:
-                zf.write(path_join(rel_dir, entry))
-    chdir(current_dir)
+                if exclude and exclude(path_join(dirpath, entry)):
+                    continue
+                zf.write(path_join(dirpath, entry), path_join(rel_dir, entry))
 
 
-def archive_remote_urls(download_path, title, urls, archiver='.tar.gz', cleanup=True, each_delay=0):
+def archive_remote_urls(download_path, title, urls, archiver='.tar.gz', cleanup=True, each_delay=0,
+                        workers=1, per_host=0, resume=False, compress_level=None, compress_threads=1,
+                        staging=True, spool_size=16 * 1024 * 1024, blob_store=None, warc=None, concurrency=None,
+                        strict=True, session=None):
     """
     Downloading remote resources and archiving them as a tar or zip file.
-    :param download_path: path to store. final images will be saved in <download_path>/<title>
-    :param title:         episode title. Used as directory name
-    :param urls:          images a list of URLs.
-    :param archiver:      can be either '.tar.gz', '.zip', or empty string to skip archiving
-    :param cleanup:       remove <download_path>/<title> directory after archiving
-    :param each_delay:    delay after downloading each url
-    :return:
+    :param download_path:    path to store. final images will be saved in <download_path>/<title>
+    :param title:            episode title. Used as directory name
+    :param urls:             images a list of URLs.
+    :param archiver:         one of ArchiveWriter.archivers: '.tar', '.tar.gz', '.tar.xz', '.tar.zst', '.zip',
+                             or empty string to skip archiving
+    :param cleanup:          remove <download_path>/<title> directory after archiving
+    :param each_delay:       delay after downloading each url
+    :param workers:          number of concurrent downloads. 1 means sequential downloading
+    :param per_host:         maximum concurrent downloads per host. 0 means no cap
+    :param resume:           skip urls already downloaded by the last run, and continue partially downloaded files.
+                             Downloads are recorded in <download_path>/<title>/.manifest.json
+    :param compress_level:   compression level of the archive. ArchiveWriter.default_levels if None
+    :param compress_threads: compression threads for '.tar.gz' and '.tar.zst'
+    :param staging:          False to put response bodies into the archive directly, without <download_path>/<title>.
+                             Each body is buffered in memory until it is complete, and spilled to a temporary file
+                             only when it exceeds spool_size bytes. Cannot be used with resume or empty archiver.
+    :param spool_size:       see staging
+    :param blob_store:       BlobStore to skip urls fetched before, and to store identical contents only once.
+                             Files in <download_path>/<title> are hard links to the store's blobs.
+    :param warc:             WarcWriter to record the requests and the responses. Urls found in blob_store are
+                             not fetched, so they are not recorded
+    :param concurrency:      AdaptiveLimiter replacing the per_host cap. It raises the cap of a host while its
+                             latency stays flat, and lowers it on errors. workers bounds the total.
+                             With workers=1 the downloads are sequential, so it only learns from them,
+                             e.g. for connectors sharing it
+    :param strict:           raise the error of the first failed download, in the order of urls, after aborting
+                             the archive. Sequential downloads stop there, and concurrent ones finish first.
+                             False to go on and return the failures
+    :param session:          requests Session. The default session if None, or a new one keeping a connection
+                             for each worker if the default one keeps fewer. See get_pooled_session()
+    :return:                 a list of (url, exception) for failed downloads, which is empty unless strict is False.
+                             Archive entries are written in the order of urls; an error writing the archive aborts it,
+                             and is raised after the downloads. If a download failed, the archive is not created, and
+                             <download_path>/<title> is kept for resume=True to finish it
     """
     safe_title = get_safe_name(title)
     save_dir = path_join(download_path, safe_title)
 
-    if not path_exists(save_dir):
+    if not staging and (resume or not archiver):
+        raise ValueError('staging=False requires an archiver, and cannot resume')
+
+    if staging and not path_exists(save_dir):
         makedirs(save_dir)
         assert path_exists(save_dir)
 
-    sleep_index = len(urls) - 1
-    for idx, url in enumerate(urls):
-        ext = path_splitext(urlparse(url).path.strip('/').split('/')[-1])[1]
-        path = path_join(save_dir, '%02d%s' % (idx + 1, ext))
-        url_download(url=url, download_path=path)
-        assert path_exists(path)
-        if idx < sleep_index:
-            sleep(each_delay)
+    manifest = DownloadManifest(save_dir) if resume else None
+
+    # files are archived as soon as they are downloaded, in the order of urls
+    writer = None
+    if archiver:
+        archive_path = path_join(download_path, safe_title + archiver)
+        writer = ArchiveWriter(archive_path, archiver, level=compress_level, threads=compress_threads)
+        writer.add_directory(safe_title)
+
+    entry_lock = Lock()
+    entries = {}  # index of url -> callable writing its entry, or None for a failed download
+    entry_state = {'next': 0, 'error': None}
+
+    def finish(index, write=None):
+        """
+        write the entries ready in the order of urls. An archive error stops writing, and is raised at the end.
+        """
+        with entry_lock:
+            entries[index] = write
+            while entry_state['next'] in entries:
+                write = entries.pop(entry_state['next'])
+                entry_state['next'] += 1
+                if write and entry_state['error'] is None:
+                    try:
+                        write()
+                    except Exception as e:
+                        entry_state['error'] = e
+
+    def add_file(path):
+        if writer:
+            return lambda: writer.add(path, path_join(safe_title, path_basename(path)))
+
+    jobs = []
+    indexes = {}
+    for idx, (url, path) in enumerate(zip(urls, get_download_paths(save_dir, urls))):
+        if manifest and manifest.is_complete(url, path):
+            finish(idx, add_file(path))
+        else:
+            indexes[path] = idx
+            jobs.append((url, path))
 
-    if not archiver:
-        return
+    # the limiter learns from the downloads
+    options = {'warc': warc, 'metrics': concurrency, 'session': session or get_pooled_session(workers)}
 
-    archive_path = path_join(download_path, safe_title + archiver)
+    def fetch(url, path):
+        """
+        :return: callable writing the entry of the download, or None
+        """
+        arcname = path_join(safe_title, path_basename(path))
+        if blob_store and staging:
+            blob_store.fetch(url, path, **options)
+            if manifest:
+                manifest.complete(url, path, path_getsize(path))
+            return add_file(path)
+        elif blob_store:
+            blob_path = blob_store.fetch_blob(url, **options)
+            return lambda: writer.add(blob_path, arcname)
+        elif staging:
+            url_download(url=url, download_path=path, manifest=manifest, **options)
+            assert path_exists(path)
+            return add_file(path)
 
-    if archiver == '.tar.gz':
-        current_dir = getcwd()
-        chdir(download_path)
-        with tarfile_open(archive_path, 'w:gz', compresslevel=1) as tar:
-            tar.add(safe_title)
-        chdir(current_dir)
-    elif archiver == '.zip':
-        zip_recursive(archive_path, save_dir)
-    else:
-        raise AttributeError('Unsupported archive: %s' % archiver)
+        # kept until the entries before it are written
+        buffer = SpooledTemporaryFile(spool_size)
+        try:
+            url_download(url=url, download_path=buffer, **options)
+        except Exception:
+            buffer.close()
+            raise
+        size = buffer.tell()
+        buffer.seek(0)
 
+        def write():
+            try:
+                writer.add_fileobj(buffer, arcname, size)
+            finally:
+                buffer.close()
+        return write
+
+    def download(url, path):
+        try:
+            write = fetch(url, path)
+        except Exception:
+            finish(indexes[path])
+            raise
+        finish(indexes[path], write)
+
+    try:
+        if workers > 1:
+            failures = download_concurrently(jobs, workers, per_host, each_delay, download=download,
+                                             limiter=concurrency)
+        else:
+            failures = []
+            sleep_index = len(jobs) - 1
+            for idx, (url, path) in enumerate(jobs):
+                try:
+                    download(url, path)
+                except Exception as e:
+                    failures.append((url, e))
+                    if strict:
+                        break
+                if idx < sleep_index:
+                    sleep(each_delay)
+        if entry_state['error'] is not None:
+            raise entry_state['error']
+        if failures and strict:
+            raise failures[0][1]
+    except Exception:
+        if writer:
+            writer.abort()
+        raise
+
+    if not writer:
+        return failures
+
+    if failures:
+        # the downloads and the manifest are kept for resume=True to finish the archive
+        writer.abort()
+        return failures
+
+    writer.close()
     assert path_exists(archive_path)
 
-    if cleanup:
+    if cleanup and staging:
         rmtree(save_dir)
 
+    return failures
+
+
+def download_concurrently(jobs, workers=4, per_host=0, each_delay=0, manifest=None, on_complete=None,
+                          download=None, limiter=None, session=None):
+    """
+    Download (url, download_path) pairs on a thread pool.
+    A failed download does not stop the others.
+    :param jobs:        a list of (url, download_path)
+    :param workers:     number of threads
+    :param per_host:    maximum concurrent downloads per host. 0 means no cap
+    :param each_delay:  delay of a worker after downloading each url
+    :param manifest:    DownloadManifest to resume and record the downloads
+    :param on_complete: callable taking the download_path of each finished download
+    :param download:    callable taking (url, download_path) to replace url_download(),
+                        manifest and on_complete are ignored if given
+    :param limiter:     HostLimiter to use instead of a new one with per_host, e.g. AdaptiveLimiter
+    :param session:     requests Session for url_download(). get_pooled_session(workers) if None
+    :return:            a list of (url, exception) for failed downloads
+    """
+    limiter = limiter or HostLimiter(per_host)
+
+    if download is None:
+        session = session or get_pooled_session(workers)
+
+        def download(url, path):
+            url_download(url=url, download_path=path, session=session, manifest=manifest)
+            if on_complete:
+                on_complete(path)
+
+    def limited_download(url, path):
+        host = get_host(url)
+        limiter.acquire(host)
+        try:
+            download(url, path)
+        finally:
+            limiter.release(host)
+        if each_delay:
+            sleep(each_delay)
+
+    return [(job[0], error) for job, _, error in run_in_threads(limited_download, jobs, workers) if error]
+
+
+def is_download_leftover(path):
+    """
+    True if the path is not a downloaded resource, but the manifest or a partial download.
+    """
+    return DownloadManifest.is_manifest_file(path) or path.endswith('.part')
+
+
+def get_download_paths(save_dir, urls):
+    """
+    return file paths of urls in save_dir: 01.jpg, 02.png, ... in the order of urls.
+    Extensions are taken from the urls.
+    """
+    paths = []
+    for idx, url in enumerate(urls):
+        ext = path_splitext(urlparse(url).path.strip('/').split('/')[-1])[1]
+        paths.append(path_join(save_dir, '%02d%s' % (idx + 1, ext)))
+    return paths
+
 
 unsafe_expr = re_compile(r'[<>:\"/|?*]')  # not good characters for directory
 
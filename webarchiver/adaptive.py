@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+
+from .ratelimit import monotonic
+from .workers import HostLimiter
+
+
+class AdaptiveLimiter(HostLimiter):
+    """
+    HostLimiter whose per-host limits follow the responses of each host, by additive increase and
+    multiplicative decrease (AIMD).
+
+    - While the latency of a host stays within tolerance times its baseline, the limit grows by increase
+      for every limit successful responses, about one step per round of requests.
+    - Errors, 429 and 5xx responses multiply the limit by decrease, at most once per cooldown seconds.
+    - A latency beyond twice the tolerance decreases the limit as well.
+
+    It is a metrics callable, fed by the events of RequestsConnector and url_download:
+
+        limiter = AdaptiveLimiter(max_limit=16)
+        connector = RequestsConnector(cookie_file, 0, concurrency=limiter)
+        archive_remote_urls(download_path, title, urls, workers=32, concurrency=limiter)
+        limiter.limits
+
+    It caps requests only where they run concurrently: with workers=1, archive_remote_urls() downloads one url
+    at a time, and the limiter merely learns from the downloads.
+    """
+
+    def __init__(self, initial=2, min_limit=1, max_limit=32, increase=1.0, decrease=0.5, tolerance=1.5,
+                 cooldown=1.0, smoothing=0.2):
+        """
+        :param initial:   limit of a new host
+        :param min_limit: lowest limit
+        :param max_limit: highest limit
+        :param increase:  limit added after a round of fast responses
+        :param decrease:  factor of the limit after a failure
+        :param tolerance: latency ratio to the baseline regarded as flat
+        :param cooldown:  minimum seconds between two decreases of a host
+        :param smoothing: weight of a new latency in the moving average
+        """
+        super(AdaptiveLimiter, self).__init__(initial)
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self._hosts = {}
+
+    def _get_state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = {
+                'limit': float(self.initial),
+                'latency': None,
+                'baseline': None,
+                'successes': 0,
+                'failures': 0,
+                'decreased': None,
+            }
+        return state
+
+    def get_limit(self, host):
+        state = self._hosts.get(host)
+        return int(state['limit']) if state else self.initial
+
+    @property
+    def limits(self):
+        """
+        :return: {host: {'limit', 'active', 'latency', 'baseline', 'successes', 'failures'}} for monitoring
+        """
+        with self._condition:
+            return dict(
+                (host, {
+                    'limit': int(state['limit']),
+                    'active': self._active.get(host, 0),
+                    'latency': state['latency'],
+                    'baseline': state['baseline'],
+                    'successes': state['successes'],
+                    'failures': state['failures'],
+                })
+                for host, state in self._hosts.items()
+            )
+
+    def observe(self, host, latency=None, status_code=None, error=None):
+        """
+        adjust the limit of host by a response.
+        :param host:        host name
+        :param latency:     seconds to the response headers
+        :param status_code: response status code. None for failed requests
+        :param error:       exception or error message of a failed request
+        """
+        failed = bool(error) or status_code == 429 or (status_code is not None and status_code >= 500)
+
+        with self._condition:
+            state = self._get_state(host)
+            if failed:
+                state['failures'] += 1
+                self._decrease(state)
+            else:
+                state['successes'] += 1
+                if latency is not None:
+                    self._adjust(state, latency)
+            self._condition.notify_all()
+
+    def __call__(self, event):
+        """
+        observe a metrics event. See metrics module.
+        """
+        latency = event['ttfb'] if event.get('ttfb') is not None else event.get('total')
+        self.observe(event['host'], latency, event['status_code'], event['error'])
+
+    def _adjust(self, state, latency):
+        if state['latency'] is None:
+            state['latency'] = latency
+        else:
+            state['latency'] += self.smoothing * (latency - state['latency'])
+        # the baseline follows the fastest latency, and drifts up slowly to forget old conditions
+        if state['baseline'] is None or latency < state['baseline']:
+            state['baseline'] = latency
+        else:
+            state['baseline'] *= 1.01
+
+        ratio = state['latency'] / state['baseline'] if state['baseline'] > 0 else 1.0
+        if ratio <= self.tolerance:
+            state['limit'] = min(self.max_limit, state['limit'] + self.increase / state['limit'])
+        elif ratio > 2 * self.tolerance:
+            self._decrease(state)
+
+    def _decrease(self, state):
+        now = monotonic()
+        if state['decreased'] is not None and now - state['decreased'] < self.cooldown:
+            return
+        state['decreased'] = now
+        state['limit'] = max(self.min_limit, state['limit'] * self.decrease)
@@ -0,0 +1,166 @@
+"""
+asyncio connector. Requires python 3.5+ and aiohttp.
+"""
+from __future__ import absolute_import
+
+import asyncio
+
+from http.client import HTTPMessage
+from urllib.parse import urljoin
+
+import aiohttp
+
+from requests.cookies import (
+    MockRequest,
+    MockResponse,
+    RequestsCookieJar,
+)
+
+from .connectors import (
+    BaseConnector,
+    ConnectorMixin,
+    CookieJarMixin,
+)
+from .ratelimit import get_default_rate_limiter
+from .workers import get_host
+
+
+class _CookieRequest(object):
+    """
+    Minimal request object for requests.cookies.MockRequest
+    """
+
+    def __init__(self, url, headers):
+        self.url = url
+        self.headers = headers
+
+
+class AsyncRequestsConnector(CookieJarMixin, BaseConnector):
+    """
+    asyncio counterpart of RequestsConnector.
+
+        async with AsyncRequestsConnector('cookie.txt', delay=1) as connector:
+            content = await connector.get('http://example.com/')
+            pages = await connector.gather(['http://example.com/1', 'http://example.com/2'])
+
+    Cookies are kept in a RequestsCookieJar, so save_cookie() and load_cookie() use the same LWP format file.
+    """
+
+    redirect_statuses = (301, 302, 303, 307, 308)
+
+    def __init__(self, cookie_file, delay=2, extra_headers=None, rate_limiter=None, throttled_retries=2,
+                 limit=100, limit_per_host=0, max_redirects=10):
+        """
+        Keywords
+        --------
+        rate_limiter:      HostRateLimiter enforcing delay per host. The shared default limiter is used if omitted.
+        throttled_retries: times to resend a request answered with 429, or 503 with Retry-After.
+        limit:             maximum number of simultaneous connections.
+        limit_per_host:    maximum number of simultaneous connections per host. 0 means no limit.
+        max_redirects:     maximum number of redirects to follow.
+        """
+        super(AsyncRequestsConnector, self).__init__(delay, extra_headers)
+
+        self._cookie_file = cookie_file
+        self._cookie_jar = RequestsCookieJar()
+        self._rate_limiter = rate_limiter or get_default_rate_limiter()
+        self._throttled_retries = throttled_retries
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._max_redirects = max_redirects
+        self._session = None
+        self.last_response = None
+
+        self.load_cookie()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._limit, limit_per_host=self._limit_per_host),
+                cookie_jar=aiohttp.DummyCookieJar(),
+            )
+        return self._session
+
+    async def request(self, url, method='GET', params=None, data=None, headers=None):
+        """
+        :return: decoded body. last_response and last_content are also updated.
+        """
+        headers = dict(headers or {})
+        headers.update(self._extra_headers)
+        url = ConnectorMixin.create_get_url(url, dict(params or {}))
+
+        for _ in range(self._max_redirects + 1):
+            response, content = await self._send(url, method, data, headers)
+            if response.status not in self.redirect_statuses or 'location' not in response.headers:
+                break
+            url = urljoin(url, response.headers['location'])
+            if response.status == 303 or (response.status in (301, 302) and method.upper() == 'POST'):
+                method, data = 'GET', None
+        else:
+            raise aiohttp.TooManyRedirects(response.request_info, response.history)
+
+        self.last_response = response
+        self.last_content = content
+        return content
+
+    async def get(self, url, params=None, headers=None):
+        return await self.request(url, method='GET', params=params, headers=headers)
+
+    async def post(self, url, data=None, headers=None):
+        return await self.request(url, method='POST', data=data, headers=headers)
+
+    async def gather(self, urls, method='GET', return_exceptions=True):
+        """
+        request urls concurrently. Per-host delay is still respected.
+        :param urls:              list of urls
+        :param method:            HTTP method
+        :param return_exceptions: put exceptions into the result list, instead of raising the first one
+        :return:                  list of decoded bodies in the order of urls
+        """
+        return await asyncio.gather(
+            *[self.request(url, method=method) for url in urls],
+            return_exceptions=return_exceptions
+        )
+
+    async def _send(self, url, method, data, headers):
+        host = get_host(url)
+        retries = self._throttled_retries
+        while True:
+            delay = self._rate_limiter.reserve(host, self._delay)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            request_headers = dict(headers)
+            cookie_request = MockRequest(_CookieRequest(url, request_headers))
+            self._cookie_jar.add_cookie_header(cookie_request)
+            request_headers.update(cookie_request.get_new_headers())
+
+            async with self._get_session().request(
+                    method,
+                    url,
+                    data=data,
+                    headers=request_headers,
+                    allow_redirects=False,
+            ) as response:
+                await response.read()
+                self._extract_cookies(url, request_headers, response)
+                if not self._rate_limiter.observe(host, response.status, response.headers) or retries <= 0:
+                    return response, await response.text()
+            retries -= 1
+
+    def _extract_cookies(self, url, headers, response):
+        message = HTTPMessage()
+        for name, value in response.raw_headers:
+            message.add_header(name.decode('latin-1'), value.decode('latin-1'))
+        self._cookie_jar.extract_cookies(MockResponse(message), MockRequest(_CookieRequest(url, headers)))
@@ -0,0 +1,313 @@
+from __future__ import absolute_import
+
+import tarfile
+import zlib
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from os import (
+    unlink,
+    walk,
+)
+
+from os.path import (
+    exists as path_exists,
+    join as path_join,
+    relpath as path_relpath,
+    splitext as path_splitext,
+)
+
+from shutil import copyfileobj
+from sys import version_info
+from threading import RLock
+from time import (
+    localtime,
+    time,
+)
+from zipfile import (
+    ZIP_DEFLATED,
+    ZIP_STORED,
+    ZipFile,
+    ZipInfo,
+)
+
+from .manifest import file_replace
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ZipFile.open() accepts mode 'w' since python 3.6
+_zip_writable = version_info >= (3, 6)
+# ZipFile takes compresslevel since python 3.7
+_zip_levels = version_info >= (3, 7)
+
+
+class ParallelGzipFile(object):
+    """
+    Write-only file object compressing blocks on a thread pool, like pigz.
+    Each block becomes a gzip member, and concatenated members are a valid gzip file.
+    """
+
+    def __init__(self, fileobj, level=6, threads=2, block_size=1024 * 1024):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self._threads = threads
+        self._pool = ThreadPool(threads)
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit()
+
+    def close(self):
+        if self._pool is None:
+            return
+        self._submit()
+        while self._pending:
+            self.fileobj.write(self._pending.popleft().get())
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+    def _submit(self):
+        if not self._buffered:
+            return
+        block = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._pool.apply_async(compress_gzip_member, (block, self.level)))
+        # keep memory bounded: write finished blocks in order
+        while len(self._pending) > self._threads * 2 or (self._pending and self._pending[0].ready()):
+            self.fileobj.write(self._pending.popleft().get())
+
+
+def compress_gzip_member(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ArchiveWriter(object):
+    """
+    Thread-safe archive writer. Files are added one by one as they become ready, without chdir().
+
+        with ArchiveWriter('episode.tar.gz', level=1, threads=4) as writer:
+            writer.add('/tmp/episode/01.jpg', 'episode/01.jpg')
+
+    The archive is written to <archive_path>.part, and renamed to archive_path when it is closed.
+
+    archivers:
+        '.tar':     no compression. Good for already-compressed images
+        '.tar.gz':  gzip. threads > 1 compresses blocks in parallel
+        '.tar.xz':  xz, python 3 only
+        '.tar.zst': zstandard, requires the zstandard package. threads > 1 compresses in parallel
+        '.zip':     deflate, except already-compressed files which are stored as they are.
+                    The level applies on python 3.7 or later only
+    """
+
+    archivers = ('.tar', '.tar.gz', '.tar.xz', '.tar.zst', '.zip')
+
+    default_levels = {
+        '.tar.gz': 1,
+        '.tar.xz': 6,
+        '.tar.zst': 3,
+        '.zip': 6,
+    }
+
+    compressed_extensions = frozenset([
+        '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.webm', '.ogg',
+        '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.woff', '.woff2',
+    ])
+
+    def __init__(self, archive_path, archiver='.tar.gz', level=None, threads=1, store_compressed=True):
+        """
+        :param archive_path:     path of the archive
+        :param archiver:         one of archivers
+        :param level:            compression level. default_levels[archiver] if None
+        :param threads:          compression threads for '.tar.gz' and '.tar.zst'
+        :param store_compressed: '.zip' only. Store already-compressed files without recompression
+        """
+        if archiver not in self.archivers:
+            raise AttributeError('Unsupported archive: %s' % archiver)
+        if archiver == '.tar.zst' and zstandard is None:
+            raise ImportError('.tar.zst requires the zstandard package')
+
+        self.archive_path = archive_path
+        self.archiver = archiver
+        self.level = self.default_levels.get(archiver) if level is None else level
+        self.threads = threads
+        self.store_compressed = store_compressed
+
+        self._part_path = archive_path + '.part'
+        self._lock = RLock()
+        self._fileobj = None
+        self._compressor = None
+        self._tar = None
+        self._zip = None
+        self._closed = False
+
+        self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _open(self):
+        if self.archiver == '.zip':
+            kwargs = {'compresslevel': self.level} if _zip_levels else {}
+            self._zip = ZipFile(self._part_path, 'w', ZIP_DEFLATED, allowZip64=True, **kwargs)
+        elif self.archiver == '.tar.xz':
+            self._tar = tarfile.open(self._part_path, 'w:xz', preset=self.level)
+        else:
+            self._fileobj = open(self._part_path, 'wb')
+            if self.archiver == '.tar.gz':
+                if self.threads > 1:
+                    self._compressor = ParallelGzipFile(self._fileobj, self.level, self.threads)
+                else:
+                    self._compressor = _GzipStream(self._fileobj, self.level)
+            elif self.archiver == '.tar.zst':
+                self._compressor = zstandard.ZstdCompressor(
+                    level=self.level,
+                    threads=self.threads if self.threads > 1 else 0,
+                ).stream_writer(self._fileobj, closefd=False)
+            self._tar = tarfile.open(fileobj=self._compressor or self._fileobj, mode='w|')
+
+    def is_compressed(self, name):
+        return path_splitext(name)[1].lower() in self.compressed_extensions
+
+    def _get_compress_type(self, arcname):
+        return ZIP_STORED if self.store_compressed and self.is_compressed(arcname) else ZIP_DEFLATED
+
+    def add(self, path, arcname):
+        """
+        add a file.
+        :param path:    file path
+        :param arcname: name in the archive
+        """
+        with self._lock:
+            if self._zip is not None:
+                self._zip.write(path, arcname, self._get_compress_type(arcname))
+            else:
+                self._tar.add(path, arcname, recursive=False)
+
+    def add_fileobj(self, fileobj, arcname, size):
+        """
+        add a file read from a file-like object.
+        :param fileobj: readable file-like object
+        :param arcname: name in the archive
+        :param size:    number of bytes to read from fileobj
+        """
+        with self._lock:
+            if self._zip is not None:
+                info = ZipInfo(arcname, localtime()[:6])
+                info.external_attr = 0o644 << 16
+                info.compress_type = self._get_compress_type(arcname)
+                info.file_size = size
+                if _zip_levels:
+                    # ZipFile.open() does not apply the level of the ZipFile to a given ZipInfo
+                    info._compresslevel = self.level
+                if _zip_writable:
+                    with self._zip.open(info, 'w', force_zip64=size > 0x7fffffff) as entry:
+                        copyfileobj(fileobj, entry)
+                else:
+                    self._zip.writestr(info, fileobj.read(size))
+            else:
+                info = tarfile.TarInfo(arcname)
+                info.size = size
+                info.mtime = time()
+                info.mode = 0o644
+                self._tar.addfile(info, fileobj)
+
+    def add_directory(self, arcname):
+        """
+        add a directory entry. zip archives have no directory entries.
+        """
+        with self._lock:
+            if self._tar is not None:
+                info = tarfile.TarInfo(arcname)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = time()
+                self._tar.addfile(info)
+
+    def add_tree(self, path, arcname, exclude=None):
+        """
+        add a directory recursively.
+        :param path:    directory path
+        :param arcname: name of the directory in the archive
+        :param exclude: callable to skip a file. It takes the file path and returns True to skip
+        """
+        for dirpath, dirnames, filenames in walk(path):
+            rel_path = path_relpath(dirpath, path)
+            rel_dir = arcname if rel_path == '.' else path_join(arcname, rel_path)
+            dirnames.sort()
+            self.add_directory(rel_dir)
+            for entry in sorted(filenames):
+                if exclude and exclude(path_join(dirpath, entry)):
+                    continue
+                self.add(path_join(dirpath, entry), path_join(rel_dir, entry))
+
+    def close(self):
+        """
+        finish the archive, and move it to archive_path.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._close_streams()
+            file_replace(self._part_path, self.archive_path)
+
+    def abort(self):
+        """
+        discard the unfinished archive.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                self._close_streams()
+            finally:
+                if path_exists(self._part_path):
+                    unlink(self._part_path)
+
+    def _close_streams(self):
+        if self._zip is not None:
+            self._zip.close()
+        if self._tar is not None:
+            self._tar.close()
+        if self._compressor is not None:
+            self._compressor.close()
+        if self._fileobj is not None:
+            self._fileobj.close()
+
+
+class _GzipStream(object):
+    """
+    Single-threaded counterpart of ParallelGzipFile.
+    """
+
+    def __init__(self, fileobj, level):
+        self.fileobj = fileobj
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        self.fileobj.write(self._compressor.compress(data))
+
+    def close(self):
+        if self._compressor:
+            self.fileobj.write(self._compressor.flush())
+            self._compressor = None
+
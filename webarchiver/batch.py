@@ -0,0 +1,277 @@
+"""
+Batch archiving: downloads run on a thread pool shared by all jobs, and archives are built on a process pool.
+
+    python -m webarchiver.batch jobs.json -d /data/archives --workers 16 --per-host 4 --processes 4
+
+A job file maps titles to url lists:
+
+    {"episode 1": ["http://example.com/1.jpg", "http://example.com/2.jpg"], "episode 2": [...]}
+
+Job states are kept in <download_path>/.batch-state.json, so a restarted batch skips archived titles,
+and continues the downloads of the others.
+"""
+from __future__ import absolute_import, print_function
+
+from argparse import ArgumentParser
+from io import open
+from json import (
+    dumps as json_dumps,
+    load as json_load,
+)
+from multiprocessing import Pool
+from os import makedirs
+from sys import exit
+
+from os.path import (
+    exists as path_exists,
+    join as path_join,
+)
+
+from shutil import rmtree
+from threading import Lock
+
+from . import (
+    get_download_paths,
+    get_safe_name,
+    is_download_leftover,
+    url_download,
+)
+from .archives import ArchiveWriter
+from .manifest import (
+    DownloadManifest,
+    file_replace,
+)
+from .ratelimit import HostRateLimiter
+from .workers import (
+    HostLimiter,
+    get_host,
+    run_in_threads,
+)
+
+PENDING = 'pending'
+DOWNLOADED = 'downloaded'
+ARCHIVED = 'archived'
+FAILED = 'failed'
+
+
+def load_jobs(job_file):
+    """
+    :param job_file: JSON file of {title: [url, ...]}, or [{"title": title, "urls": [url, ...]}, ...]
+    :return:         list of (title, urls)
+    """
+    with open(job_file, 'r', encoding='utf-8') as f:
+        jobs = json_load(f)
+    if isinstance(jobs, dict):
+        return sorted(jobs.items())
+    return [(job['title'], job['urls']) for job in jobs]
+
+
+def archive_directory(archive_path, save_dir, arcname, archiver, level=None, threads=1, cleanup=True):
+    """
+    archive a downloaded directory. Runs in a worker process of BatchRunner.
+    :return: None, or the error message
+    """
+    try:
+        with ArchiveWriter(archive_path, archiver, level=level, threads=threads) as writer:
+            writer.add_tree(save_dir, arcname, exclude=is_download_leftover)
+        if cleanup:
+            rmtree(save_dir)
+    except Exception as e:
+        return repr(e)
+
+
+class JobState(object):
+    """
+    Thread-safe job states persisted in a JSON file: {title: {"status": ..., "failures": [[url, error], ...]}}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._states = {}
+        if path_exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self._states = json_load(f)
+
+    def get(self, title):
+        with self._lock:
+            return self._states.get(title, {}).get('status', PENDING)
+
+    def get_failures(self, title):
+        with self._lock:
+            return self._states.get(title, {}).get('failures', [])
+
+    def set(self, title, status, failures=None):
+        with self._lock:
+            self._states[title] = {'status': status, 'failures': failures or []}
+            temp_path = self.path + '.part'
+            with open(temp_path, 'wb') as f:
+                f.write(json_dumps(self._states, indent=1, sort_keys=True).encode('utf-8'))
+            file_replace(temp_path, self.path)
+
+
+class BatchRunner(object):
+    """
+    Runs archiving jobs. Every job shares one budget: at most workers downloads at once, at most per_host
+    downloads per host at once, and at least interval seconds between the starts of downloads from a host.
+    """
+
+    state_file_name = '.batch-state.json'
+
+    def __init__(self, download_path, archiver='.tar.gz', workers=8, per_host=2, interval=0, processes=2,
+                 compress_level=None, compress_threads=1, cleanup=True, state_file=None):
+        """
+        :param download_path:    directory of downloads and archives
+        :param archiver:         one of ArchiveWriter.archivers
+        :param workers:          number of download threads
+        :param per_host:         maximum concurrent downloads per host. 0 means no cap
+        :param interval:         minimum seconds between downloads from the same host
+        :param processes:        number of archiving processes
+        :param compress_level:   compression level. ArchiveWriter.default_levels if None
+        :param compress_threads: compression threads per archive for '.tar.gz' and '.tar.zst'
+        :param cleanup:          remove downloaded directories after archiving
+        :param state_file:       path of the job state file. <download_path>/.batch-state.json if None
+        """
+        if archiver not in ArchiveWriter.archivers:
+            raise AttributeError('Unsupported archive: %s' % archiver)
+
+        self.download_path = download_path
+        self.archiver = archiver
+        self.workers = workers
+        self.interval = interval
+        self.processes = processes
+        self.compress_level = compress_level
+        self.compress_threads = compress_threads
+        self.cleanup = cleanup
+        self.state = JobState(state_file or path_join(download_path, self.state_file_name))
+
+        self.host_limiter = HostLimiter(per_host)
+        self.rate_limiter = HostRateLimiter(interval)
+
+    def run(self, jobs):
+        """
+        :param jobs: list of (title, urls)
+        :return:     {title: status}
+        """
+        if not path_exists(self.download_path):
+            makedirs(self.download_path)
+
+        pool = Pool(self.processes)
+        lock = Lock()
+        remaining = {}
+        failures = {}
+        manifests = {}
+        tasks = []
+        urls_of = dict(jobs)
+
+        def archive(title):
+            def archived(error):
+                if error:
+                    self.state.set(title, FAILED, [['', error]])
+                else:
+                    self.state.set(title, ARCHIVED)
+
+            safe_title = get_safe_name(title)
+            pool.apply_async(
+                archive_directory,
+                (path_join(self.download_path, safe_title + self.archiver),
+                 path_join(self.download_path, safe_title), safe_title, self.archiver,
+                 self.compress_level, self.compress_threads, self.cleanup),
+                callback=archived,
+            )
+
+        def finish(title):
+            if failures[title]:
+                self.state.set(title, FAILED, failures[title])
+            else:
+                self.state.set(title, DOWNLOADED)
+                archive(title)
+
+        for title, urls in jobs:
+            status = self.state.get(title)
+            if status == ARCHIVED:
+                continue
+            if status == DOWNLOADED:
+                archive(title)
+                continue
+            save_dir = path_join(self.download_path, get_safe_name(title))
+            if not path_exists(save_dir):
+                makedirs(save_dir)
+            manifest = manifests[title] = DownloadManifest(save_dir)
+            failures[title] = []
+            title_tasks = [(title, url, path) for url, path in zip(urls, get_download_paths(save_dir, urls))
+                           if not manifest.is_complete(url, path)]
+            remaining[title] = len(title_tasks)
+            if title_tasks:
+                tasks.extend(title_tasks)
+            else:
+                finish(title)
+
+        def download(title, url, path):
+            host = get_host(url)
+            try:
+                self.host_limiter.acquire(host)
+                try:
+                    self.rate_limiter.wait(host)
+                    url_download(url=url, download_path=path, manifest=manifests[title])
+                finally:
+                    self.host_limiter.release(host)
+            except Exception as e:
+                with lock:
+                    failures[title].append([url, repr(e)])
+                raise
+            finally:
+                with lock:
+                    remaining[title] -= 1
+                    done = not remaining[title]
+                if done:
+                    finish(title)
+
+        try:
+            run_in_threads(download, tasks, self.workers)
+        finally:
+            pool.close()
+            pool.join()
+
+        return dict((title, self.state.get(title)) for title in urls_of)
+
+
+def main(args=None):
+    parser = ArgumentParser(description='Download and archive url lists of a job file.')
+    parser.add_argument('job_file', help='JSON file of {title: [url, ...]}')
+    parser.add_argument('-d', '--download-path', default='.', help='directory of downloads and archives')
+    parser.add_argument('-a', '--archiver', default='.tar.gz', choices=ArchiveWriter.archivers)
+    parser.add_argument('-w', '--workers', type=int, default=8, help='download threads')
+    parser.add_argument('--per-host', type=int, default=2, help='concurrent downloads per host. 0 means no cap')
+    parser.add_argument('--interval', type=float, default=0, help='seconds between downloads from a host')
+    parser.add_argument('-p', '--processes', type=int, default=2, help='archiving processes')
+    parser.add_argument('--level', type=int, default=None, help='compression level')
+    parser.add_argument('--threads', type=int, default=1, help='compression threads per archive')
+    parser.add_argument('--keep', action='store_true', help='keep downloaded directories after archiving')
+    parser.add_argument('--state-file', default=None, help='job state file')
+    options = parser.parse_args(args)
+
+    runner = BatchRunner(
+        options.download_path,
+        archiver=options.archiver,
+        workers=options.workers,
+        per_host=options.per_host,
+        interval=options.interval,
+        processes=options.processes,
+        compress_level=options.level,
+        compress_threads=options.threads,
+        cleanup=not options.keep,
+        state_file=options.state_file,
+    )
+    statuses = runner.run(load_jobs(options.job_file))
+
+    for title, status in sorted(statuses.items()):
+        print('%s\t%s' % (status, title))
+        for url, error in runner.state.get_failures(title):
+            print('\t%s\t%s' % (url, error))
+
+    return 0 if all(status == ARCHIVED for status in statuses.values()) else 1
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,282 @@
+"""
+Benchmarks against a local HTTP server, like the tests.
+
+    python -m webarchiver.benchmarks -o results-1.1.0.json
+    python -m webarchiver.benchmarks --compare results-1.0.0.json --tolerance 0.2
+
+Each benchmark runs once untimed to warm up, then --runs times; the median is reported. Memory is traced
+in one more run, as tracing slows the timed ones down. Results are written as JSON. With --compare,
+benchmarks slower than the baseline by more than the tolerance are reported, and the exit status is 1.
+"""
+from __future__ import absolute_import, print_function
+
+import platform
+import sys
+import tempfile
+
+from argparse import ArgumentParser
+from io import open
+from json import (
+    dumps as json_dumps,
+    load as json_load,
+)
+from os import urandom
+from shutil import rmtree
+from threading import Thread
+from time import time
+
+from six import text_type
+# noinspection PyUnresolvedReferences
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler
+# noinspection PyUnresolvedReferences
+from six.moves.socketserver import (
+    TCPServer,
+    ThreadingMixIn,
+)
+
+from . import (
+    __version__,
+    archive_remote_urls,
+    url_download,
+)
+from .connectors import RequestsConnector
+from .ratelimit import HostRateLimiter
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+
+class PayloadHandler(BaseHTTPRequestHandler):
+    """
+    '/bytes/<size>/<name>' replies <size> random bytes. Other paths reply a small HTML page.
+    """
+    payloads = {}
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts[0] == 'bytes':
+            size = int(parts[1])
+            if size not in self.payloads:
+                self.payloads[size] = urandom(size)
+            body = self.payloads[size]
+            content_type = 'application/octet-stream'
+        else:
+            body = b'<html><body>benchmark</body></html>'
+            content_type = 'text/html; charset=utf-8'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class BenchmarkServer(object):
+    """
+    Local HTTP server on a free port.
+    """
+
+    def __init__(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), PayloadHandler)
+        self.thread = Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.httpd.server_address[:2]
+
+
+def measure(name, func, params, units=None, runs=5, warmup=1):
+    """
+    time func, and trace its peak memory in a separate run, as tracing slows it down.
+    :param name:   benchmark name
+    :param func:   callable without arguments, which can run repeatedly
+    :param params: dict of benchmark parameters
+    :param units:  number of units processed by func, e.g. bytes or requests, to compute the rate
+    :param runs:   number of timed runs. The median is reported
+    :param warmup: number of untimed runs before, to warm up connections and caches
+    :return:       result dict
+    """
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    for _ in range(max(1, runs)):
+        started = time()
+        func()
+        timings.append(time() - started)
+    seconds = median(timings)
+
+    peak = None
+    if tracemalloc:
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'name': name,
+        'params': params,
+        'seconds': seconds,
+        'runs': len(timings),
+        'min_seconds': min(timings),
+        'max_seconds': max(timings),
+        'rate': units / seconds if units and seconds else None,
+        'peak_memory': peak,
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def bench_url_download(server, size, count, **kwargs):
+    temp_dir = tempfile.mkdtemp()
+
+    def run():
+        for i in range(count):
+            url_download('%s/bytes/%d/%d.bin' % (server.url, size, i), '%s/%d.bin' % (temp_dir, i))
+
+    try:
+        return measure('url_download', run, {'size': size, 'count': count}, size * count, **kwargs)
+    finally:
+        rmtree(temp_dir)
+
+
+def bench_requests_connector(server, count, **kwargs):
+    temp_dir = tempfile.mkdtemp()
+    connector = RequestsConnector(temp_dir + '/cookie', delay=0, rate_limiter=HostRateLimiter())
+
+    def run():
+        for i in range(count):
+            connector.get('%s/page/%d' % (server.url, i))
+
+    try:
+        return measure('RequestsConnector.get', run, {'count': count}, count, **kwargs)
+    finally:
+        rmtree(temp_dir)
+
+
+def bench_archive_remote_urls(server, archiver, size, count, workers, **kwargs):
+    temp_dir = tempfile.mkdtemp()
+    urls = ['%s/bytes/%d/%d.jpg' % (server.url, size, i) for i in range(count)]
+
+    def run():
+        archive_remote_urls(temp_dir, 'benchmark', urls, archiver=archiver, workers=workers)
+
+    try:
+        params = {'archiver': archiver, 'size': size, 'count': count, 'workers': workers}
+        return measure('archive_remote_urls', run, params, size * count, **kwargs)
+    finally:
+        rmtree(temp_dir)
+
+
+def run_benchmarks(sizes=(16 * 1024, 1024 * 1024), counts=(10, 50), requests=200, workers=(1, 4),
+                   archivers=('.tar.gz', '.zip'), runs=5, warmup=1):
+    """
+    :param runs:   timed runs of each benchmark. See measure()
+    :param warmup: untimed runs of each benchmark
+    :return:       list of result dicts
+    """
+    options = {'runs': runs, 'warmup': warmup}
+    results = []
+    with BenchmarkServer() as server:
+        for size in sizes:
+            results.append(bench_url_download(server, size, max(counts), **options))
+        results.append(bench_requests_connector(server, requests, **options))
+        for archiver in archivers:
+            for size in sizes:
+                for count in counts:
+                    for worker_count in workers:
+                        results.append(
+                            bench_archive_remote_urls(server, archiver, size, count, worker_count, **options)
+                        )
+    return results
+
+
+def get_key(result):
+    return result['name'] + json_dumps(result['params'], sort_keys=True)
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    :param results:   list of result dicts
+    :param baseline:  list of result dicts of a previous run
+    :param tolerance: allowed slowdown ratio
+    :return:          list of (result, baseline result) slower than tolerance
+    """
+    previous = dict((get_key(result), result) for result in baseline)
+    regressions = []
+    for result in results:
+        old = previous.get(get_key(result))
+        if old and result['seconds'] > old['seconds'] * (1 + tolerance):
+            regressions.append((result, old))
+    return regressions
+
+
+def main(args=None):
+    parser = ArgumentParser(description='Benchmark webarchiver against a local HTTP server.')
+    parser.add_argument('-o', '--output', help='JSON file to write the results. stdout if omitted')
+    parser.add_argument('--compare', help='JSON file of baseline results')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown ratio from the baseline')
+    parser.add_argument('--quick', action='store_true', help='small sizes and counts')
+    parser.add_argument('--runs', type=int, default=5, help='timed runs of each benchmark, reporting the median')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs of each benchmark')
+    options = parser.parse_args(args)
+
+    if options.quick:
+        results = run_benchmarks(sizes=(16 * 1024,), counts=(10,), requests=50, workers=(1, 4),
+                                 runs=options.runs, warmup=options.warmup)
+    else:
+        results = run_benchmarks(runs=options.runs, warmup=options.warmup)
+
+    report = json_dumps({
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }, indent=1, sort_keys=True)
+
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            f.write(text_type(report))
+    else:
+        print(report)
+
+    if options.compare:
+        with open(options.compare, 'r', encoding='utf-8') as f:
+            baseline = json_load(f)['results']
+        regressions = compare(results, baseline, options.tolerance)
+        for result, old in regressions:
+            print('regression: %s %s: %.3fs -> %.3fs' % (
+                result['name'], json_dumps(result['params'], sort_keys=True), old['seconds'], result['seconds']
+            ), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
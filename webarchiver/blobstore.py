@@ -0,0 +1,205 @@
+from __future__ import absolute_import
+
+import hashlib
+import sqlite3
+
+from os import (
+    close as os_close,
+    makedirs,
+    unlink,
+)
+
+from os.path import (
+    exists as path_exists,
+    getsize as path_getsize,
+    join as path_join,
+)
+
+from shutil import copyfile
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+
+from .manifest import file_replace
+
+try:
+    from os import link
+except ImportError:
+    # python 2 on Windows
+    link = None
+
+
+class HashingWriter(object):
+    """
+    File-like wrapper hashing everything written through it.
+    """
+
+    def __init__(self, f, algorithm='sha256'):
+        self.f = f
+        self.hash = hashlib.new(algorithm)
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class BlobStore(object):
+    """
+    Content-addressed store of downloaded files.
+
+    Blobs are kept in <root>/objects/<digest[:2]>/<digest>, and <root>/index.sqlite maps urls to digests.
+    A url fetched before is not downloaded again, and identical contents from different urls are stored once.
+    Files are placed at their destinations as hard links to the blobs, or copies if hard links are not possible.
+    Do not modify the placed files in place: hard links share the blob's content.
+    """
+
+    def __init__(self, root, algorithm='sha256'):
+        """
+        :param root:      directory of the store
+        :param algorithm: hashlib algorithm name
+        """
+        self.root = root
+        self.algorithm = algorithm
+        self.objects_dir = path_join(root, 'objects')
+        self.temp_dir = path_join(root, 'tmp')
+
+        for directory in (self.objects_dir, self.temp_dir):
+            if not path_exists(directory):
+                makedirs(directory)
+
+        self._lock = Lock()
+        self._db = sqlite3.connect(path_join(root, 'index.sqlite'), timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT, size INTEGER, stored REAL)'
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get_blob_path(self, digest):
+        return path_join(self.objects_dir, digest[:2], digest)
+
+    def lookup(self, url):
+        """
+        :return: digest of url's content if the url is fetched before and its blob exists, or None
+        """
+        with self._lock:
+            row = self._db.execute('SELECT digest FROM urls WHERE url = ?', (url,)).fetchone()
+        if row and path_exists(self.get_blob_path(row[0])):
+            return row[0]
+        return None
+
+    def fetch_blob(self, url, download=None, **kwargs):
+        """
+        download url into the store, unless the url is already stored.
+        :param url:      url to fetch
+        :param download: callable like url_download(url, download_path, **kwargs), used to fetch unknown urls
+        :param kwargs:   keyword arguments for download
+        :return:         path of the blob
+        """
+        digest = self.lookup(url)
+        if digest:
+            return self.get_blob_path(digest)
+
+        if download is None:
+            from . import url_download as download
+
+        fd, temp_path = mkstemp(dir=self.temp_dir)
+        os_close(fd)
+        try:
+            with open(temp_path, 'wb') as f:
+                writer = HashingWriter(f, self.algorithm)
+                download(url, writer, **kwargs)
+            digest = writer.hexdigest()
+            self._store(temp_path, digest)
+        finally:
+            if path_exists(temp_path):
+                unlink(temp_path)
+
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)',
+                    (url, digest, writer.size, time())
+                )
+        return self.get_blob_path(digest)
+
+    def fetch(self, url, download_path, download=None, **kwargs):
+        """
+        place url's content at download_path, downloading it only if the url is not stored yet.
+        :param url:           url to fetch
+        :param download_path: destination file path
+        :param download:      see fetch_blob()
+        :param kwargs:        see fetch_blob()
+        :return:              path of the blob
+        """
+        blob_path = self.fetch_blob(url, download, **kwargs)
+        self.place(blob_path, download_path)
+        return blob_path
+
+    def add_file(self, path, url=None):
+        """
+        put an existing file into the store, and replace the file with a link to the blob.
+        :param path: file path
+        :param url:  url of the file to record in the index
+        :return:     digest
+        """
+        file_hash = hashlib.new(self.algorithm)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                file_hash.update(chunk)
+        digest = file_hash.hexdigest()
+
+        blob_path = self.get_blob_path(digest)
+        if not path_exists(blob_path):
+            fd, temp_path = mkstemp(dir=self.temp_dir)
+            os_close(fd)
+            copyfile(path, temp_path)
+            self._store(temp_path, digest)
+        self.place(blob_path, path)
+
+        if url:
+            with self._lock:
+                with self._db:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)',
+                        (url, digest, path_getsize(blob_path), time())
+                    )
+        return digest
+
+    @staticmethod
+    def place(blob_path, download_path):
+        """
+        hard link blob_path to download_path, or copy it if a hard link is not possible.
+        """
+        part_path = download_path + '.part'
+        if path_exists(part_path):
+            unlink(part_path)
+        try:
+            if link is None:
+                raise OSError()
+            link(blob_path, part_path)
+        except OSError:
+            # another file system, or no hard link support
+            copyfile(blob_path, part_path)
+        file_replace(part_path, download_path)
+
+    def _store(self, temp_path, digest):
+        blob_path = self.get_blob_path(digest)
+        if path_exists(blob_path):
+            return
+        blob_dir = path_join(self.objects_dir, digest[:2])
+        if not path_exists(blob_dir):
+            try:
+                makedirs(blob_dir)
+            except OSError:
+                # created by another thread meanwhile
+                pass
+        file_replace(temp_path, blob_path)
@@ -0,0 +1,421 @@
+"""
+Headless Chromium and Firefox rendering, with several tabs per browser process.
+
+    browser = Browser('chrome', max_tabs=4, service_log_path=os.devnull)
+    connector = BrowserConnector(browser, cookie_store=CookieStore('cookies.sqlite'))
+    connector.get('http://example.com/')
+    browser.close()
+
+Each BrowserConnector is a tab of a Browser. The tabs of a browser render pages concurrently: a tab starts
+its navigation by a script, and is polled until the new document is complete, while the other tabs use
+the WebDriver session meanwhile.
+
+BrowserConnector keeps cookies like RequestsConnector. Cookies of a host in its jar, cookie file or cookie store
+are set in the browser before the first page of the host, and cookies set by pages are written back.
+A login done by a RequestsConnector with the same cookie store is used by the browser, and vice versa.
+
+Browser('phantomjs') drives PhantomJS as a browser of one tab. PhantomJSConnector and phantomjs_factory() of
+connectors module stay a separate backend on purpose: they run scripts in the PhantomJS context,
+which ResourceFilter needs, and load pages by a blocking driver.get(). Use them for ResourceFilter,
+and Browser for tabs and cookies shared with RequestsConnector.
+
+browser_factory() is a connector factory for ConnectorPool and HybridConnector:
+
+    pool = ConnectorPool(factory=browser_factory, browser=Browser('chrome', max_tabs=4), max_size=4)
+"""
+from __future__ import absolute_import
+
+from threading import Lock
+from time import sleep
+
+from requests.cookies import (
+    RequestsCookieJar,
+    create_cookie,
+)
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    StaleElementReferenceException,
+    TimeoutException,
+    WebDriverException,
+)
+from selenium.webdriver import (
+    Chrome,
+    ChromeOptions,
+    DesiredCapabilities,
+    Firefox,
+    FirefoxOptions,
+    PhantomJS,
+)
+
+from .connectors import (
+    BaseConnector,
+    ConnectorMixin,
+    CookieJarMixin,
+    UserAgents,
+)
+from .metrics import (
+    create_event,
+    emit,
+    timer,
+)
+from .ratelimit import monotonic
+from .workers import get_host
+
+
+def create_chrome_driver(executable_path='chromedriver', headless=True, user_agent=None, block_images=False,
+                         service_log_path=None, arguments=()):
+    options = ChromeOptions()
+    if headless:
+        options.add_argument('--headless')
+    options.add_argument('--disable-gpu')
+    options.add_argument('--no-sandbox')
+    if user_agent:
+        options.add_argument('--user-agent=%s' % user_agent)
+    if block_images:
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+    for argument in arguments:
+        options.add_argument(argument)
+    return Chrome(executable_path=executable_path, options=options, service_log_path=service_log_path)
+
+
+def create_firefox_driver(executable_path='geckodriver', headless=True, user_agent=None, block_images=False,
+                          service_log_path=None, arguments=()):
+    options = FirefoxOptions()
+    options.headless = headless
+    if user_agent:
+        options.set_preference('general.useragent.override', user_agent)
+    if block_images:
+        options.set_preference('permissions.default.image', 2)
+    for argument in arguments:
+        options.add_argument(argument)
+    return Firefox(
+        executable_path=executable_path, options=options, service_log_path=service_log_path or 'geckodriver.log'
+    )
+
+
+def create_phantomjs_driver(executable_path='phantomjs', headless=True, user_agent=None, block_images=False,
+                            service_log_path=None, arguments=()):
+    caps = dict(DesiredCapabilities.PHANTOMJS)
+    if user_agent:
+        caps['phantomjs.page.settings.userAgent'] = user_agent
+    if block_images:
+        caps['phantomjs.page.settings.loadImages'] = False
+    return PhantomJS(
+        executable_path=executable_path, desired_capabilities=caps, service_args=list(arguments),
+        service_log_path=service_log_path
+    )
+
+
+def to_webdriver_cookie(cookie):
+    """
+    :param cookie: cookielib Cookie
+    :return:       dict for WebDriver's add_cookie()
+    """
+    item = {
+        'name': cookie.name,
+        'value': cookie.value or '',
+        'path': cookie.path or '/',
+        'secure': bool(cookie.secure),
+    }
+    if cookie.domain_specified:
+        item['domain'] = cookie.domain
+    if cookie.expires:
+        item['expiry'] = int(cookie.expires)
+    if cookie.has_nonstandard_attr('HttpOnly'):
+        item['httpOnly'] = True
+    return item
+
+
+def from_webdriver_cookie(item, host):
+    """
+    :param item: dict of WebDriver's get_cookies()
+    :param host: host of the page, the domain of a host-only cookie
+    :return:     cookielib Cookie
+    """
+    domain = item.get('domain') or host.split(':')[0]
+    rest = {'HttpOnly': None} if item.get('httpOnly') else {}
+    cookie = create_cookie(
+        item['name'], item['value'], domain=domain, path=item.get('path', '/'), secure=item.get('secure', False),
+        expires=int(item['expiry']) if item.get('expiry') else None, discard=not item.get('expiry'), rest=rest
+    )
+    # a cookie without a leading dot is host-only
+    cookie.domain_specified = domain.startswith('.')
+    return cookie
+
+
+class Browser(object):
+    """
+    A browser process driven by WebDriver, rendering pages on several tabs.
+    The WebDriver session serves one command at a time, so the tabs take turns by a lock.
+    """
+
+    drivers = {
+        'chrome': create_chrome_driver,
+        'firefox': create_firefox_driver,
+        'phantomjs': create_phantomjs_driver,
+    }
+
+    def __init__(self, engine='chrome', max_tabs=4, driver_factory=None, **driver_kwargs):
+        """
+        :param engine:         key of drivers: 'chrome', 'firefox' or 'phantomjs'. PhantomJS has one tab
+        :param max_tabs:       maximum number of tabs
+        :param driver_factory: callable creating the WebDriver, taking driver_kwargs. drivers[engine] if None
+        :param driver_kwargs:  keyword arguments for the driver factory, e.g. executable_path, headless, user_agent,
+                               block_images, service_log_path, arguments
+        """
+        if driver_factory is None and engine not in self.drivers:
+            raise ValueError('Unknown browser engine: %s' % engine)
+
+        self.engine = engine
+        self.max_tabs = 1 if engine == 'phantomjs' else max_tabs
+        self.driver = (driver_factory or self.drivers[engine])(**driver_kwargs)
+        self.driver_open = True
+
+        self._lock = Lock()
+        self._current = self.driver.current_window_handle
+        self._free = [self._current]  # window handles not used by connectors
+        self._tabs = 1
+        self._hosts = {}  # host: cookies set in the browser, by set_cookies()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if not self.driver_open:
+                return
+            self.driver_open = False
+            self.driver.quit()
+
+    def is_alive(self):
+        process = getattr(getattr(self.driver, 'service', None), 'process', None)
+        return self.driver_open and (process is None or process.poll() is None)
+
+    def open_tab(self):
+        """
+        :return: window handle of a new or free tab
+        """
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            if self._tabs >= self.max_tabs:
+                raise RuntimeError('All %d tabs are in use' % self.max_tabs)
+            known = set(self.driver.window_handles)
+            self.driver.execute_script('window.open("about:blank");')
+            handle = next(h for h in self.driver.window_handles if h not in known)
+            self._tabs += 1
+            return handle
+
+    def close_tab(self, handle):
+        """
+        give a tab back. The tab is kept blank for the next connector.
+        """
+        with self._lock:
+            if not self.driver_open:
+                return
+            try:
+                self._switch(handle)
+                self.driver.get('about:blank')
+            except WebDriverException:
+                self._tabs -= 1
+                return
+            self._free.append(handle)
+
+    def _switch(self, handle):
+        if self._current != handle:
+            self.driver.switch_to.window(handle)
+            self._current = handle
+
+    def run(self, handle, func, *args):
+        """
+        call func(driver, *args) on the tab.
+        """
+        with self._lock:
+            self._switch(handle)
+            return func(self.driver, *args)
+
+    def set_cookies(self, handle, url, cookies, wait=10):
+        """
+        set cookies of url's host in the browser, when they differ from those set before, e.g. after a login
+        by HTTP. Chrome sets them by DevTools. The other engines set them on the host's robots.txt, the cheapest
+        page of the host, loaded like render() without keeping the other tabs waiting.
+        :param wait: seconds to load robots.txt
+        :return:     True if set now
+        """
+        host = get_host(url)
+        cookies = list(cookies)
+        key = frozenset((c.domain, c.path, c.name, c.value) for c in cookies)
+        with self._lock:
+            if not cookies or self._hosts.get(host) == key:
+                return False
+            if hasattr(self.driver, 'execute_cdp_cmd'):
+                self._switch(handle)
+                for cookie in cookies:
+                    item = to_webdriver_cookie(cookie)
+                    item['url'] = url
+                    if 'expiry' in item:
+                        item['expires'] = item.pop('expiry')
+                    self.driver.execute_cdp_cmd('Network.setCookie', item)
+                self._hosts[host] = key
+                return True
+
+        # add_cookie() sets cookies of the current document's host only
+        self.render(handle, url.split('://')[0] + '://' + host + '/robots.txt', wait)
+        with self._lock:
+            self._switch(handle)
+            for cookie in cookies:
+                self.driver.add_cookie(to_webdriver_cookie(cookie))
+            self._hosts[host] = key
+            return True
+
+    def render(self, handle, url, wait=10, until_condition=None, poll_interval=0.1):
+        """
+        load url on the tab, leaving the lock to the other tabs while the page loads.
+        :param wait:            seconds before TimeoutException. 0 means no limit
+        :param until_condition: callable taking the driver, e.g. of expected_conditions, true when the page is ready
+        :return:                (page source, current url, cookies of the page)
+        """
+        with self._lock:
+            self._switch(handle)
+            # the flag is gone once the new document replaces the old one
+            self.driver.execute_script('window.webarchiverLoading = true; window.location.href = arguments[0];', url)
+
+        deadline = monotonic() + wait if wait else None
+        while True:
+            sleep(poll_interval)
+            with self._lock:
+                self._switch(handle)
+                if self._is_ready(until_condition):
+                    return self.driver.page_source, self.driver.current_url, self.driver.get_cookies()
+            if deadline is not None and monotonic() > deadline:
+                raise TimeoutException('Page not ready in %s seconds: %s' % (wait, url))
+
+    def _is_ready(self, until_condition):
+        try:
+            complete = self.driver.execute_script(
+                'return !window.webarchiverLoading && document.readyState === "complete";'
+            )
+            return complete and (until_condition is None or until_condition(self.driver))
+        except (NoSuchElementException, StaleElementReferenceException):
+            return False
+
+
+class BrowserConnector(CookieJarMixin, BaseConnector):
+    """
+    A tab of a Browser. See the module docstring.
+    """
+
+    def __init__(self, browser, cookie_file=None, cookie_store=None, wait=10, until_condition=None,
+                 poll_interval=0.1, metrics=None, warc=None, own_browser=False, wait_profiles=None):
+        """
+        :param browser:         Browser to open the tab in
+        :param cookie_file:     LWP format file of cookies, shared with RequestsConnector
+        :param cookie_store:    CookieStore shared with RequestsConnector and other connectors
+        :param wait:            seconds to wait for a page. 0 means no limit
+        :param until_condition: callable taking the driver, true when the page is ready. See waits module
+        :param poll_interval:   seconds between checks of a loading page
+        :param metrics:         callable taking an event dict of each rendered page. See metrics module
+        :param warc:            WarcWriter to record each rendered page as a resource record
+        :param own_browser:     close the browser on disconnect()
+        :param wait_profiles:   WaitProfiles choosing wait and until_condition by the url, instead of the two
+        """
+        super(BrowserConnector, self).__init__(delay=0)
+
+        self._cookie_file = cookie_file
+        self._cookie_jar = RequestsCookieJar()
+        self._cookie_store = cookie_store
+        self._cookie_hosts = {}
+
+        self.browser = browser
+        self.wait = wait
+        self.until_condition = until_condition
+        self.poll_interval = poll_interval
+        self.metrics = metrics
+        self.warc = warc
+        self.own_browser = own_browser
+        self.wait_profiles = wait_profiles
+        self.last_url = None
+
+        self.handle = browser.open_tab()
+
+        if cookie_file:
+            self.load_cookie()
+
+    @property
+    def driver(self):
+        return self.browser.driver
+
+    @property
+    def driver_open(self):
+        return self.handle is not None and self.browser.is_alive()
+
+    def disconnect(self):
+        handle, self.handle = self.handle, None
+        if handle is None:
+            return
+        if self.own_browser:
+            self.browser.close()
+        else:
+            self.browser.close_tab(handle)
+
+    def get(self, url, params=None, headers=None):
+        url = ConnectorMixin.create_get_url(url, dict(params)) if params else url
+        host = get_host(url)
+        self.load_host_cookies(host)
+        wait, until_condition = self.wait_profiles.get(url) if self.wait_profiles else (
+            self.wait, self.until_condition
+        )
+        self.browser.set_cookies(self.handle, url, [c for c in self._cookie_jar if self._matches(c, host)], wait)
+        started = timer()
+        try:
+            self.last_content, self.last_url, cookies = self.browser.render(
+                self.handle, url, wait, until_condition, self.poll_interval
+            )
+        except Exception as e:
+            emit(self.metrics, create_event('render', url, total=timer() - started, error=repr(e)))
+            raise
+        emit(self.metrics, create_event(
+            'render', url, bytes=len(self.last_content), render=timer() - started, total=timer() - started
+        ))
+
+        self._update_browser_cookies(get_host(self.last_url or url), cookies)
+        if self.warc:
+            self.warc.write_resource(self.last_url or url, self.last_content)
+        return self.last_content
+
+    def post(self, url, data=None, headers=None):
+        raise NotImplementedError('BrowserConnector does not post')
+
+    @staticmethod
+    def _matches(cookie, host):
+        host = host.split(':')[0]
+        domain = cookie.domain.lstrip('.')
+        return host == domain or (cookie.domain_specified and host.endswith('.' + domain))
+
+    def _update_browser_cookies(self, host, items):
+        jar = RequestsCookieJar()
+        for item in items:
+            cookie = from_webdriver_cookie(item, host)
+            if self._cookie_jar.get(cookie.name, domain=cookie.domain, path=cookie.path) != cookie.value:
+                jar.set_cookie(cookie)
+        self.update_cookies(jar)
+
+
+def browser_factory(engine='chrome', user_agent='chrome', browser=None, cookie_file=None, cookie_store=None,
+                    wait=10, until_condition=None, metrics=None, warc=None, wait_profiles=None, **driver_kwargs):
+    """
+    create a BrowserConnector on a tab of browser, or on a new Browser of engine closed with the connector.
+    :param user_agent:    method name of UserAgents, for a new browser
+    :param driver_kwargs: keyword arguments for a new Browser, e.g. max_tabs, service_log_path
+    """
+    own_browser = browser is None
+    if own_browser:
+        driver_kwargs.setdefault('user_agent', getattr(UserAgents, user_agent, UserAgents.chrome)())
+        browser = Browser(engine, **driver_kwargs)
+    return BrowserConnector(
+        browser, cookie_file=cookie_file, cookie_store=cookie_store, wait=wait, until_condition=until_condition,
+        metrics=metrics, warc=warc, own_browser=own_browser, wait_profiles=wait_profiles
+    )
@@ -0,0 +1,188 @@
+from __future__ import absolute_import
+
+import sqlite3
+
+from hashlib import sha1
+from io import open
+from json import (
+    dumps as json_dumps,
+    loads as json_loads,
+)
+from os import (
+    makedirs,
+    unlink,
+)
+
+from os.path import (
+    exists as path_exists,
+    join as path_join,
+)
+
+from threading import Lock
+from time import time
+
+from .manifest import file_replace
+
+
+class HttpCache(object):
+    """
+    On-disk cache of GET responses validated by ETag and Last-Modified.
+
+    Bodies are stored in <cache_dir>/<key[:2]>/<key>, and their validators in <cache_dir>/index.sqlite.
+    The least recently used entries are evicted when max_entries or max_bytes is exceeded.
+    """
+
+    index_name = 'index.sqlite'
+
+    def __init__(self, cache_dir, max_entries=1000, max_bytes=100 * 1024 * 1024,
+                 key_headers=('accept', 'accept-language', 'user-agent')):
+        """
+        :param cache_dir:   directory to store cached responses
+        :param max_entries: maximum number of cached responses. 0 means no limit
+        :param max_bytes:   maximum total size of cached bodies. 0 means no limit
+        :param key_headers: request headers distinguishing cached responses of the same url
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.key_headers = tuple(h.lower() for h in key_headers)
+
+        self.hits = 0
+        self.misses = 0
+
+        if not path_exists(cache_dir):
+            makedirs(cache_dir)
+
+        self._lock = Lock()
+        self._db = sqlite3.connect(path_join(cache_dir, self.index_name), timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                ' key TEXT PRIMARY KEY,'
+                ' url TEXT,'
+                ' etag TEXT,'
+                ' last_modified TEXT,'
+                ' encoding TEXT,'
+                ' headers TEXT,'
+                ' size INTEGER,'
+                ' accessed REAL'
+                ')'
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @property
+    def stats(self):
+        """
+        hit and miss counters, and current size of the cache
+        """
+        with self._lock:
+            entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': entries,
+            'bytes': size,
+        }
+
+    def get_key(self, url, headers=None):
+        """
+        :param url:     url from ConnectorMixin.create_get_url()
+        :param headers: request headers
+        :return:        cache key
+        """
+        headers = dict((k.lower(), v) for k, v in (headers or {}).items())
+        parts = [url] + ['%s: %s' % (h, headers.get(h, '')) for h in self.key_headers]
+        return sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def get_validators(self, key):
+        """
+        return request headers to validate the cached response, or an empty dict if key is not cached
+        """
+        with self._lock:
+            row = self._db.execute('SELECT etag, last_modified FROM entries WHERE key = ?', (key,)).fetchone()
+        validators = {}
+        if row:
+            if row[0]:
+                validators['If-None-Match'] = row[0]
+            if row[1]:
+                validators['If-Modified-Since'] = row[1]
+        return validators
+
+    def load(self, key):
+        """
+        :param key: cache key
+        :return:    (body, encoding, headers) of the cached response, or None
+        """
+        with self._lock:
+            row = self._db.execute('SELECT encoding, headers FROM entries WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            try:
+                with open(self._body_path(key), 'rb') as f:
+                    body = f.read()
+            except IOError:
+                self._delete(key)
+                return None
+            with self._db:
+                self._db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time(), key))
+            self.hits += 1
+        return body, row[0], json_loads(row[1])
+
+    def store(self, key, url, response):
+        """
+        stores a response if it has a validator.
+        :param key:      cache key
+        :param url:      requested url
+        :param response: requests' Response object
+        :return:         True if stored
+        """
+        with self._lock:
+            self.misses += 1
+
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if response.status_code != 200 or not (etag or last_modified):
+            return False
+
+        body = response.content
+        if self.max_bytes and len(body) > self.max_bytes:
+            return False
+
+        body_path = self._body_path(key)
+        body_dir = path_join(self.cache_dir, key[:2])
+        with self._lock:
+            if not path_exists(body_dir):
+                makedirs(body_dir)
+            with open(body_path + '.part', 'wb') as f:
+                f.write(body)
+            file_replace(body_path + '.part', body_path)
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (key, url, etag, last_modified, response.encoding,
+                     json_dumps(dict(response.headers)), len(body), time())
+                )
+            self._evict()
+        return True
+
+    def _evict(self):
+        while True:
+            entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+            if not entries:
+                break
+            if (not self.max_entries or entries <= self.max_entries) and (not self.max_bytes or size <= self.max_bytes):
+                break
+            key = self._db.execute('SELECT key FROM entries ORDER BY accessed LIMIT 1').fetchone()[0]
+            self._delete(key)
+
+    def _delete(self, key):
+        with self._db:
+            self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+        if path_exists(self._body_path(key)):
+            unlink(self._body_path(key))
+
+    def _body_path(self, key):
+        return path_join(self.cache_dir, key[:2], key)
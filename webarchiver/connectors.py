@@ -6,19 +6,28 @@ from six.moves.urllib.parse import (
     urlencode
 )
 
+from codecs import lookup as codecs_lookup
+from json import dumps as json_dumps
 from os.path import exists as path_exists
+from re import (
+    IGNORECASE,
+    compile as re_compile,
+    search as re_search,
+)
 from signal import SIGTERM
-from time import sleep
 
 # noinspection PyUnresolvedReferences
 from six.moves.http_cookiejar import (
-    Cookie,
     LWPCookieJar,
     LoadError,
 )
 
-from requests import request
-from requests.cookies import RequestsCookieJar
+from requests.compat import chardet
+from requests.cookies import (
+    RequestsCookieJar,
+    extract_cookies_to_jar,
+)
+from requests.structures import CaseInsensitiveDict
 
 from selenium.webdriver import PhantomJS
 from selenium.webdriver.common.by import By
@@ -26,6 +35,16 @@ from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions
 
+from .metrics import (
+    create_event,
+    emit,
+    timer,
+)
+from .cookiestore import get_cookie_domains
+from .ratelimit import get_default_rate_limiter
+from .sessions import get_default_session
+from .workers import get_host
+
 
 def get_ec_class():
     return expected_conditions
@@ -59,6 +78,127 @@ class ConnectorMixin(object):
         return url + ('' if not params else '?' + urlencode(params))
 
 
+class _ResponseCookieJar(RequestsCookieJar):
+    """
+    Cookies set by responses, and (domain, path, name) of those deleted by Max-Age <= 0 or a past Expires,
+    which cookielib clears from the jar extracting them.
+    """
+
+    def __init__(self, policy=None):
+        RequestsCookieJar.__init__(self, policy)
+        self.deleted = set()
+
+    def set_cookie(self, cookie, *args, **kwargs):
+        self.deleted.discard((cookie.domain, cookie.path, cookie.name))
+        return RequestsCookieJar.set_cookie(self, cookie, *args, **kwargs)
+
+    def clear(self, domain=None, path=None, name=None):
+        if name is not None:
+            self.deleted.add((domain, path, name))
+        try:
+            RequestsCookieJar.clear(self, domain, path, name)
+        except KeyError:
+            pass
+
+
+class CookieJarMixin(object):
+    """
+    Cookie methods for connectors keeping a RequestsCookieJar in self._cookie_jar,
+    and its LWP format file path in self._cookie_file.
+    With a CookieStore in self._cookie_store, cookies are read per host and written on change instead.
+    """
+
+    _cookie_store = None
+
+    def save_cookie(self, cookie_path=None, **kwargs):
+        """
+        save all cookies into the LWP format file, or into the cookie store if there is no file to save.
+        """
+        cookie_path = cookie_path or self._cookie_file
+        if not cookie_path and self._cookie_store is not None:
+            self._cookie_store.set_cookies(self._cookie_jar)
+            return
+        lwp_jar = LWPCookieJar()
+        for item in self._cookie_jar:
+            lwp_jar.set_cookie(item)
+        lwp_jar.save(cookie_path, **kwargs)
+
+    def load_cookie(self, cookie_path=None, **kwargs):
+        """
+        load cookies of the LWP format file, or all cookies of the cookie store if there is no file to load.
+        Cookies of the file are written to the cookie store.
+        """
+        cookie_path = cookie_path or self._cookie_file
+        if not cookie_path:
+            if self._cookie_store is not None:
+                for cookie in self._cookie_store.get_cookies():
+                    self._cookie_jar.set_cookie(cookie)
+        elif path_exists(cookie_path):
+            try:
+                lwp_jar = LWPCookieJar()
+                lwp_jar.load(cookie_path, **kwargs)
+                self._cookie_jar.update(lwp_jar)
+                if self._cookie_store is not None:
+                    # the store is read again by hosts, so it must hold the cookies of the file
+                    self._cookie_store.set_cookies(lwp_jar)
+            except LoadError:
+                # TODO: log error message
+                pass
+
+    def load_host_cookies(self, host):
+        """
+        load cookies of host from the cookie store, and again whenever the store has changed since.
+        Cookies of the host's domains missing from the store are removed from the jar.
+        """
+        if self._cookie_store is None:
+            return
+        version = self._cookie_store.version
+        if self._cookie_hosts.get(host) == version:
+            return
+        domains = set(get_cookie_domains(host))
+        for cookie in [c for c in self._cookie_jar if c.domain in domains]:
+            self._cookie_jar.clear(cookie.domain, cookie.path, cookie.name)
+        for cookie in self._cookie_store.get_cookies(host):
+            self._cookie_jar.set_cookie(cookie)
+        self._cookie_hosts[host] = version
+
+    def update_cookies(self, cookies, deleted=()):
+        """
+        add cookies received in a response, and write them to the cookie store.
+        :param deleted: (domain, path, name) of cookies deleted or expired by the response
+        """
+        self._cookie_jar.update(cookies)
+        for key in deleted:
+            try:
+                self._cookie_jar.clear(*key)
+            except KeyError:
+                pass
+        if self._cookie_store is not None and (len(cookies) or deleted):
+            self._cookie_store.set_cookies(cookies, deleted)
+
+    def update_response_cookies(self, response):
+        """
+        apply the Set-Cookie headers of a requests' Response and its redirects to the jar and the cookie store,
+        including cookies deleted or expired by them.
+        """
+        responses = list(getattr(response, 'history', None) or ()) + [response]
+        if not any('set-cookie' in r.headers for r in responses):
+            return
+        jar = _ResponseCookieJar()
+        for item in responses:
+            extract_cookies_to_jar(jar, item.request, item.raw)
+        self.update_cookies(jar, jar.deleted)
+
+    def get_cookie(self, name, default=None):
+        return self._cookie_jar.get(name, default)
+
+    def set_cookie(self, name, value, **kwargs):
+        cookie = self._cookie_jar.set(name, value, **kwargs)
+        if self._cookie_store is not None and cookie is not None:
+            self._cookie_store.set_cookies([cookie])
+        return cookie
+
+
 class BaseConnector(object):
     """
     Connector base class
@@ -68,7 +208,7 @@ class BaseConnector(object):
         """
         Keywords
         --------
-        delay: mandatory halt after each response. May be zero.
+        delay: minimum interval in seconds between requests to the same host. May be zero.
         extra_headers: dict for additional request headers
         """
         self._delay = delay
@@ -92,60 +232,418 @@ class BaseConnector(object):
             f.write(self.last_content)
 
 
-class RequestsConnector(BaseConnector):
-    def __init__(self, cookie_file, delay=2, extra_headers=None):
+meta_charset_expr = re_compile(br'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', IGNORECASE)
+
+
+def get_declared_encoding(response, content):
+    """
+    :return: encoding of the headers, or of a <meta> charset in the first 1024 bytes of content, or None
+    """
+    if response.encoding:
+        return response.encoding
+    found = meta_charset_expr.search(content[:1024])
+    if found:
+        try:
+            return codecs_lookup(found.group(1).decode('ascii')).name
+        except LookupError:
+            pass
+    return None
+
+
+def detect_encoding(content, sniff_size=65536):
+    """
+    :return: encoding detected from the first sniff_size bytes of content
+    """
+    return (chardet.detect(content[:sniff_size]) if chardet else {}).get('encoding') or 'utf-8'
+
+
+def get_response_encoding(response, content=None, sniff_size=65536):
+    """
+    encoding of a response body, without running charset detection over the whole body.
+    The encoding of the headers comes first, then a <meta> charset in the first 1024 bytes, then UTF-8.
+    Only a body which is not UTF-8 is detected, from its first sniff_size bytes.
+    :param response: requests' Response object
+    :param content:  the body. response.content if None
+    :return:         encoding name
+    """
+    if content is None:
+        content = response.content
+    encoding = get_declared_encoding(response, content)
+    if encoding:
+        return encoding
+    try:
+        content.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return detect_encoding(content, sniff_size)
+
+
+def get_response_text(response, content=None):
+    """
+    :return: decoded body of requests' Response object, decoded once. See get_response_encoding()
+    """
+    if content is None:
+        content = response.content
+    if not content:
+        return ''
+    encoding = get_declared_encoding(response, content)
+    if encoding is None:
+        try:
+            return content.decode('utf-8')
+        except UnicodeDecodeError:
+            encoding = detect_encoding(content)
+    try:
+        return content.decode(encoding, 'replace')
+    except LookupError:
+        # unknown encoding of the headers
+        return content.decode('utf-8', 'replace')
+
+
+class LazyResponse(object):
+    """
+    Response of RequestsConnector.fetch(). Its body is decoded only when text is read.
+
+        with connector.fetch(url, stream=True) as response:
+            for chunk in response.iter_content(65536):
+                f.write(chunk)
+
+    - content: the raw bytes. Read on first access if streamed
+    - text:    the decoded body, decoded on first access and not kept by the connector
+    - iter_content(): chunks of the body, read from the network if streamed and not read yet.
+                      A body streamed this way is not kept: content and text are empty afterwards,
+                      and so is last_content of the connector
+    - release(): discards the body, and returns the connection to the pool
+    """
+
+    def __init__(self, response):
+        """
+        :param response: requests' Response object
+        """
+        self.response = response
+        self._text = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @property
+    def url(self):
+        return self.response.url
+
+    @property
+    def status_code(self):
+        return self.response.status_code
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    @property
+    def cookies(self):
+        return self.response.cookies
+
+    @property
+    def consumed(self):
+        """
+        True if the body is streamed through iter_content() or released, and no longer available
+        """
+        return self.response._content is False and self.response._content_consumed
+
+    @property
+    def content(self):
+        return b'' if self.consumed else self.response.content
+
+    @property
+    def encoding(self):
+        return get_response_encoding(self.response, self.content)
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = get_response_text(self.response, self.content)
+        return self._text
+
+    def raise_for_status(self):
+        self.response.raise_for_status()
+
+    def iter_content(self, chunk_size=65536):
+        """
+        :return: iterator of bytes chunks of the body
+        """
+        content = self.response._content
+        if content is False:
+            # streamed, not read yet
+            return self.response.iter_content(chunk_size)
+        content = content or b''
+        return (content[i:i + chunk_size] for i in range(0, len(content), chunk_size))
+
+    def release(self):
+        """
+        discard the body and the decoded text. content is empty afterwards.
+        """
+        self._text = None
+        self.response._content = b''
+        self.response._content_consumed = True
+        self.response.close()
+
+
+class RequestsConnector(CookieJarMixin, BaseConnector):
+    # headers of a 304 response not to replace those of the cached response
+    cache_header_excludes = ('content-length', 'content-encoding', 'transfer-encoding', 'content-type')
+
+    def __init__(self, cookie_file, delay=2, extra_headers=None, session=None, cache=None, rate_limiter=None,
+                 throttled_retries=2, metrics=None, cookie_store=None, warc=None, concurrency=None):
+        """
+        Keywords
+        --------
+        cookie_file: LWP format file of cookies. May be None with cookie_store.
+        session: requests Session to send requests. The shared default session is used if omitted.
+                 Cookies are kept in the connector, not in the session.
+        cache:   HttpCache for GET requests. Cached pages are revalidated by If-None-Match and If-Modified-Since,
+                 and a 304 response is served from the cache: last_response gets the cached status, headers
+                 and body, with from_cache set.
+        rate_limiter: HostRateLimiter enforcing delay per host. The shared default limiter is used if omitted.
+        throttled_retries: times to resend a request answered with 429, or 503 with Retry-After.
+        metrics: callable taking an event dict of each HTTP exchange, e.g. MetricsAggregator. See metrics module.
+        cookie_store: CookieStore shared with other connectors. Cookies of a host are read from the store
+                      before the first request to the host, and received cookies are written as they arrive.
+        warc: WarcWriter to record each request and its response. Pages served from the cache are not recorded.
+        concurrency: AdaptiveLimiter shared by connectors on several threads. It caps the requests in flight
+                     per host, and adapts the caps to the responses. A small delay lets it work.
+        """
         super(RequestsConnector, self).__init__(delay, extra_headers)
 
         self._cookie_file = cookie_file
         self._cookie_jar = RequestsCookieJar()
+        self._cookie_store = cookie_store
+        self._cookie_hosts = {}  # host -> version of the cookie store when loaded
+        self._session = session or get_default_session()
+        self._cache = cache
+        self._rate_limiter = rate_limiter or get_default_rate_limiter()
+        self._throttled_retries = throttled_retries
+        self.metrics = metrics
+        self.warc = warc
+        self.concurrency = concurrency
         self.last_response = None
 
-        self.load_cookie()
+        if cookie_file:
+            # a cookie store is read per host instead
+            self.load_cookie()
+
+    @property
+    def last_content(self):
+        """
+        decoded body of the last page. After fetch(), it is decoded on first access.
+        """
+        if self._last_content is None:
+            self._last_content = self._last_fetched.text if self._last_fetched is not None else ''
+        return self._last_content
+
+    @last_content.setter
+    def last_content(self, value):
+        self._last_content = value
+        self._last_fetched = None
 
     def request(self, url, method='GET', params=None, data=None, headers=None):
+        self.last_content = get_response_text(self._request(url, method, params, data, headers))
+        return self.last_content
+
+    def fetch(self, url, method='GET', params=None, data=None, headers=None, stream=False):
+        """
+        send a request like request(), without decoding the body.
+        :param stream: if True, the body is not read until content or iter_content() of the result is used.
+                       Bodies to cache or to record in the WARC file are read anyway
+        :return:       LazyResponse. Call its release() to discard the body
+        """
+        response = LazyResponse(self._request(url, method, params, data, headers, stream))
+        self._last_content = None
+        self._last_fetched = response
+        return response
+
+    def _request(self, url, method, params, data, headers, stream=False):
         headers = headers or {}
         headers.update(self._extra_headers)
-        self.last_response = request(
-            url=url,
-            method=method,
-            params=params,
-            data=data,
-            headers=headers,
-            cookies=self._cookie_jar
-        )
-        self.last_content = self.last_response.text
-        self._cookie_jar.update(self.last_response.cookies)
-        sleep(self._delay)
-        return self.last_content
 
-    def save_cookie(self, cookie_path=None, **kwargs):
+        cache_key = None
+        if self._cache and method.upper() == 'GET':
+            cache_key = self._cache.get_key(ConnectorMixin.create_get_url(url, dict(params or {})), headers)
+            headers = dict(headers, **self._cache.get_validators(cache_key))
+
+        self.last_response = self._send(url, method, params, data, headers, stream)
+
+        if cache_key:
+            cached = None
+            if self.last_response.status_code == 304:
+                cached = self._cache.load(cache_key)
+                if cached:
+                    body, encoding, cached_headers = cached
+                    # the cached response, updated by the headers of the 304 response
+                    headers_304 = self.last_response.headers
+                    self.last_response.headers = CaseInsensitiveDict(cached_headers)
+                    self.last_response.headers.update(
+                        (k, v) for k, v in headers_304.items() if k.lower() not in self.cache_header_excludes
+                    )
+                    self.last_response.status_code = 200
+                    self.last_response.reason = 'OK'
+                    self.last_response._content = body
+                    self.last_response.encoding = encoding
+                else:
+                    # evicted meanwhile: fetch the page again
+                    self.update_response_cookies(self.last_response)
+                    self.last_response.close()
+                    headers.pop('If-None-Match', None)
+                    headers.pop('If-Modified-Since', None)
+                    self.last_response = self._send(url, method, params, data, headers, stream)
+            if not cached:
+                self._cache.store(cache_key, url, self.last_response)
+            self.last_response.from_cache = bool(cached)
+
+        if self.warc and not getattr(self.last_response, 'from_cache', False):
+            self.warc.write_response(self.last_response)
+
+        self.update_response_cookies(self.last_response)
+        return self.last_response
+
+    def _send(self, url, method, params, data, headers, stream=False):
+        host = get_host(url)
+        self.load_host_cookies(host)
+        retries = self._throttled_retries
+        while True:
+            delay = self._rate_limiter.wait(host, self._delay)
+            if self.concurrency:
+                self.concurrency.acquire(host)
+            started = timer()
+            try:
+                response = self._session.request(
+                    url=url,
+                    method=method,
+                    params=params,
+                    data=data,
+                    headers=headers,
+                    cookies=self._cookie_jar,
+                    stream=stream
+                )
+            except Exception as e:
+                event = create_event('request', url, method, delay=delay, total=timer() - started, error=repr(e))
+                emit(self.metrics, event)
+                emit(self.concurrency, event)
+                raise
+            finally:
+                if self.concurrency:
+                    self.concurrency.release(host)
+            if self.metrics or self.concurrency:
+                total = timer() - started
+                ttfb = min(response.elapsed.total_seconds(), total)
+                # never read a body for the metrics
+                if response._content is False:
+                    size = response.headers.get('content-length', '')
+                    size = int(size) if size.isdigit() else None
+                else:
+                    size = len(response._content or b'')
+                event = create_event(
+                    'request', url, method, status_code=response.status_code, bytes=size,
+                    delay=delay, ttfb=ttfb, transfer=total - ttfb, total=total
+                )
+                emit(self.metrics, event)
+                emit(self.concurrency, event)
+            if not self._rate_limiter.observe(host, response.status_code, response.headers) or retries <= 0:
+                return response
+            retries -= 1
+            self.update_response_cookies(response)
+            response.close()
+
+
+class ResourceFilter(object):
+    """
+    Blocks sub-resources of pages rendered by PhantomJSConnector, by type and url pattern.
 
-        cookie_path = cookie_path or self._cookie_file
-        lwp_jar = LWPCookieJar()
-        for item in self._cookie_jar:
-            args = dict(vars(item).items())
-            args['rest'] = args['_rest']
-            del args['_rest']
-            lwp_jar.set_cookie(Cookie(**args))
-        lwp_jar.save(cookie_path, **kwargs)
+        connector = phantomjs_factory(resource_filter=ResourceFilter(block_types=('image', 'font', 'stylesheet')))
 
-    def load_cookie(self, cookie_path=None, **kwargs):
+    PhantomJS does not report resource types, so types are guessed by url patterns in resource_types.
+    The page url passed to PhantomJSConnector.get() is never blocked.
+    """
 
-        cookie_path = cookie_path or self._cookie_file
-        if path_exists(cookie_path):
-            try:
-                lwp_jar = LWPCookieJar()
-                lwp_jar.load(cookie_path, **kwargs)
-                self._cookie_jar.update(lwp_jar)
-            except LoadError:
-                # TODO: log error message
-                pass
+    resource_types = {
+        'image': r'\.(png|jpe?g|gif|webp|svg|ico|bmp)([?#]|$)',
+        'font': r'\.(woff2?|ttf|otf|eot)([?#]|$)',
+        'stylesheet': r'\.css([?#]|$)',
+        'media': r'\.(mp4|webm|ogg|mp3|wav|m4a|flv)([?#]|$)',
+        'script': r'\.js([?#]|$)',
+    }
 
-    def get_cookie(self, name, default=None):
-        return self._cookie_jar.get(name, default)
+    def __init__(self, block_types=(), deny_patterns=(), allow_hosts=None, deny_hosts=()):
+        """
+        :param block_types:   keys of resource_types to block
+        :param deny_patterns: regular expressions of urls to block, e.g. 'google-analytics\\.com'
+        :param allow_hosts:   if given, block resources from the other hosts. Subdomains are allowed too
+        :param deny_hosts:    block resources from these hosts, and their subdomains
+        """
+        for block_type in block_types:
+            if block_type not in self.resource_types:
+                raise ValueError('Unknown resource type: %s' % block_type)
 
-    def set_cookie(self, name, value, **kwargs):
-        self._cookie_jar.set(name, value, **kwargs)
+        self.block_types = tuple(block_types)
+        self.deny_patterns = tuple(deny_patterns)
+        self.allow_hosts = None if allow_hosts is None else tuple(h.lower() for h in allow_hosts)
+        self.deny_hosts = tuple(h.lower() for h in deny_hosts)
+
+    @property
+    def blocks_images(self):
+        return 'image' in self.block_types
+
+    @property
+    def patterns(self):
+        return [self.resource_types[t] for t in self.block_types] + list(self.deny_patterns)
+
+    @staticmethod
+    def _host_matches(host, hosts):
+        return any(host == h or host.endswith('.' + h) for h in hosts)
+
+    def is_blocked(self, url):
+        """
+        Python counterpart of the filter script, for testing urls.
+        """
+        host = get_host(url).split(':')[0]
+        if self.allow_hosts is not None and not self._host_matches(host, self.allow_hosts):
+            return True
+        if self._host_matches(host, self.deny_hosts):
+            return True
+        return any(re_search(p, url, IGNORECASE) for p in self.patterns)
+
+    def get_script(self):
+        """
+        :return: script to run by PhantomJS' executePhantomScript, where 'this' is the page.
+        """
+        config = json_dumps({
+            'patterns': self.patterns,
+            'allowHosts': self.allow_hosts,
+            'denyHosts': self.deny_hosts,
+        })
+        return """
+            var config = %s;
+            var patterns = config.patterns.map(function (p) { return new RegExp(p, 'i'); });
+            var matches = function (host, hosts) {
+                return hosts.some(function (h) { return host === h || host.slice(-h.length - 1) === '.' + h; });
+            };
+            var normalize = function (url) { return url.replace(/#.*$/, '').replace(/\\/$/, ''); };
+            var page = this;
+            page.onResourceRequested = function (requestData, networkRequest) {
+                var url = requestData.url;
+                if (page.webarchiverTarget && normalize(url) === normalize(page.webarchiverTarget)) {
+                    // the page itself
+                    return;
+                }
+                var found = /^[a-z]+:\\/\\/([^\\/?#:]+)/i.exec(url);
+                var host = found ? found[1].toLowerCase() : '';
+                if ((config.allowHosts !== null && !matches(host, config.allowHosts)) ||
+                    matches(host, config.denyHosts) ||
+                    patterns.some(function (p) { return p.test(url); })) {
+                    networkRequest.abort();
+                }
+            };
+        """ % config
 
 
 class PhantomJSConnector(BaseConnector):
@@ -157,9 +655,30 @@ class PhantomJSConnector(BaseConnector):
             service_args=None,
             service_log_path=None,
             wait=10,
-            until_condition=None
+            until_condition=None,
+            resource_filter=None,
+            metrics=None,
+            warc=None,
+            wait_profiles=None,
+            poll_interval=0.1
     ):
-        super(BaseConnector, self).__init__()
+        """
+        Keywords
+        --------
+        until_condition: callable taking the driver, true when the page is ready. See waits module.
+        resource_filter: ResourceFilter to block images, fonts, trackers, and so on.
+        metrics: callable taking an event dict of each rendered page, e.g. MetricsAggregator. See metrics module.
+        warc: WarcWriter to record each rendered page as a resource record.
+        wait_profiles: WaitProfiles choosing wait and until_condition by the url, instead of the two.
+        poll_interval: seconds between checks of until_condition.
+        """
+        super(PhantomJSConnector, self).__init__(delay=0)
+
+        self.driver_open = False
+
+        if resource_filter and resource_filter.blocks_images:
+            desired_capabilities = dict(desired_capabilities)
+            desired_capabilities['phantomjs.page.settings.loadImages'] = False
 
         self.driver = PhantomJS(
             executable_path=executable_path,
@@ -173,23 +692,65 @@ class PhantomJSConnector(BaseConnector):
 
         self.until_condition = until_condition
 
+        self.resource_filter = resource_filter
+
+        self.metrics = metrics
+
+        self.warc = warc
+
+        self.wait_profiles = wait_profiles
+
+        self.poll_interval = poll_interval
+
         self.driver_open = True
 
+        if resource_filter:
+            self.execute_phantom_script(resource_filter.get_script())
+
+    def execute_phantom_script(self, script, *args):
+        """
+        run a script in the PhantomJS context, where 'this' is the page object.
+        """
+        self.driver.command_executor._commands['executePhantomScript'] = (
+            'POST', '/session/$sessionId/phantom/execute'
+        )
+        return self.driver.execute('executePhantomScript', {'script': script, 'args': list(args)})['value']
+
     def __del__(self):
         self.disconnect()
 
     def disconnect(self):
-        if isinstance(self.driver, PhantomJS) and self.driver_open:
-            self.driver.close()
-            self.driver.service.process.send_signal(SIGTERM)
-            self.driver.quit()
+        if self.driver_open and isinstance(self.driver, PhantomJS):
             self.driver_open = False
+            try:
+                self.driver.close()
+            finally:
+                self.driver.service.process.send_signal(SIGTERM)
+                self.driver.quit()
 
     def get(self, url, params=None, headers=None):
-        self.driver.get(url)
-        if self.wait and self.until_condition:
-            WebDriverWait(self.driver, self.wait).until(self.until_condition)
-        self.last_content = self.driver.page_source
+        if self.resource_filter:
+            self.execute_phantom_script('this.webarchiverTarget = arguments[0];', url)
+        started = timer()
+        try:
+            self.driver.get(url)
+            wait, until_condition = self.wait_profiles.get(url) if self.wait_profiles else (
+                self.wait, self.until_condition
+            )
+            if wait and until_condition:
+                WebDriverWait(self.driver, wait, poll_frequency=self.poll_interval).until(until_condition)
+            rendered = timer()
+            self.last_content = self.driver.page_source
+        except Exception as e:
+            emit(self.metrics, create_event('render', url, total=timer() - started, error=repr(e)))
+            raise
+        finished = timer()
+        emit(self.metrics, create_event(
+            'render', url, bytes=len(self.last_content), render=rendered - started, transfer=finished - rendered,
+            total=finished - started
+        ))
+        if self.warc:
+            self.warc.write_resource(self.driver.current_url or url, self.last_content)
         return self.last_content
 
     def post(self, url, data=None, headers=None):
@@ -238,6 +799,8 @@ def phantomjs_factory_mixin_waits(wait, wait_method, by, expr):
     :param by:                attribute of By class as string
     :param expr:              string expression to be retrieved
     :return:
+
+    For composite conditions and waits by url, see waits module.
     """
 
     ec_class = get_ec_class()
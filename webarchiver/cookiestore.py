@@ -0,0 +1,253 @@
+from __future__ import absolute_import
+
+import sqlite3
+
+from json import (
+    dumps as json_dumps,
+    loads as json_loads,
+)
+from os import makedirs
+from os.path import (
+    abspath as path_abspath,
+    dirname as path_dirname,
+    exists as path_exists,
+)
+from threading import Lock
+from time import time
+
+# noinspection PyUnresolvedReferences
+from six.moves.http_cookiejar import (
+    Cookie,
+    LWPCookieJar,
+)
+
+
+def get_cookie_domains(host):
+    """
+    cookie domains matching host: the host itself, and the dotted domains of the host and its parents.
+    :param host: host name, e.g. 'www.example.com'. A port is ignored
+    :return:     list of domains, e.g. ['www.example.com', '.www.example.com', '.example.com', '.com']
+    """
+    host = host.split(':')[0].lower()
+    domains = [host, '.' + host]
+    parts = host.split('.')
+    for i in range(1, len(parts)):
+        domains.append('.' + '.'.join(parts[i:]))
+    return domains
+
+
+class CookieStore(object):
+    """
+    SQLite store of cookies, indexed by domain.
+
+        store = CookieStore('cookies.sqlite')
+        connector = RequestsConnector(None, cookie_store=store)
+
+    Connectors read only the cookies of the hosts they request, and write only the cookies changed by responses.
+    Several connectors, threads, or processes may share one store file. Each process should open its own store.
+    Every write increments version, so connectors read a host again once the store has changed.
+    Expired cookies are never returned, and prune() deletes them.
+    """
+
+    columns = (
+        'domain', 'path', 'name', 'value', 'version', 'port', 'port_specified', 'domain_specified',
+        'domain_initial_dot', 'path_specified', 'secure', 'expires', 'discard', 'comment', 'comment_url', 'rest',
+        'updated',
+    )
+
+    def __init__(self, path, timeout=30):
+        """
+        :param path:    database file path
+        :param timeout: seconds to wait for the lock held by another connection
+        """
+        self.path = path
+
+        directory = path_dirname(path_abspath(path))
+        if not path_exists(directory):
+            makedirs(directory)
+
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        # readers do not block the writer of another process
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS cookies ('
+                ' domain TEXT,'
+                ' path TEXT,'
+                ' name TEXT,'
+                ' value TEXT,'
+                ' version INTEGER,'
+                ' port TEXT,'
+                ' port_specified INTEGER,'
+                ' domain_specified INTEGER,'
+                ' domain_initial_dot INTEGER,'
+                ' path_specified INTEGER,'
+                ' secure INTEGER,'
+                ' expires INTEGER,'
+                ' discard INTEGER,'
+                ' comment TEXT,'
+                ' comment_url TEXT,'
+                ' rest TEXT,'
+                ' updated REAL,'
+                ' PRIMARY KEY (domain, path, name)'
+                ')'
+            )
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM cookies').fetchone()[0]
+
+    @property
+    def version(self):
+        """
+        number of writes to the store, by any connection
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else 0
+
+    def _increment_version(self):
+        self._db.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('version', COALESCE("
+            "(SELECT value FROM meta WHERE key = 'version'), 0) + 1)"
+        )
+
+    def get_cookies(self, host=None, include_expired=False):
+        """
+        :param host:            host name. Cookies of every domain if None
+        :param include_expired: return expired cookies too
+        :return:                list of Cookie objects
+        """
+        query = 'SELECT %s FROM cookies' % ', '.join(self.columns)
+        conditions = []
+        args = []
+        if host is not None:
+            domains = get_cookie_domains(host)
+            conditions.append('domain IN (%s)' % ', '.join('?' * len(domains)))
+            args.extend(domains)
+        if not include_expired:
+            conditions.append('(expires IS NULL OR expires > ?)')
+            args.append(int(time()))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        with self._lock:
+            rows = self._db.execute(query, args).fetchall()
+        return [self._to_cookie(row) for row in rows]
+
+    def set_cookies(self, cookies, deleted=()):
+        """
+        insert or replace cookies in one transaction. Already expired cookies are deleted instead.
+        :param cookies: iterable of Cookie objects, e.g. a CookieJar
+        :param deleted: (domain, path, name) of cookies to delete in the same transaction
+        :return:        number of stored cookies
+        """
+        now = time()
+        rows = []
+        expired = list(deleted)
+        for cookie in cookies:
+            if cookie.expires is not None and cookie.expires <= now:
+                expired.append((cookie.domain, cookie.path, cookie.name))
+            else:
+                rows.append(self._to_row(cookie, now))
+
+        if rows or expired:
+            with self._lock:
+                with self._db:
+                    self._db.executemany(
+                        'INSERT OR REPLACE INTO cookies VALUES (%s)' % ', '.join('?' * len(self.columns)), rows
+                    )
+                    self._db.executemany('DELETE FROM cookies WHERE domain = ? AND path = ? AND name = ?', expired)
+                    self._increment_version()
+        return len(rows)
+
+    def delete(self, domain=None, path=None, name=None):
+        """
+        delete cookies, like CookieJar.clear(): all cookies, cookies of domain, of domain and path, or one cookie.
+        :return: number of deleted cookies
+        """
+        conditions = []
+        args = []
+        for column, value in (('domain', domain), ('path', path), ('name', name)):
+            if value is not None:
+                conditions.append('%s = ?' % column)
+                args.append(value)
+        query = 'DELETE FROM cookies'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        with self._lock:
+            with self._db:
+                self._increment_version()
+                return self._db.execute(query, args).rowcount
+
+    def prune(self, session_cookies=False):
+        """
+        delete expired cookies.
+        :param session_cookies: delete cookies to discard at the end of the session as well
+        :return:                number of deleted cookies
+        """
+        query = 'DELETE FROM cookies WHERE expires <= ?'
+        if session_cookies:
+            query += ' OR discard'
+        with self._lock:
+            with self._db:
+                self._increment_version()
+                return self._db.execute(query, (int(time()),)).rowcount
+
+    def import_lwp(self, cookie_path, ignore_discard=True, ignore_expires=False):
+        """
+        copy cookies of an LWP format file, saved by CookieJarMixin.save_cookie(), into the store.
+        :return: number of stored cookies
+        """
+        lwp_jar = LWPCookieJar()
+        lwp_jar.load(cookie_path, ignore_discard=ignore_discard, ignore_expires=ignore_expires)
+        return self.set_cookies(lwp_jar)
+
+    def export_lwp(self, cookie_path, ignore_discard=True, ignore_expires=False):
+        """
+        write cookies of the store into an LWP format file, readable by CookieJarMixin.load_cookie().
+        """
+        lwp_jar = LWPCookieJar()
+        for cookie in self.get_cookies(include_expired=ignore_expires):
+            lwp_jar.set_cookie(cookie)
+        lwp_jar.save(cookie_path, ignore_discard=ignore_discard, ignore_expires=ignore_expires)
+
+    @staticmethod
+    def _to_row(cookie, updated):
+        rest = dict(getattr(cookie, '_rest', {}))
+        return (
+            cookie.domain, cookie.path, cookie.name, cookie.value, cookie.version, cookie.port,
+            cookie.port_specified, cookie.domain_specified, cookie.domain_initial_dot, cookie.path_specified,
+            cookie.secure, cookie.expires, cookie.discard, cookie.comment, cookie.comment_url, json_dumps(rest),
+            updated,
+        )
+
+    @staticmethod
+    def _to_cookie(row):
+        (domain, path, name, value, version, port, port_specified, domain_specified, domain_initial_dot,
+         path_specified, secure, expires, discard, comment, comment_url, rest) = row[:16]
+        return Cookie(
+            version=version,
+            name=name,
+            value=value,
+            port=port,
+            port_specified=bool(port_specified),
+            domain=domain,
+            domain_specified=bool(domain_specified),
+            domain_initial_dot=bool(domain_initial_dot),
+            path=path,
+            path_specified=bool(path_specified),
+            secure=bool(secure),
+            expires=expires,
+            discard=bool(discard),
+            comment=comment,
+            comment_url=comment_url,
+            rest=json_loads(rest) if rest else {},
+        )
@@ -0,0 +1,474 @@
+"""
+Recursive crawling of a site section.
+
+    frontier = Frontier('crawl.sqlite')
+    crawler = Crawler(frontier, scope=CrawlScope(max_depth=3, allow_patterns=(r'/gallery/',)), on_page=save_page)
+    crawler.crawl(['http://example.com/gallery/'])
+
+Urls wait in the frontier, a SQLite table ordered by priority, depth by default. The frontier survives restarts:
+crawling again with the same file continues the pending urls, and urls seen before are never added again.
+Pages are fetched by connectors from connector_factory, one per worker thread, so JavaScript-heavy sites
+can be crawled with phantomjs_factory. Between the requests to a host, the crawler waits delay seconds,
+or the Crawl-delay of robots.txt if longer.
+"""
+from __future__ import absolute_import
+
+import hashlib
+import sqlite3
+
+from math import (
+    ceil,
+    log,
+)
+from logging import getLogger
+from os import makedirs
+from os.path import (
+    abspath as path_abspath,
+    dirname as path_dirname,
+    exists as path_exists,
+)
+from re import search as re_search
+from threading import (
+    Condition,
+    Lock,
+    Thread,
+)
+from time import time
+
+# noinspection PyUnresolvedReferences
+from six.moves.urllib.parse import urlparse
+# noinspection PyUnresolvedReferences
+from six.moves.urllib.robotparser import RobotFileParser
+
+from .connectors import RequestsConnector
+from .links import iter_links
+from .ratelimit import HostRateLimiter
+from .sessions import get_default_session
+from .workers import (
+    HostLimiter,
+    get_host,
+)
+
+logger = getLogger(__name__)
+
+PENDING = 'pending'
+ACTIVE = 'active'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class BloomFilter(object):
+    """
+    Set of strings in a fixed-size bit array. Membership tests may give false positives at error_rate,
+    but never false negatives.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        """
+        :param capacity:   expected number of items
+        :param error_rate: false positive probability at capacity
+        """
+        self.size = int(ceil(-capacity * log(error_rate) / (log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / float(capacity) * log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.sha256(item.encode('utf-8')).hexdigest()
+        h1, h2 = int(digest[:16], 16), int(digest[16:32], 16)
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        """
+        :return: True if item was not in the filter
+        """
+        added = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        return added
+
+    def __contains__(self, item):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+
+class Frontier(object):
+    """
+    Persistent priority queue of urls to crawl, with a seen-set.
+
+    Urls are kept in a SQLite table with their states: pending, active, done, failed, or skipped.
+    Active urls of an interrupted crawl are pending again when the frontier is opened.
+    The seen-set is an in-memory set, or a BloomFilter for large crawls, rebuilt from the table.
+    A false positive of the BloomFilter drops a url that was never seen.
+    """
+
+    def __init__(self, path, bloom_capacity=0, bloom_error_rate=0.001):
+        """
+        :param path:             database file path
+        :param bloom_capacity:   expected number of urls to use a BloomFilter. 0 means a set
+        :param bloom_error_rate: see BloomFilter
+        """
+        self.path = path
+
+        directory = path_dirname(path_abspath(path))
+        if not path_exists(directory):
+            makedirs(directory)
+
+        if bloom_capacity:
+            self.seen = BloomFilter(bloom_capacity, bloom_error_rate)
+        else:
+            self.seen = set()
+
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS urls ('
+                ' seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' url TEXT UNIQUE,'
+                ' depth INTEGER,'
+                ' priority REAL,'
+                ' parent TEXT,'
+                ' state TEXT,'
+                ' error TEXT,'
+                ' updated REAL'
+                ')'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS urls_queue ON urls (state, priority, seq)')
+            self._db.execute('UPDATE urls SET state = ? WHERE state = ?', (PENDING, ACTIVE))
+
+        for row in self._db.execute('SELECT url FROM urls'):
+            self.seen.add(row[0])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @property
+    def counts(self):
+        """
+        :return: {state: number of urls}
+        """
+        with self._lock:
+            return dict(self._db.execute('SELECT state, COUNT(*) FROM urls GROUP BY state').fetchall())
+
+    def add(self, url, depth=0, priority=None, parent=None):
+        """
+        :param url:      url to crawl
+        :param depth:    number of links from a seed url
+        :param priority: lower is crawled first. depth if None
+        :param parent:   url of the page linking url
+        :return:         True if url is added, False if seen before
+        """
+        with self._lock:
+            if url in self.seen:
+                return False
+            self.seen.add(url)
+            with self._db:
+                self._db.execute(
+                    'INSERT OR IGNORE INTO urls (url, depth, priority, parent, state, updated)'
+                    ' VALUES (?, ?, ?, ?, ?, ?)',
+                    (url, depth, depth if priority is None else priority, parent, PENDING, time())
+                )
+        return True
+
+    def pop(self):
+        """
+        take the pending url of the highest priority, and mark it active.
+        :return: (url, depth), or None if no url is pending
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT url, depth FROM urls WHERE state = ? ORDER BY priority, seq LIMIT 1', (PENDING,)
+            ).fetchone()
+            if row:
+                with self._db:
+                    self._db.execute('UPDATE urls SET state = ?, updated = ? WHERE url = ?', (ACTIVE, time(), row[0]))
+        return row
+
+    def complete(self, url, state=DONE, error=None):
+        """
+        :param url:   url taken by pop()
+        :param state: DONE, FAILED, or SKIPPED
+        :param error: error message of a failed url
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'UPDATE urls SET state = ?, error = ?, updated = ? WHERE url = ?', (state, error, time(), url)
+                )
+
+    def get_seeds(self):
+        """
+        :return: list of urls added at depth 0, to find the scope of a resumed crawl
+        """
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT url FROM urls WHERE depth = 0 ORDER BY seq')]
+
+    def get_urls(self, state):
+        """
+        :return: list of (url, error) in the state
+        """
+        with self._lock:
+            return self._db.execute('SELECT url, error FROM urls WHERE state = ? ORDER BY seq', (state,)).fetchall()
+
+
+class RobotsCache(object):
+    """
+    robots.txt rules per host, fetched when a host is first checked.
+    A missing robots.txt allows everything, and 401 or 403 disallows everything.
+    """
+
+    def __init__(self, user_agent='*', session=None, timeout=10):
+        """
+        :param user_agent: user agent name to match the rules
+        :param session:    requests Session. The shared default session is used if omitted
+        :param timeout:    seconds to wait for robots.txt
+        """
+        self.user_agent = user_agent
+        self.session = session
+        self.timeout = timeout
+        self._parsers = {}
+        self._lock = Lock()
+
+    def get_parser(self, url):
+        parsed = urlparse(url)
+        key = '%s://%s' % (parsed.scheme, parsed.netloc.lower())
+        with self._lock:
+            parser = self._parsers.get(key)
+        if parser is None:
+            parser = self._fetch(key + '/robots.txt')
+            with self._lock:
+                parser = self._parsers.setdefault(key, parser)
+        return parser
+
+    def _fetch(self, robots_url):
+        parser = RobotFileParser(robots_url)
+        try:
+            response = (self.session or get_default_session()).get(robots_url, timeout=self.timeout)
+        except Exception:
+            logger.warning('robots.txt not fetched, allowing all: %s', robots_url, exc_info=True)
+            parser.allow_all = True
+            return parser
+        if response.status_code in (401, 403):
+            parser.disallow_all = True
+        elif response.status_code >= 400:
+            parser.allow_all = True
+        else:
+            parser.parse(response.text.splitlines())
+        return parser
+
+    def is_allowed(self, url):
+        return self.get_parser(url).can_fetch(self.user_agent, url)
+
+    def get_crawl_delay(self, url):
+        """
+        :return: Crawl-delay seconds of the host, or None
+        """
+        parser = self.get_parser(url)
+        # python 3.6+
+        crawl_delay = getattr(parser, 'crawl_delay', None)
+        return crawl_delay(self.user_agent) if crawl_delay else None
+
+
+class CrawlScope(object):
+    """
+    Rules of the urls to crawl.
+    """
+
+    def __init__(self, max_depth=2, allow_hosts=None, allow_patterns=(), deny_patterns=()):
+        """
+        :param max_depth:      maximum number of links from a seed url
+        :param allow_hosts:    hosts to crawl, with their subdomains. A host without a port allows any port.
+                               Crawler uses the hosts of the seeds if None
+        :param allow_patterns: regular expressions. If given, urls must match one of them
+        :param deny_patterns:  regular expressions of urls not to crawl
+        """
+        self.max_depth = max_depth
+        self.allow_hosts = None if allow_hosts is None else tuple(h.lower() for h in allow_hosts)
+        self.allow_patterns = tuple(allow_patterns)
+        self.deny_patterns = tuple(deny_patterns)
+
+    def is_allowed(self, url, depth):
+        if depth > self.max_depth or not url.startswith(('http://', 'https://')):
+            return False
+        if self.allow_hosts is not None:
+            host = get_host(url)
+            hostname = host.split(':')[0]
+            if not any(n == h or n.endswith('.' + h) for h in self.allow_hosts for n in (host, hostname)):
+                return False
+        if self.allow_patterns and not any(re_search(p, url) for p in self.allow_patterns):
+            return False
+        return not any(re_search(p, url) for p in self.deny_patterns)
+
+
+def default_connector_factory():
+    # the crawler waits between requests, not the connector
+    return RequestsConnector(None, 0)
+
+
+class Crawler(object):
+    """
+    Crawls pages on worker threads, following the links in scope.
+    """
+
+    def __init__(self, frontier, connector_factory=default_connector_factory, scope=None, workers=4, delay=1,
+                 per_host=1, robots=True, user_agent='*', on_page=None, follow_kinds=('a',), priority=None,
+                 max_pages=0, rate_limiter=None):
+        """
+        :param frontier:          Frontier
+        :param connector_factory: callable creating a connector for each worker, e.g. phantomjs_factory.
+                                  Its delay should be 0, since the crawler waits delay seconds itself
+        :param scope:             CrawlScope. Depth 2 within the hosts of the seeds if None, including the seeds
+                                  of a resumed frontier
+        :param workers:           number of threads
+        :param delay:             seconds between requests to the same host
+        :param per_host:          maximum concurrent requests per host. 0 means no cap
+        :param robots:            obey robots.txt. A RobotsCache may be given instead of True
+        :param user_agent:        user agent name for robots.txt
+        :param on_page:           callable taking (url, content, depth) of each crawled page
+        :param follow_kinds:      kinds of links to follow. See links.LinkExtractor
+        :param priority:          callable taking (url, depth), returning the priority. Lower is crawled first
+        :param max_pages:         number of pages to crawl in a crawl() call. 0 means no limit
+        :param rate_limiter:      HostRateLimiter of the crawler. A new one is used if omitted
+        """
+        self.frontier = frontier
+        self.connector_factory = connector_factory
+        self.scope = scope
+        self.workers = workers
+        self.delay = delay
+        self.host_limiter = HostLimiter(per_host)
+        self.rate_limiter = rate_limiter or HostRateLimiter()
+        if robots is True:
+            robots = RobotsCache(user_agent)
+        self.robots = robots or None
+        self.on_page = on_page
+        self.follow_kinds = follow_kinds
+        self.priority = priority
+        self.max_pages = max_pages
+
+        self.pages = 0
+        self._active = 0
+        self._stopped = False
+        self._condition = Condition(Lock())
+
+    def add(self, url, depth=0, parent=None):
+        """
+        add url to the frontier if it is in scope.
+        :return: True if added
+        """
+        if not self.scope.is_allowed(url, depth):
+            return False
+        priority = self.priority(url, depth) if self.priority else None
+        if not self.frontier.add(url, depth, priority, parent):
+            return False
+        with self._condition:
+            self._condition.notify()
+        return True
+
+    def stop(self):
+        """
+        stop taking urls. Pages being fetched are completed.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def crawl(self, seeds=()):
+        """
+        crawl from seeds, and the pending urls of the frontier.
+        :param seeds: urls of depth 0. Urls seen before are not crawled again
+        :return:      frontier counts: {state: number of urls}
+        """
+        seeds = list(seeds)
+        if self.scope is None:
+            hosts = set(get_host(url) for url in seeds + self.frontier.get_seeds())
+            if not hosts:
+                raise ValueError('No seeds to find the scope from. Give seeds or a scope')
+            self.scope = CrawlScope(allow_hosts=hosts)
+
+        self.pages = 0
+        self._stopped = False
+        for url in seeds:
+            self.add(url)
+
+        threads = [Thread(target=self._work) for _ in range(max(1, self.workers))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        return self.frontier.counts
+
+    def _next(self):
+        with self._condition:
+            while True:
+                if self._stopped or (self.max_pages and self.pages >= self.max_pages):
+                    return None
+                item = self.frontier.pop()
+                if item:
+                    self._active += 1
+                    self.pages += 1
+                    return item
+                if not self._active:
+                    # nothing pending, and no page can add more
+                    self._condition.notify_all()
+                    return None
+                self._condition.wait()
+
+    def _work(self):
+        connector = self.connector_factory()
+        try:
+            while True:
+                item = self._next()
+                if item is None:
+                    break
+                url, depth = item
+                state, error = DONE, None
+                try:
+                    if not self._visit(connector, url, depth):
+                        state = SKIPPED
+                except Exception as e:
+                    state, error = FAILED, repr(e)
+                finally:
+                    self.frontier.complete(url, state, error)
+                    with self._condition:
+                        self._active -= 1
+                        self._condition.notify_all()
+        finally:
+            connector.disconnect()
+
+    def _visit(self, connector, url, depth):
+        """
+        :return: False if robots.txt disallows url
+        """
+        delay = self.delay
+        if self.robots:
+            if not self.robots.is_allowed(url):
+                return False
+            delay = max(delay, self.robots.get_crawl_delay(url) or 0)
+
+        host = get_host(url)
+        self.host_limiter.acquire(host)
+        try:
+            self.rate_limiter.wait(host, delay)
+            content = connector.get(url)
+        finally:
+            self.host_limiter.release(host)
+
+        # status code and the url after redirects, if the connector keeps the response
+        response = getattr(connector, 'last_response', None)
+        if response is not None:
+            response.raise_for_status()
+
+        if self.on_page:
+            self.on_page(url, content, depth)
+
+        if depth < self.scope.max_depth:
+            base_url = getattr(response, 'url', None) or url
+            for link in iter_links([content], base_url, self.follow_kinds):
+                self.add(link, depth + 1, url)
+        return True
@@ -0,0 +1,187 @@
+from __future__ import absolute_import
+
+from re import (
+    DOTALL,
+    IGNORECASE,
+    compile as re_compile,
+    search as re_search,
+    sub as re_sub,
+)
+from threading import Lock
+
+from .connectors import (
+    BaseConnector,
+    ConnectorMixin,
+    phantomjs_factory,
+)
+from .ratelimit import monotonic
+from .workers import get_host
+
+REQUESTS = 'requests'
+BROWSER = 'browser'
+
+
+class BrowserDetector(object):
+    """
+    Tells whether a page fetched over plain HTTP needs a browser to render.
+
+    A page needs a browser if its visible text is shorter than min_text_length, if it misses one of
+    required_patterns, or if it matches one of js_markers. Responses other than HTML never need a browser.
+    """
+
+    js_markers = (
+        r'<noscript[^>]*>[^<]*(enable|turn on|requires?)\s+javascript',
+        r'<div[^>]+id=["\'](root|app)["\'][^>]*>\s*</div>',
+    )
+
+    script_expr = re_compile(r'<(script|style|noscript)\b.*?</\1\s*>', DOTALL | IGNORECASE)
+    tag_expr = re_compile(r'<[^>]+>')
+
+    def __init__(self, min_text_length=64, required_patterns=(), js_markers=None):
+        """
+        :param min_text_length:   minimum length of the visible text, without whitespaces
+        :param required_patterns: regular expressions the rendered page must match, e.g. r'class="gallery"'
+        :param js_markers:        regular expressions of pages rendered by scripts. js_markers if None
+        """
+        self.min_text_length = min_text_length
+        self.required_patterns = tuple(required_patterns)
+        if js_markers is not None:
+            self.js_markers = tuple(js_markers)
+
+    def get_text_length(self, content):
+        text = self.tag_expr.sub('', self.script_expr.sub('', content))
+        return len(re_sub(r'\s+', '', text))
+
+    def __call__(self, url, content, response=None):
+        """
+        :param url:      requested url
+        :param content:  page text fetched over plain HTTP
+        :param response: requests' Response object, if available
+        :return:         True if the page needs a browser
+        """
+        if response is not None:
+            content_type = response.headers.get('content-type', '')
+            if content_type and 'html' not in content_type.lower():
+                return False
+        if any(not re_search(p, content, IGNORECASE) for p in self.required_patterns):
+            return True
+        if any(re_search(p, content, IGNORECASE) for p in self.js_markers):
+            return True
+        return self.get_text_length(content) < self.min_text_length
+
+
+class HybridConnector(BaseConnector):
+    """
+    Fetches pages by plain HTTP, and by a browser only when the detector says the page needs one.
+
+        connector = HybridConnector(RequestsConnector('cookie.txt'), browser_kwargs={'service_log_path': os.devnull})
+        connector.get('http://example.com/')
+
+    Once a page of a host needs a browser, later pages of the host go straight to the browser, until the decision
+    expires after engine_ttl seconds and the host is probed by plain HTTP again. Only 2xx responses are examined:
+    error pages say nothing about how the host renders. The browser is created on first use.
+    A ConnectorPool may be given as the browser.
+    POST requests always use the requests connector. Cookies are not shared between the two engines.
+    """
+
+    def __init__(self, requests_connector, browser=None, browser_factory=phantomjs_factory, browser_kwargs=None,
+                 detector=None, engines=None, engine_ttl=3600):
+        """
+        :param requests_connector: RequestsConnector for plain HTTP
+        :param browser:            connector or ConnectorPool rendering pages. Created by browser_factory if None
+        :param browser_factory:    callable creating the browser connector
+        :param browser_kwargs:     keyword arguments for browser_factory
+        :param detector:           callable taking (url, content, response), returning True if the page needs
+                                   a browser. BrowserDetector() if None
+        :param engines:            dict of {host: (REQUESTS or BROWSER, decision time)}, to share with other connectors
+        :param engine_ttl:         seconds before a decision is probed again. 0 means never
+        """
+        super(HybridConnector, self).__init__(delay=0)
+
+        self.requests_connector = requests_connector
+        self.browser_factory = browser_factory
+        self.browser_kwargs = browser_kwargs or {}
+        self.detector = detector or BrowserDetector()
+        self.engines = {} if engines is None else engines
+        self.engine_ttl = engine_ttl
+        self.last_engine = None
+        self.stats = {REQUESTS: 0, BROWSER: 0, 'escalated': 0}
+
+        self._browser = browser
+        self._lock = Lock()
+        self._stats_lock = Lock()
+
+    @property
+    def browser(self):
+        with self._lock:
+            if self._browser is None:
+                self._browser = self.browser_factory(**self.browser_kwargs)
+            return self._browser
+
+    @property
+    def last_response(self):
+        """
+        the response of the requests connector, if the last page is fetched by it
+        """
+        if self.last_engine == REQUESTS:
+            return self.requests_connector.last_response
+        return None
+
+    def get_engine(self, url):
+        """
+        :return: REQUESTS or BROWSER decided for the url's host, or None if not decided yet
+        """
+        decision = self.engines.get(get_host(url))
+        if decision is None:
+            return None
+        engine, decided = decision
+        if self.engine_ttl and monotonic() - decided > self.engine_ttl:
+            return None
+        return engine
+
+    def set_engine(self, url, engine):
+        """
+        decide the engine of url's host
+        """
+        with self._stats_lock:
+            self.engines[get_host(url)] = (engine, monotonic())
+
+    def disconnect(self):
+        self.requests_connector.disconnect()
+        with self._lock:
+            browser, self._browser = self._browser, None
+        if browser is not None:
+            if hasattr(browser, 'close'):
+                # ConnectorPool
+                browser.close()
+            else:
+                browser.disconnect()
+
+    def get(self, url, params=None, headers=None):
+        engine = self.get_engine(url)
+
+        if engine != BROWSER:
+            content = self.requests_connector.get(url, params=params, headers=headers)
+            response = self.requests_connector.last_response
+            if response is not None and not 200 <= response.status_code < 300:
+                return self._done(REQUESTS, content)
+            if not self.detector(url, content, response):
+                if engine is None:
+                    self.set_engine(url, REQUESTS)
+                return self._done(REQUESTS, content)
+            self.set_engine(url, BROWSER)
+            with self._stats_lock:
+                self.stats['escalated'] += 1
+
+        # browsers ignore params
+        return self._done(BROWSER, self.browser.get(ConnectorMixin.create_get_url(url, dict(params or {}))))
+
+    def post(self, url, data=None, headers=None):
+        return self._done(REQUESTS, self.requests_connector.post(url, data=data, headers=headers))
+
+    def _done(self, engine, content):
+        self.last_engine = engine
+        with self._stats_lock:
+            self.stats[engine] += 1
+        self.last_content = content
+        return content
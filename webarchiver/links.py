@@ -0,0 +1,229 @@
+"""
+Extraction of image, link and stylesheet urls from fetched pages.
+
+    connector.get(listing_url)
+    urls = extract_links(connector.last_content, listing_url, kinds=('img', 'srcset'))
+
+    # or in one step
+    archive_page(connector, listing_url, download_path, title, kinds=('img',), pattern=r'/uploads/')
+
+Pages are read by an incremental HTMLParser, so no document tree is built, and stream_links() finds urls
+while the response body is still arriving.
+"""
+from __future__ import absolute_import
+
+from re import (
+    IGNORECASE,
+    compile as re_compile,
+    search as re_search,
+)
+
+# noinspection PyUnresolvedReferences
+from six.moves.html_parser import HTMLParser
+# noinspection PyUnresolvedReferences
+from six.moves.urllib.parse import (
+    urldefrag,
+    urljoin,
+)
+
+from .sessions import get_default_session
+
+css_url_expr = re_compile(r'url\(\s*([\'"]?)(.*?)\1\s*\)', IGNORECASE)
+
+ignored_schemes = ('data:', 'javascript:', 'mailto:', 'tel:', 'about:')
+
+
+def parse_srcset(srcset):
+    """
+    :param srcset: srcset attribute, e.g. 'a.jpg 1x, b.jpg 2x'
+    :return:       list of candidate urls
+    """
+    urls = []
+    for candidate in srcset.split(','):
+        parts = candidate.strip().split()
+        if parts:
+            urls.append(parts[0])
+    return urls
+
+
+class LinkExtractor(HTMLParser):
+    """
+    Incremental parser collecting urls of a page, resolved against the page url and without duplicates.
+
+        extractor = LinkExtractor(page_url, kinds=('img', 'css'))
+        for chunk in chunks:
+            for url in extractor.feed(chunk):
+                ...
+        remaining = extractor.close()
+
+    A <base href> in the page changes the url to resolve against. Fragments are removed.
+    """
+
+    kinds = {
+        'img': 'src and data-src of <img>, <source>, <input type="image"> and <video poster>',
+        'srcset': 'srcset of <img> and <source>',
+        'a': 'href of <a> and <area>',
+        'css': 'href of <link rel="stylesheet">, and url() in style attributes and <style> elements',
+    }
+
+    def __init__(self, page_url, kinds=('img', 'srcset'), pattern=None):
+        """
+        :param page_url: url of the page
+        :param kinds:    keys of LinkExtractor.kinds to collect
+        :param pattern:  regular expression. Only urls matching it are collected
+        """
+        HTMLParser.__init__(self)
+
+        for kind in kinds:
+            if kind not in self.kinds:
+                raise ValueError('Unknown link kind: %s' % kind)
+
+        self.base_url = page_url
+        self.collect = frozenset(kinds)
+        self.pattern = pattern
+        self.seen = set()
+        self._found = []
+        self._in_style = False
+
+    def feed(self, data):
+        """
+        :param data: next part of the page
+        :return:     list of urls found in data, in document order
+        """
+        HTMLParser.feed(self, data)
+        return self._pop()
+
+    def close(self):
+        """
+        :return: list of urls found in the rest of the page
+        """
+        HTMLParser.close(self)
+        return self._pop()
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+
+        if tag == 'base' and attrs.get('href'):
+            self.base_url = urljoin(self.base_url, attrs['href'])
+        elif tag == 'style':
+            self._in_style = True
+
+        if 'img' in self.collect:
+            if tag in ('img', 'source'):
+                self._add(attrs.get('src'))
+                self._add(attrs.get('data-src'))
+            elif tag == 'input' and (attrs.get('type') or '').lower() == 'image':
+                self._add(attrs.get('src'))
+            elif tag == 'video':
+                self._add(attrs.get('poster'))
+
+        if 'srcset' in self.collect and tag in ('img', 'source') and attrs.get('srcset'):
+            for url in parse_srcset(attrs['srcset']):
+                self._add(url)
+
+        if 'a' in self.collect and tag in ('a', 'area'):
+            self._add(attrs.get('href'))
+
+        if 'css' in self.collect:
+            if tag == 'link' and 'stylesheet' in (attrs.get('rel') or '').lower().split():
+                self._add(attrs.get('href'))
+            if attrs.get('style'):
+                self._add_css(attrs['style'])
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag == 'style':
+            self._in_style = False
+
+    def handle_endtag(self, tag):
+        if tag == 'style':
+            self._in_style = False
+
+    def handle_data(self, data):
+        if self._in_style and 'css' in self.collect:
+            self._add_css(data)
+
+    def _add_css(self, css):
+        for match in css_url_expr.finditer(css):
+            self._add(match.group(2))
+
+    def _add(self, url):
+        if not url:
+            return
+        url = url.strip()
+        if not url or url.startswith('#') or url.lower().startswith(ignored_schemes):
+            return
+        url = urldefrag(urljoin(self.base_url, url))[0]
+        if url in self.seen:
+            return
+        self.seen.add(url)
+        if self.pattern and not re_search(self.pattern, url):
+            return
+        self._found.append(url)
+
+    def _pop(self):
+        found, self._found = self._found, []
+        return found
+
+
+def iter_links(chunks, page_url, kinds=('img', 'srcset'), pattern=None):
+    """
+    yield urls of a page given in parts, as soon as they are found.
+    :param chunks:   iterable of the page's text parts
+    :param page_url: see LinkExtractor
+    :param kinds:    see LinkExtractor
+    :param pattern:  see LinkExtractor
+    """
+    extractor = LinkExtractor(page_url, kinds, pattern)
+    for chunk in chunks:
+        for url in extractor.feed(chunk):
+            yield url
+    for url in extractor.close():
+        yield url
+
+
+def extract_links(content, page_url, kinds=('img', 'srcset'), pattern=None):
+    """
+    :param content:  page text, e.g. connector.last_content
+    :return:         list of urls in document order. See LinkExtractor for the other parameters
+    """
+    return list(iter_links([content], page_url, kinds, pattern))
+
+
+def stream_links(url, kinds=('img', 'srcset'), pattern=None, session=None, chunk_size=65536, **kwargs):
+    """
+    yield urls of a page while it is downloaded.
+    :param url:        page url
+    :param session:    requests Session. The shared default session is used if omitted
+    :param chunk_size: bytes to read at once
+    :param kwargs:     any keywords for Request object
+    """
+    kwargs['stream'] = True
+    response = (session or get_default_session()).get(url, **kwargs)
+    try:
+        response.raise_for_status()
+        if not response.encoding:
+            response.encoding = 'utf-8'
+        for link in iter_links(response.iter_content(chunk_size, decode_unicode=True), response.url, kinds, pattern):
+            yield link
+    finally:
+        response.close()
+
+
+def archive_page(connector, page_url, download_path, title, kinds=('img', 'srcset'), pattern=None, **kwargs):
+    """
+    fetch a page by a connector, and archive the urls found in it by archive_remote_urls().
+    :param connector: RequestsConnector, PhantomJSConnector, or any connector whose get() returns the page
+    :param page_url:  page url
+    :param kwargs:    keywords for archive_remote_urls(). See LinkExtractor for the other parameters
+    :return:          a list of (url, exception) for failed downloads with strict=False, from archive_remote_urls()
+    """
+    from . import archive_remote_urls
+
+    content = connector.get(page_url)
+    # the url after redirects, if the connector keeps the response
+    last_response = getattr(connector, 'last_response', None)
+    base_url = getattr(last_response, 'url', None) or page_url
+
+    urls = extract_links(content, base_url, kinds, pattern)
+    return archive_remote_urls(download_path, title, urls, **kwargs)
@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+
+from io import open
+from json import (
+    dumps as json_dumps,
+    load as json_load,
+)
+from os import unlink
+
+from os.path import (
+    basename as path_basename,
+    exists as path_exists,
+    getsize as path_getsize,
+    join as path_join,
+)
+
+from threading import RLock
+
+try:
+    from os import replace as file_replace
+except ImportError:
+    # python 2: rename() replaces the destination atomically on POSIX
+    from os import rename as file_replace
+
+
+class DownloadManifest(object):
+    """
+    Records downloads of a directory in <directory>/.manifest.json, to resume them later.
+
+    Each file name in the directory maps to its url, ETag, size, and completion:
+        {"01.png": {"url": "http://...", "etag": "\"abc\"", "size": 1024, "complete": true}}
+    """
+
+    file_name = '.manifest.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = path_join(directory, self.file_name)
+        self._lock = RLock()
+        self._entries = {}
+        self.load()
+
+    @classmethod
+    def is_manifest_file(cls, name):
+        return path_basename(name) == cls.file_name
+
+    def load(self):
+        with self._lock:
+            self._entries = {}
+            if path_exists(self.path):
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        self._entries = json_load(f)
+                except ValueError:
+                    # broken manifest: everything is downloaded again
+                    pass
+
+    def save(self):
+        with self._lock:
+            temp_path = self.path + '.part'
+            with open(temp_path, 'wb') as f:
+                f.write(json_dumps(self._entries, indent=1, sort_keys=True).encode('utf-8'))
+            file_replace(temp_path, self.path)
+
+    def remove(self):
+        with self._lock:
+            self._entries = {}
+            if path_exists(self.path):
+                unlink(self.path)
+
+    def get(self, path):
+        with self._lock:
+            return self._entries.get(path_basename(path))
+
+    def is_complete(self, url, path):
+        """
+        True if url is completely downloaded as path, and the file is intact.
+        """
+        entry = self.get(path)
+        return bool(
+            entry and
+            entry.get('complete') and
+            entry.get('url') == url and
+            path_exists(path) and
+            path_getsize(path) == entry.get('size')
+        )
+
+    def get_etag(self, url, path):
+        """
+        return the ETag recorded when the download of url into path started, or None
+        """
+        entry = self.get(path)
+        if entry and entry.get('url') == url:
+            return entry.get('etag')
+
+    def start(self, url, path, etag=None):
+        self._set(path, url=url, etag=etag, size=None, complete=False)
+
+    def complete(self, url, path, size, etag=None):
+        self._set(path, url=url, etag=etag, size=size, complete=True)
+
+    def _set(self, path, **entry):
+        with self._lock:
+            self._entries[path_basename(path)] = entry
+            self.save()
+
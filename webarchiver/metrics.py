@@ -0,0 +1,198 @@
+"""
+Instrumentation of requests, downloads and page renders.
+
+RequestsConnector, PhantomJSConnector and url_download take a 'metrics' callable. It is called with an event dict
+after each HTTP exchange or page render:
+
+    type:        'request' (RequestsConnector), 'download' (url_download), or 'render' (PhantomJSConnector)
+    url, host:   requested url and its host
+    method:      HTTP method. 'GET' for renders
+    status_code: response status code. None for renders and failed requests
+    bytes:       response body bytes, or page source length for renders
+    delay:       seconds waited by the rate limiter before sending
+    ttfb:        seconds from sending the request to receiving the response headers
+    transfer:    seconds to read the response body
+    render:      seconds to load the page and to satisfy the wait condition. Renders only
+    total:       seconds of the whole exchange, excluding delay
+    error:       repr() of the exception, or None
+
+Timings missing for an event are None. DNS lookup and connection times are not reported separately,
+because requests does not expose them; they are included in ttfb.
+
+    aggregator = MetricsAggregator()
+    connector = RequestsConnector(cookie_file, metrics=MetricsHooks(aggregator, print))
+    ...
+    aggregator.percentile('request', 'ttfb', 95)
+    aggregator.slowest_hosts('request', 'total', 90)
+"""
+from __future__ import absolute_import
+
+from collections import (
+    defaultdict,
+    deque,
+)
+from logging import getLogger
+from math import ceil
+from threading import Lock
+
+from .ratelimit import monotonic
+from .workers import get_host
+
+timer = monotonic
+
+logger = getLogger(__name__)
+
+
+def create_event(event_type, url, method='GET', **values):
+    """
+    :return: event dict with every key, None for missing values
+    """
+    event = {
+        'type': event_type,
+        'url': url,
+        'host': get_host(url),
+        'method': method,
+        'status_code': None,
+        'bytes': 0,
+        'delay': None,
+        'ttfb': None,
+        'transfer': None,
+        'render': None,
+        'total': None,
+        'error': None,
+    }
+    event.update(values)
+    return event
+
+
+def emit(metrics, event):
+    """
+    call the metrics callable with event. Errors of the callable never break the instrumented call.
+    """
+    if metrics is None:
+        return
+    try:
+        metrics(event)
+    except Exception:
+        logger.exception('metrics callable failed on %s event of %s', event.get('type'), event.get('url'))
+
+
+class MetricsHooks(object):
+    """
+    Calls several metrics callables, in order.
+    """
+
+    def __init__(self, *callbacks):
+        self.callbacks = list(callbacks)
+        self._lock = Lock()
+
+    def add(self, callback):
+        with self._lock:
+            self.callbacks = self.callbacks + [callback]
+
+    def remove(self, callback):
+        with self._lock:
+            self.callbacks = [c for c in self.callbacks if c is not callback]
+
+    def __call__(self, event):
+        for callback in self.callbacks:
+            emit(callback, event)
+
+
+class MetricsAggregator(object):
+    """
+    Thread-safe metrics callable keeping counters and the recent timings, per event type and per host.
+    Percentiles are computed over the last max_samples timings.
+    """
+
+    timings = ('delay', 'ttfb', 'transfer', 'render', 'total')
+
+    def __init__(self, max_samples=1000):
+        """
+        :param max_samples: number of recent timings to keep per event type, host and timing
+        """
+        self.max_samples = max_samples
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (type, host) -> counters. host None is the total of the type
+            self._counters = defaultdict(lambda: {'count': 0, 'errors': 0, 'bytes': 0, 'status': {}})
+            # (type, host, timing) -> recent seconds
+            self._samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+
+    def __call__(self, event):
+        with self._lock:
+            for host in (None, event['host']):
+                counters = self._counters[(event['type'], host)]
+                counters['count'] += 1
+                counters['bytes'] += event['bytes'] or 0
+                if event['error']:
+                    counters['errors'] += 1
+                if event['status_code'] is not None:
+                    status = counters['status']
+                    status[event['status_code']] = status.get(event['status_code'], 0) + 1
+                for timing in self.timings:
+                    if event.get(timing) is not None:
+                        self._samples[(event['type'], host, timing)].append(event[timing])
+
+    @property
+    def hosts(self):
+        with self._lock:
+            return sorted(set(host for _, host in self._counters if host is not None))
+
+    def get_counters(self, event_type, host=None):
+        """
+        :return: dict of count, errors, bytes, and status: {status_code: count}
+        """
+        with self._lock:
+            counters = self._counters.get((event_type, host))
+            if not counters:
+                return {'count': 0, 'errors': 0, 'bytes': 0, 'status': {}}
+            return dict(counters, status=dict(counters['status']))
+
+    def percentile(self, event_type, timing, p, host=None):
+        """
+        :param event_type: 'request', 'download', or 'render'
+        :param timing:     one of timings
+        :param p:          percentile, 0 to 100
+        :param host:       host name. All hosts if None
+        :return:           seconds by the nearest-rank method, or None without samples
+        """
+        with self._lock:
+            samples = sorted(self._samples.get((event_type, host, timing), ()))
+        if not samples:
+            return None
+        rank = int(ceil(p / 100.0 * len(samples))) - 1
+        return samples[min(max(rank, 0), len(samples) - 1)]
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+        :return: {event type: {host: {'count', 'errors', 'bytes', 'status', timing: {percentile: seconds}}}},
+                 where host '*' is the total of the event type
+        """
+        with self._lock:
+            keys = list(self._counters)
+
+        result = {}
+        for event_type, host in keys:
+            stats = self.get_counters(event_type, host)
+            for timing in self.timings:
+                values = dict((p, self.percentile(event_type, timing, p, host)) for p in percentiles)
+                if any(v is not None for v in values.values()):
+                    stats[timing] = values
+            result.setdefault(event_type, {})['*' if host is None else host] = stats
+        return result
+
+    def slowest_hosts(self, event_type='request', timing='total', p=90, n=10):
+        """
+        :return: list of (host, seconds) of the n hosts with the largest percentile p of timing, slowest first
+        """
+        ranking = []
+        for host in self.hosts:
+            value = self.percentile(event_type, timing, p, host)
+            if value is not None:
+                ranking.append((host, value))
+        ranking.sort(key=lambda item: item[1], reverse=True)
+        return ranking[:n]
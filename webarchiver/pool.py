@@ -0,0 +1,230 @@
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+from threading import (
+    Condition,
+    Event,
+    Lock,
+    Thread,
+)
+
+from .connectors import phantomjs_factory
+from .ratelimit import monotonic
+
+
+def is_driver_alive(connector):
+    """
+    default health check: the browser process of a PhantomJSConnector is still running.
+    """
+    driver = getattr(connector, 'driver', None)
+    if not getattr(connector, 'driver_open', False) or driver is None:
+        return False
+    process = getattr(getattr(driver, 'service', None), 'process', None)
+    return process is None or process.poll() is None
+
+
+class PoolClosed(Exception):
+    pass
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectorPool(object):
+    """
+    A pool of warm connectors, PhantomJSConnector by default, to save the browser startup time.
+
+        with ConnectorPool(max_size=4, service_log_path=os.devnull) as pool:
+            with pool.connector() as connector:
+                connector.get('http://example.com/')
+
+    A connector is recycled after max_uses pages, when it fails the health check,
+    or when it raised an exception inside pool.connector().
+    Connectors idle for more than max_idle seconds are disconnected at checkout, and by a reaper thread
+    every reap_interval seconds while the pool is quiet. close() stops the thread.
+    """
+
+    def __init__(self, factory=phantomjs_factory, max_size=4, max_idle=300, max_uses=100,
+                 health_check=is_driver_alive, reap_interval=60, **factory_kwargs):
+        """
+        :param factory:        callable creating a connector. factory_kwargs are passed to it
+        :param max_size:       maximum number of connectors, in use or idle
+        :param max_idle:       seconds before an idle connector is disconnected. 0 means forever
+        :param max_uses:       number of checkouts before a connector is recycled. 0 means no limit
+        :param health_check:   callable taking a connector, returning False if it must be recycled
+        :param reap_interval:  seconds between reaps by the reaper thread. 0 not to start the thread,
+                               leaving idle connectors until the next checkout() or reap()
+        :param factory_kwargs: keyword arguments for factory
+        """
+        self.factory = factory
+        self.factory_kwargs = factory_kwargs
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self.health_check = health_check
+
+        self._idle = []  # (connector, idle since), most recently used last
+        self._uses = {}  # id(connector) -> number of checkouts
+        self._size = 0
+        self._closed = False
+        self._condition = Condition(Lock())
+
+        self._stopped = Event()
+        self._reaper = None
+        if max_idle and reap_interval:
+            self._reaper = Thread(target=self._reap_forever, args=(reap_interval,))
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def checkout(self, timeout=None):
+        """
+        take a healthy connector from the pool, or create one.
+        :param timeout: seconds to wait for a connector when max_size connectors are in use. None means forever
+        :return:        connector
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        self.reap()
+
+        connector = None
+        unhealthy = []
+        try:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise PoolClosed()
+                    if self._idle:
+                        candidate, _ = self._idle.pop()
+                        if self._is_healthy(candidate):
+                            self._uses[id(candidate)] += 1
+                            connector = candidate
+                            break
+                        unhealthy.append(self._forget(candidate))
+                    elif self._size < self.max_size:
+                        # reserve a slot for a new connector
+                        self._size += 1
+                        break
+                    else:
+                        remaining = None if deadline is None else deadline - monotonic()
+                        if remaining is not None and remaining <= 0:
+                            raise PoolTimeout()
+                        self._condition.wait(remaining)
+        finally:
+            self._disconnect(unhealthy)
+
+        if connector is not None:
+            return connector
+
+        try:
+            connector = self.factory(**self.factory_kwargs)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._uses[id(connector)] = 1
+        return connector
+
+    def checkin(self, connector, broken=False):
+        """
+        return a connector to the pool.
+        :param connector: connector from checkout()
+        :param broken:    True to recycle the connector
+        """
+        discarded = []
+        with self._condition:
+            worn_out = self.max_uses and self._uses.get(id(connector), 0) >= self.max_uses
+            if broken or worn_out or self._closed or not self._is_healthy(connector):
+                discarded.append(self._forget(connector))
+            else:
+                self._idle.append((connector, monotonic()))
+            self._condition.notify()
+        self._disconnect(discarded)
+
+    @contextmanager
+    def connector(self, timeout=None):
+        connector = self.checkout(timeout)
+        try:
+            yield connector
+        except Exception:
+            self.checkin(connector, broken=True)
+            raise
+        self.checkin(connector)
+
+    def get(self, url, params=None, headers=None):
+        """
+        shortcut to get a page with a pooled connector.
+        """
+        with self.connector() as connector:
+            return connector.get(url, params=params, headers=headers)
+
+    def reap(self):
+        """
+        disconnect connectors idle for more than max_idle seconds.
+        :return: number of disconnected connectors
+        """
+        if not self.max_idle:
+            return 0
+        with self._condition:
+            expiry = monotonic() - self.max_idle
+            expired = [self._forget(c) for c, since in self._idle if since < expiry]
+            self._idle = [(c, since) for c, since in self._idle if since >= expiry]
+            if expired:
+                self._condition.notify_all()
+        self._disconnect(expired)
+        return len(expired)
+
+    def _reap_forever(self, interval):
+        while not self._stopped.wait(interval):
+            self.reap()
+
+    def close(self):
+        """
+        disconnect idle connectors, and stop the reaper thread. Connectors in use are disconnected when they are
+        checked in.
+        """
+        self._stopped.set()
+        with self._condition:
+            self._closed = True
+            idle = [self._forget(c) for c, _ in self._idle]
+            self._idle = []
+            self._condition.notify_all()
+        self._disconnect(idle)
+
+    def _is_healthy(self, connector):
+        if not self.health_check:
+            return True
+        try:
+            return self.health_check(connector)
+        except Exception:
+            return False
+
+    def _forget(self, connector):
+        self._size -= 1
+        self._uses.pop(id(connector), None)
+        return connector
+
+    @staticmethod
+    def _disconnect(connectors):
+        for connector in connectors:
+            try:
+                connector.disconnect()
+            except Exception:
+                # a crashed browser cannot be closed gracefully
+                pass
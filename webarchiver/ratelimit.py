@@ -0,0 +1,178 @@
+from __future__ import absolute_import
+
+import sqlite3
+
+from email.utils import (
+    mktime_tz,
+    parsedate_tz,
+)
+from threading import Lock
+from time import (
+    sleep,
+    time,
+)
+
+try:
+    from time import monotonic
+except ImportError:
+    # python 2
+    monotonic = time
+
+
+def parse_retry_after(value):
+    """
+    :param value: Retry-After header value: seconds or an HTTP-date
+    :return:      seconds to wait, or None if the value is invalid
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = parsedate_tz(value)
+    if parsed:
+        return max(0, mktime_tz(parsed) - time())
+    return None
+
+
+class HostRateLimiter(object):
+    """
+    Minimum-interval scheduler per host, shared across connectors and threads.
+
+    A request to a host waits only until the interval since the previous request to the same host has passed,
+    so requests to other hosts are never delayed. 429 and 503 responses block the host for Retry-After seconds.
+    """
+
+    def __init__(self, interval=0, throttled_wait=5):
+        """
+        :param interval:       default interval in seconds between requests to the same host
+        :param throttled_wait: seconds to block a host answering 429 without Retry-After
+        """
+        self.interval = interval
+        self.throttled_wait = throttled_wait
+        self._next = {}
+        self._lock = Lock()
+
+    def reserve(self, host, interval=None):
+        """
+        reserve a time slot for a request to host.
+        :param host:     host name
+        :param interval: interval for this request. Uses the default interval if None
+        :return:         seconds to wait before sending the request
+        """
+        if interval is None:
+            interval = self.interval
+        with self._lock:
+            now = monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + interval
+        return start - now
+
+    def wait(self, host, interval=None):
+        """
+        sleep until a request to host is allowed.
+        :return: slept seconds
+        """
+        delay = self.reserve(host, interval)
+        if delay > 0:
+            sleep(delay)
+        return max(0, delay)
+
+    def block(self, host, seconds):
+        """
+        hold requests to host for the next seconds
+        """
+        with self._lock:
+            until = monotonic() + seconds
+            self._next[host] = max(self._next.get(host, until), until)
+
+    def observe(self, host, status_code, headers):
+        """
+        block the host according to a throttling response.
+        :param host:        host name
+        :param status_code: response status code
+        :param headers:     response headers
+        :return:            True if the response is throttled: 429, or 503 with Retry-After
+        """
+        retry_after = parse_retry_after(headers.get('retry-after'))
+        if status_code == 429:
+            self.block(host, self.throttled_wait if retry_after is None else retry_after)
+            return True
+        if status_code == 503 and retry_after is not None:
+            self.block(host, retry_after)
+            return True
+        return False
+
+
+class SharedRateLimiter(HostRateLimiter):
+    """
+    HostRateLimiter keeping its schedule in a SQLite file, so that processes on one machine share the intervals
+    and the blocks of each host. Each process should open its own limiter.
+    """
+
+    def __init__(self, path, interval=0, throttled_wait=5, timeout=30):
+        """
+        :param path:    database file path
+        :param timeout: seconds to wait for the lock held by another process
+        """
+        super(SharedRateLimiter, self).__init__(interval, throttled_wait)
+        self.path = path
+        # transactions are opened explicitly by BEGIN IMMEDIATE
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS hosts (host TEXT PRIMARY KEY, next REAL)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _update(self, host, func):
+        """
+        replace the next time slot of host by func(now, next time slot or None) -> (next time slot, result)
+        in one transaction, and return the result.
+        """
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute('SELECT next FROM hosts WHERE host = ?', (host,)).fetchone()
+                # wall clock, since monotonic clocks of processes may differ
+                next_time, result = func(time(), row[0] if row else None)
+                self._db.execute('INSERT OR REPLACE INTO hosts VALUES (?, ?)', (host, next_time))
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return result
+
+    def reserve(self, host, interval=None):
+        if interval is None:
+            interval = self.interval
+
+        def schedule(now, next_time):
+            start = max(now, next_time or now)
+            return start + interval, start - now
+
+        return self._update(host, schedule)
+
+    def block(self, host, seconds):
+        def hold(now, next_time):
+            until = now + seconds
+            return max(next_time or until, until), None
+
+        self._update(host, hold)
+
+
+_default_rate_limiter = None
+_default_rate_limiter_lock = Lock()
+
+
+def get_default_rate_limiter():
+    """
+    return the rate limiter shared by connectors.
+    """
+    global _default_rate_limiter
+
+    with _default_rate_limiter_lock:
+        if _default_rate_limiter is None:
+            _default_rate_limiter = HostRateLimiter()
+        return _default_rate_limiter
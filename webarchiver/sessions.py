@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+
+from threading import Lock
+
+# noinspection PyUnresolvedReferences
+from six.moves.http_cookiejar import DefaultCookiePolicy
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+# noinspection PyUnresolvedReferences
+from requests.packages.urllib3.util.retry import Retry
+
+
+class NoCookiePolicy(DefaultCookiePolicy):
+    """
+    Cookie policy that never stores cookies.
+    A shared session must not leak one connector's cookies to another.
+    Connectors keep their own cookie jars and pass them for each request.
+    """
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+class ThrottleRetry(Retry):
+    """
+    Retry leaving throttling responses, 429 and 503 with Retry-After, to the caller.
+    RequestsConnector passes them to its HostRateLimiter, which blocks the host for every connector.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429 or (status_code == 503 and has_retry_after):
+            return False
+        return super(ThrottleRetry, self).is_retry(method, status_code, has_retry_after)
+
+
+def create_session(
+        pool_connections=10,
+        pool_maxsize=10,
+        pool_block=False,
+        keep_alive=True,
+        max_retries=3,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+):
+    """
+    Creates a requests Session with pooled connections and a retry policy.
+    :param pool_connections: number of hosts whose connection pools are cached
+    :param pool_maxsize:     maximum number of connections kept for each host
+    :param pool_block:       block when no free connection is in the pool, instead of opening a new one
+    :param keep_alive:       False to close the connection after each response
+    :param max_retries:      retries of connection errors and status_forcelist responses.
+                             Throttling responses are not retried. See ThrottleRetry
+    :param backoff_factor:   sleep between retries: backoff_factor * (2 ** (retry number - 1))
+    :param status_forcelist: status codes to retry
+    :return:                 Session
+    """
+    retry = ThrottleRetry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        raise_on_status=False,
+        respect_retry_after_header=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry,
+        pool_block=pool_block,
+    )
+
+    session = Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.cookies.set_policy(NoCookiePolicy())
+
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+
+    return session
+
+
+_default_session = None
+_default_session_lock = Lock()
+
+
+def get_default_session():
+    """
+    return the session shared by url_download() and RequestsConnector.
+    It is created by create_session() when it is first required.
+    """
+    global _default_session
+
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = create_session()
+        return _default_session
+
+
+def get_pooled_session(workers):
+    """
+    return the default session, or a new session by create_session() if the default one keeps fewer
+    connections for each host than workers. Connections beyond pool_maxsize are discarded after each response.
+    :param workers: number of threads sharing the session
+    """
+    session = get_default_session()
+    if getattr(session.get_adapter('http://'), '_pool_maxsize', workers) >= workers:
+        return session
+    return create_session(pool_maxsize=workers)
+
+
+def set_default_session(session):
+    """
+    replace the shared session, e.g. set_default_session(create_session(pool_maxsize=32))
+    :param session: Session object, or None to create a new one next time.
+    """
+    global _default_session
+
+    with _default_session_lock:
+        _default_session = session
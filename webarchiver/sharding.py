@@ -0,0 +1,167 @@
+"""
+Fetching on several processes, to use every core for parsing and decoding.
+
+    def parse(connector, url):
+        connector.get(url)
+        return extract_links(connector.last_content, url)
+
+    runner = ShardedRunner('/data/state', processes=4, threads=4, delay=1)
+    results = runner.run(urls, handler=parse)
+
+Urls are assigned to processes by the hash of their hosts, so each host is fetched by one process.
+The processes share cookies through a CookieStore, <state_dir>/cookies.sqlite, and the per-host schedule through
+a SharedRateLimiter, <state_dir>/ratelimit.sqlite. Cookies stored before run(), e.g. by a login with
+RequestsConnector(None, cookie_store=CookieStore(runner.cookie_path)), are used by every process.
+
+Handlers run in the worker processes, so they must be functions defined at the module level,
+and their results must be picklable.
+"""
+from __future__ import absolute_import
+
+from multiprocessing import (
+    Pool,
+    cpu_count,
+)
+from os import makedirs
+from os.path import (
+    exists as path_exists,
+    join as path_join,
+)
+from threading import local
+from zlib import crc32
+
+from .connectors import RequestsConnector
+from .cookiestore import CookieStore
+from .ratelimit import SharedRateLimiter
+from .sessions import create_session
+from .workers import (
+    HostLimiter,
+    get_host,
+    run_in_threads,
+)
+
+
+def get_shard(url, shards):
+    """
+    :return: shard index of url's host, stable across processes and runs
+    """
+    return (crc32(get_host(url).encode('utf-8')) & 0xffffffff) % shards
+
+
+def get_content(connector, url):
+    """
+    default handler: the page text
+    """
+    return connector.get(url)
+
+
+def run_shard(jobs, handler, cookie_path, rate_limit_path, threads, delay, per_host, connector_kwargs):
+    """
+    fetch the urls of a shard on threads. Runs in a worker process of ShardedRunner.
+    :param jobs: list of (index, url)
+    :return:     list of (index, result, error message)
+    """
+    cookie_store = CookieStore(cookie_path)
+    rate_limiter = SharedRateLimiter(rate_limit_path)
+    # pooled connections inherited from the parent process must not be shared
+    session = create_session(pool_maxsize=threads)
+    host_limiter = HostLimiter(per_host)
+    connectors = []
+    thread_data = local()
+
+    def fetch(index, url):
+        connector = getattr(thread_data, 'connector', None)
+        if connector is None:
+            connector = thread_data.connector = RequestsConnector(
+                None, delay, session=session, cookie_store=cookie_store, rate_limiter=rate_limiter,
+                **connector_kwargs
+            )
+            connectors.append(connector)
+        host = get_host(url)
+        host_limiter.acquire(host)
+        try:
+            return handler(connector, url)
+        finally:
+            host_limiter.release(host)
+
+    try:
+        results = run_in_threads(fetch, jobs, threads)
+    finally:
+        for connector in connectors:
+            connector.disconnect()
+        session.close()
+        cookie_store.close()
+        rate_limiter.close()
+
+    return [(job[0], result, repr(error) if error else None) for job, result, error in results]
+
+
+class ShardedRunner(object):
+    """
+    Runs a handler for each url on a pool of processes, sharded by host.
+    """
+
+    cookie_file_name = 'cookies.sqlite'
+    rate_limit_file_name = 'ratelimit.sqlite'
+
+    def __init__(self, state_dir, processes=None, threads=4, delay=1, per_host=1, connector_kwargs=None):
+        """
+        :param state_dir:        directory of the shared cookie store and rate limiter
+        :param processes:        number of processes. The number of CPUs if None
+        :param threads:          fetching threads per process
+        :param delay:            minimum interval in seconds between requests to the same host, in all processes
+        :param per_host:         maximum concurrent requests per host. 0 means no cap
+        :param connector_kwargs: other keyword arguments for RequestsConnector, e.g. extra_headers
+        """
+        self.state_dir = state_dir
+        self.processes = processes or cpu_count()
+        self.threads = threads
+        self.delay = delay
+        self.per_host = per_host
+        self.connector_kwargs = connector_kwargs or {}
+
+        if not path_exists(state_dir):
+            makedirs(state_dir)
+
+    @property
+    def cookie_path(self):
+        return path_join(self.state_dir, self.cookie_file_name)
+
+    @property
+    def rate_limit_path(self):
+        return path_join(self.state_dir, self.rate_limit_file_name)
+
+    def run(self, urls, handler=get_content):
+        """
+        :param urls:    urls to fetch
+        :param handler: function taking (connector, url), called in the worker processes.
+                        Its result is returned. get_content() returns the page text
+        :return:        list of (url, result, error message) in the order of urls. result is None on errors
+        """
+        urls = list(urls)
+        shards = [[] for _ in range(self.processes)]
+        for index, url in enumerate(urls):
+            shards[get_shard(url, self.processes)].append((index, url))
+
+        # create the stores before the workers open them
+        CookieStore(self.cookie_path).close()
+        SharedRateLimiter(self.rate_limit_path).close()
+
+        results = [None] * len(urls)
+        pool = Pool(self.processes)
+        try:
+            pending = [
+                pool.apply_async(run_shard, (
+                    jobs, handler, self.cookie_path, self.rate_limit_path, self.threads, self.delay,
+                    self.per_host, self.connector_kwargs
+                ))
+                for jobs in shards if jobs
+            ]
+            for async_result in pending:
+                for index, result, error in async_result.get():
+                    results[index] = (urls[index], result, error)
+        finally:
+            pool.close()
+            pool.join()
+
+        return results
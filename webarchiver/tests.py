@@ -1,14 +1,24 @@
 from __future__ import absolute_import
 import atexit
+import gzip
 import io
+import json
 import operator
 import os
 import tempfile
+import threading
 import unittest
 import tarfile
 import time
 import zipfile
 
+import requests
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.support.expected_conditions import presence_of_element_located
 
@@ -25,7 +35,32 @@ from six.moves.urllib.parse import urlparse, parse_qsl
 from six.moves.BaseHTTPServer import BaseHTTPRequestHandler
 
 import webarchiver
+import webarchiver.adaptive as adaptive
+import webarchiver.archives as archives
+import webarchiver.batch as batch
+import webarchiver.benchmarks as benchmarks
+import webarchiver.blobstore as blobstore
+import webarchiver.browsers as browsers
+import webarchiver.cache as cache
 import webarchiver.connectors as connectors
+import webarchiver.cookiestore as cookiestore
+import webarchiver.crawler as crawler
+import webarchiver.hybrid as hybrid
+import webarchiver.links as links
+import webarchiver.metrics as metrics
+import webarchiver.pool as pool
+import webarchiver.ratelimit as ratelimit
+import webarchiver.sessions as sessions
+import webarchiver.sharding as sharding
+import webarchiver.waits as waits
+import webarchiver.warc as warc
+import webarchiver.workers as workers
+
+try:
+    import webarchiver.aio as aio
+except (ImportError, SyntaxError):
+    # python 2, or aiohttp is not installed
+    aio = None
 
 
 RESOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources')
@@ -63,12 +98,19 @@ def get_http_test_server_thread(handler_class):
         daemon = True
         current_path = os.getcwd()
         httpd = None
+        ready = threading.Event()
+
+        def start(self):
+            # wait until the server is bound, so that the first request is not refused
+            Thread.start(self)
+            self.ready.wait(5)
 
         def run(self):
             os.chdir(RESOURCE_PATH)
             TCPServer.allow_reuse_address = True
             # SimpleHTTPRequestHandler
             self.httpd = TCPServer(TEST_SERVER_ADDRESS, handler_class)
+            self.ready.set()
             self.httpd.serve_forever()
 
         def server_cleanup(self):
@@ -116,6 +158,28 @@ class TestArchiver(unittest.TestCase):
 
         file_buffer.close()
 
+    def test_url_download_streaming(self):
+        """
+        test archiver.url_download() with a file path
+        """
+        test_server = 'http://%s:%s' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        download_dir = tempfile.mkdtemp()
+        download_path = os.path.join(download_dir, 'google.png')
+
+        webarchiver.url_download(test_server + '/test_images/google.png', download_path, chunk_size=128)
+
+        with open(os.path.join(RESOURCE_PATH, 'test_images', 'google.png'), 'rb') as f:
+            real_content = f.read()
+        with open(download_path, 'rb') as f:
+            self.assertEqual(f.read(), real_content)
+
+        # failed downloads never leave a file under the final name
+        missing_path = os.path.join(download_dir, 'missing.png')
+        with self.assertRaises(requests.HTTPError):
+            webarchiver.url_download(test_server + '/test_images/missing.png', missing_path)
+
+        self.assertListEqual(os.listdir(download_dir), ['google.png'])
+
     def test_zip_recursive(self):
         """
         test archiver.zip_recursive()
@@ -209,11 +273,1087 @@ class TestArchiver(unittest.TestCase):
                 comparison_list
             )
 
+    def test_archive_remote_urls_concurrently(self):
+
+        test_server = 'http://{}:{}'.format(TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+
+        title = 'test_images'
+        broken_url = 'http://127.0.0.1:1/test_images/broken.png'
+        urls = [
+            test_server + '/test_images/google.png',
+            broken_url,
+            test_server + '/test_images/twitter.png',
+            test_server + '/test_images/facebook.png',
+        ]
+
+        # sequential and concurrent downloads report failures alike
+        for workers in (1, 3):
+            download_path = tempfile.mkdtemp()
+            failures = webarchiver.archive_remote_urls(
+                download_path=download_path,
+                title=title,
+                urls=urls,
+                archiver='',
+                workers=workers,
+                per_host=2,
+                strict=False
+            )
+
+            # the broken url is reported, and the rest are downloaded in their own place
+            self.assertEqual([url for url, error in failures], [broken_url])
+            self.assertListEqual(
+                sorted(os.listdir(os.path.join(download_path, title))), ['01.png', '03.png', '04.png']
+            )
+
+            with open(os.path.join(download_path, title, '03.png'), 'rb') as f:
+                downloaded = f.read()
+            with open(os.path.join(RESOURCE_PATH, 'test_images', 'twitter.png'), 'rb') as f:
+                self.assertEqual(downloaded, f.read())
+
+        # by default, the first failure is raised, and sequential downloads stop there
+        for workers, downloaded in ((1, ['01.png']), (3, ['01.png', '03.png', '04.png'])):
+            download_path = tempfile.mkdtemp()
+            self.assertRaises(
+                requests.ConnectionError, webarchiver.archive_remote_urls, download_path, title, urls,
+                archiver='.zip', workers=workers
+            )
+            self.assertFalse(os.path.exists(os.path.join(download_path, title + '.zip')))
+            self.assertListEqual(sorted(os.listdir(os.path.join(download_path, title))), downloaded)
+
+    def test_archive_remote_urls_adaptively(self):
+
+        test_server = 'http://{}:{}'.format(TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        broken_url = 'http://127.0.0.1:1/test_images/broken.png'
+        urls = [test_server + '/test_images/%s.png' % name for name in ('google', 'twitter', 'facebook')]
+        limiter = adaptive.AdaptiveLimiter(initial=4, cooldown=0)
+
+        failures = webarchiver.archive_remote_urls(
+            tempfile.mkdtemp(), 'adaptive', urls + [broken_url], archiver='.zip', workers=3, concurrency=limiter,
+            strict=False
+        )
+
+        self.assertEqual([url for url, error in failures], [broken_url])
+        limits = limiter.limits['%s:%s' % TEST_SERVER_ADDRESS]
+        self.assertEqual(limits['successes'], 3)
+        self.assertEqual(limits['active'], 0)
+        self.assertGreaterEqual(limits['limit'], 4)
+
+        # the failing host is cut down, and recovers with fast responses
+        self.assertEqual(limiter.limits['127.0.0.1:1']['failures'], 1)
+        self.assertEqual(limiter.get_limit('127.0.0.1:1'), 2)
+        for _ in range(4):
+            limiter.observe('127.0.0.1:1', 0.01, 200)
+        self.assertEqual(limiter.get_limit('127.0.0.1:1'), 3)
+
+    def test_archive_remote_urls_without_staging(self):
+
+        test_server = 'http://{}:{}'.format(TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+
+        title = 'test_images'
+        urls = [
+            test_server + '/test_images/google.png',
+            test_server + '/test_images/twitter.png',
+            test_server + '/test_images/facebook.png',
+        ]
+
+        for archiver, workers in (('.tar.gz', 1), ('.zip', 3)):
+            download_path = tempfile.mkdtemp()
+            webarchiver.archive_remote_urls(
+                download_path=download_path,
+                title=title,
+                urls=urls,
+                archiver=archiver,
+                workers=workers,
+                staging=False,
+                spool_size=1024
+            )
+
+            # nothing but the archive is written
+            self.assertListEqual(os.listdir(download_path), [title + archiver])
+
+            archived = os.path.join(download_path, title + archiver)
+            if archiver == '.zip':
+                with zipfile.ZipFile(archived) as zf:
+                    content = zf.read(title + '/02.png')
+                    # entries follow the urls, not the order the downloads finished in
+                    self.assertListEqual(zf.namelist(), [title + '/%02d.png' % (i + 1) for i in range(3)])
+            else:
+                with tarfile.open(archived) as tar:
+                    content = tar.extractfile(title + '/02.png').read()
+            with open(os.path.join(RESOURCE_PATH, 'test_images', 'twitter.png'), 'rb') as f:
+                self.assertEqual(content, f.read())
+
+    def test_archive_remote_urls_archive_error(self):
+
+        test_server = 'http://{}:{}'.format(TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        urls = [test_server + '/test_images/%s.png' % name for name in ('google', 'twitter', 'facebook')]
+
+        class FailingWriter(archives.ArchiveWriter):
+            def add(self, *args, **kwargs):
+                raise IOError('disk full')
+
+        # an archive error is not a download failure: the archive is aborted, and the error is raised
+        original = webarchiver.ArchiveWriter
+        webarchiver.ArchiveWriter = FailingWriter
+        try:
+            download_path = tempfile.mkdtemp()
+            with self.assertRaises(IOError):
+                webarchiver.archive_remote_urls(download_path, 'failing', urls, archiver='.zip', workers=2)
+            self.assertFalse(os.path.exists(os.path.join(download_path, 'failing.zip')))
+        finally:
+            webarchiver.ArchiveWriter = original
+
+    def test_archive_remote_urls_with_blob_store(self):
+
+        test_server = 'http://{}:{}'.format(TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+
+        download_path = tempfile.mkdtemp()
+        store = blobstore.BlobStore(os.path.join(download_path, 'store'))
+        urls = [
+            test_server + '/test_images/google.png',
+            test_server + '/test_images/google.png?mirror=1',
+            test_server + '/test_images/twitter.png',
+        ]
+
+        webarchiver.archive_remote_urls(download_path, 'first', urls, archiver='', blob_store=store)
+
+        # identical contents are stored once, and linked
+        blobs = [name for _, _, names in os.walk(store.objects_dir) for name in names]
+        self.assertEqual(len(blobs), 2)
+        first_stat = os.stat(os.path.join(download_path, 'first', '01.png'))
+        second_stat = os.stat(os.path.join(download_path, 'first', '02.png'))
+        self.assertEqual(first_stat.st_ino, second_stat.st_ino)
+
+        # known urls are not downloaded again
+        def download(url, download_path):
+            raise AssertionError('%s is downloaded again' % url)
+
+        path = os.path.join(download_path, 'twitter.png')
+        store.fetch(urls[2], path, download=download)
+        with open(os.path.join(RESOURCE_PATH, 'test_images', 'twitter.png'), 'rb') as f:
+            with open(path, 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+        store.close()
+
+    def test_batch_runner(self):
+
+        test_server = 'http://{}:{}'.format(TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+
+        download_path = tempfile.mkdtemp()
+        job_file = os.path.join(download_path, 'jobs.json')
+        with open(job_file, 'w') as f:
+            json.dump({
+                'first': [test_server + '/test_images/google.png', test_server + '/test_images/twitter.png'],
+                'second': [test_server + '/test_images/facebook.png'],
+                'broken': [test_server + '/test_images/missing.png'],
+            }, f)
+
+        self.assertEqual(batch.main([job_file, '-d', download_path, '-a', '.zip', '-p', '1']), 1)
+
+        state = batch.JobState(os.path.join(download_path, batch.BatchRunner.state_file_name))
+        self.assertEqual(state.get('first'), batch.ARCHIVED)
+        self.assertEqual(state.get('second'), batch.ARCHIVED)
+        self.assertEqual(state.get('broken'), batch.FAILED)
+        with zipfile.ZipFile(os.path.join(download_path, 'first.zip')) as zf:
+            self.assertListEqual(sorted(zf.namelist()), ['first/01.png', 'first/02.png'])
+
+        # a restarted batch skips archived jobs
+        os.unlink(os.path.join(download_path, 'first.zip'))
+        runner = batch.BatchRunner(download_path, archiver='.zip', processes=1)
+        statuses = runner.run(batch.load_jobs(job_file))
+        self.assertEqual(statuses['first'], batch.ARCHIVED)
+        self.assertFalse(os.path.exists(os.path.join(download_path, 'first.zip')))
+
+    def test_archive_page(self):
+
+        test_server = 'http://{}:{}'.format(TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        download_path = tempfile.mkdtemp()
+
+        # the directory listing links the images
+        self.assertEqual(
+            sorted(links.stream_links(test_server + '/test_images/', kinds=('a',), pattern=r'\.png$')),
+            [test_server + '/test_images/%s.png' % name for name in ('facebook', 'google', 'twitter')]
+        )
+
+        connector = connectors.RequestsConnector(os.path.join(download_path, 'cookie'), 0)
+        failures = links.archive_page(
+            connector, test_server + '/test_images/', download_path, 'page', kinds=('a',), pattern=r'\.png$',
+            archiver='.zip'
+        )
+
+        self.assertEqual(failures, [])
+        with zipfile.ZipFile(os.path.join(download_path, 'page.zip')) as zf:
+            self.assertListEqual(sorted(zf.namelist()), ['page/01.png', 'page/02.png', 'page/03.png'])
+
+    def test_warc(self):
+
+        test_server = 'http://{}:{}'.format(TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        temp_dir = tempfile.mkdtemp()
+        urls = [test_server + '/test_images/google.png', test_server + '/test_images/twitter.png']
+
+        # a new file for each exchange
+        with warc.WarcWriter(os.path.join(temp_dir, 'warc'), max_size=1) as writer:
+            webarchiver.archive_remote_urls(temp_dir, 'warc_test', urls, archiver='.zip', staging=False, warc=writer)
+            connector = connectors.RequestsConnector(os.path.join(temp_dir, 'cookie'), 0, warc=writer)
+            connector.get(test_server + '/test_images/')
+
+            record = writer.get(urls[0])
+            with open(os.path.join(RESOURCE_PATH, 'test_images', 'google.png'), 'rb') as f:
+                self.assertEqual(record.payload, f.read())
+            self.assertEqual(record.record_type, 'response')
+            self.assertEqual(record.status_code, 200)
+            self.assertEqual(dict((k.lower(), v) for k, v in record.http_headers)['content-type'], 'image/png')
+
+            page = writer.get(test_server + '/test_images/')
+            self.assertEqual(page.payload.decode('utf-8'), connector.last_content)
+            self.assertIsNone(writer.get(test_server + '/missing'))
+
+            cdx_path = os.path.join(temp_dir, 'index.cdx')
+            writer.export_cdx(cdx_path)
+
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(temp_dir, 'warc'))),
+            ['index.sqlite'] + ['webarchiver-%05d.warc.gz' % i for i in range(3)]
+        )
+        with open(cdx_path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[1].split()[0], '127.0.0.1:%d)/test_images/' % TEST_SERVER_ADDRESS[1])
+
+        # each file begins with warcinfo, and records are separate gzip members
+        path = os.path.join(temp_dir, 'warc', 'webarchiver-00000.warc.gz')
+        info = warc.read_record(path, 0)
+        self.assertEqual(info.record_type, 'warcinfo')
+        with gzip.open(path) as f:
+            self.assertEqual(f.read().count(b'WARC/1.0\r\n'), 3)
+
     def test_get_safe_name(self):
         result = webarchiver.get_safe_name('i_/am-:un|safe? maybe,...')
         self.assertEqual('i_am-unsafe maybe,...', result)
 
 
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves a fixed payload with an ETag, and honors Range and If-Range.
+    """
+    payload = bytes(bytearray(range(256))) * 16
+    etag = '"payload-v1"'
+    ranges = []  # Range headers received
+    missing = set()  # paths answered by 404
+
+    def do_GET(self):
+        if self.path in self.missing:
+            self.send_error(404)
+            return
+        self.__class__.ranges.append(self.headers.get('range'))
+        body = self.payload
+        byte_range = self.headers.get('range')
+        if byte_range and self.headers.get('if-range') == self.etag:
+            start = int(byte_range.split('=')[1].rstrip('-'))
+            body = self.payload[start:]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(self.payload) - 1, len(self.payload)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestResumeDownload(unittest.TestCase):
+    """
+    Testing archive_remote_urls(resume=True)
+    """
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = get_http_test_server_thread(RangeHandler)
+        if not cls.server.is_alive():
+            cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server.is_alive():
+            cls.server.server_cleanup()
+
+    def test(self):
+        url = 'http://%s:%s/payload.bin' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        download_path = tempfile.mkdtemp()
+        save_dir = os.path.join(download_path, 'resume')
+        os.makedirs(save_dir)
+        path = os.path.join(save_dir, '01.bin')
+
+        # an interrupted download
+        manifest = webarchiver.DownloadManifest(save_dir)
+        manifest.start(url, path, RangeHandler.etag)
+        with open(path + '.part', 'wb') as f:
+            f.write(RangeHandler.payload[:1000])
+
+        del RangeHandler.ranges[:]
+        webarchiver.archive_remote_urls(download_path, 'resume', [url], archiver='', resume=True)
+
+        self.assertEqual(RangeHandler.ranges, ['bytes=1000-'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), RangeHandler.payload)
+        self.assertFalse(os.path.exists(path + '.part'))
+
+        # finished downloads are skipped
+        webarchiver.archive_remote_urls(download_path, 'resume', [url], archiver='', resume=True)
+        self.assertEqual(len(RangeHandler.ranges), 1)
+
+        # the manifest is not archived
+        webarchiver.archive_remote_urls(download_path, 'resume', [url], archiver='.zip', resume=True)
+        with zipfile.ZipFile(os.path.join(download_path, 'resume.zip')) as zf:
+            self.assertListEqual(zf.namelist(), ['resume/01.bin'])
+        self.assertEqual(len(RangeHandler.ranges), 1)
+
+    def test_failed_download(self):
+        test_server = 'http://%s:%s' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        urls = [test_server + '/%s.bin' % name for name in ('a', 'b', 'c')]
+        download_path = tempfile.mkdtemp()
+        archive_path = os.path.join(download_path, 'failed.zip')
+
+        RangeHandler.missing.add('/b.bin')
+        try:
+            failures = webarchiver.archive_remote_urls(
+                download_path, 'failed', urls, archiver='.zip', resume=True, strict=False
+            )
+        finally:
+            RangeHandler.missing.clear()
+
+        # no incomplete archive, and the downloads are kept
+        self.assertEqual([url for url, error in failures], [urls[1]])
+        self.assertFalse(os.path.exists(archive_path))
+        self.assertFalse(os.path.exists(archive_path + '.part'))
+        self.assertIn('03.bin', os.listdir(os.path.join(download_path, 'failed')))
+
+        del RangeHandler.ranges[:]
+        failures = webarchiver.archive_remote_urls(download_path, 'failed', urls, archiver='.zip', resume=True)
+        self.assertEqual(failures, [])
+        self.assertEqual(len(RangeHandler.ranges), 1)
+        with zipfile.ZipFile(archive_path) as zf:
+            self.assertListEqual(zf.namelist(), ['failed/01.bin', 'failed/02.bin', 'failed/03.bin'])
+            self.assertEqual(zf.read('failed/02.bin'), RangeHandler.payload)
+        self.assertFalse(os.path.exists(os.path.join(download_path, 'failed')))
+
+
+class ConditionalHandler(BaseHTTPRequestHandler):
+    """
+    Serves '/page/<n>' with an ETag, and replies 304 if If-None-Match matches.
+    """
+    bodies_sent = 0
+
+    def do_GET(self):
+        etag = '"%s"' % self.path
+        if self.headers.get('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = ('<html>%s</html>' % self.path).encode('utf-8')
+        self.__class__.bodies_sent += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpCache(unittest.TestCase):
+    """
+    Testing RequestsConnector with cache.HttpCache
+    """
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = get_http_test_server_thread(ConditionalHandler)
+        if not cls.server.is_alive():
+            cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server.is_alive():
+            cls.server.server_cleanup()
+
+    def test(self):
+        test_server = 'http://%s:%s' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        temp_dir = tempfile.mkdtemp()
+        http_cache = cache.HttpCache(os.path.join(temp_dir, 'cache'), max_entries=2)
+        connector = connectors.RequestsConnector(os.path.join(temp_dir, 'cookie'), 0, cache=http_cache)
+
+        self.assertEqual(connector.get(test_server + '/page/1'), '<html>/page/1</html>')
+        self.assertFalse(connector.last_response.from_cache)
+
+        # revalidated, and served from the cache
+        self.assertEqual(connector.get(test_server + '/page/1'), '<html>/page/1</html>')
+        self.assertTrue(connector.last_response.from_cache)
+        self.assertEqual(connector.last_response.status_code, 200)
+        self.assertEqual(connector.last_response.headers['content-type'], 'text/html; charset=utf-8')
+        self.assertEqual(connector.last_response.headers['etag'], '"/page/1"')
+        self.assertEqual(ConditionalHandler.bodies_sent, 1)
+
+        # page 1 is the least recently used, and evicted
+        connector.get(test_server + '/page/2')
+        connector.get(test_server + '/page/2')
+        connector.get(test_server + '/page/3')
+        connector.get(test_server + '/page/1')
+        self.assertFalse(connector.last_response.from_cache)
+
+        self.assertEqual(http_cache.stats, {'hits': 2, 'misses': 4, 'entries': 2, 'bytes': 40})
+        http_cache.close()
+
+
+class TestArchiveWriter(unittest.TestCase):
+    """
+    Testing archives.ArchiveWriter
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.files = {
+            'episode/01.png': os.path.join(RESOURCE_PATH, 'test_images', 'google.png'),
+            'episode/02.txt': os.path.join(self.temp_dir, 'large.txt'),
+        }
+        with open(self.files['episode/02.txt'], 'wb') as f:
+            f.write(b'web archiver ' * 300000)
+
+    def write(self, archiver, **kwargs):
+        archive_path = os.path.join(self.temp_dir, 'episode' + archiver)
+        with archives.ArchiveWriter(archive_path, archiver, **kwargs) as writer:
+            writer.add_directory('episode')
+            for arcname, path in sorted(self.files.items()):
+                writer.add(path, arcname)
+        self.assertFalse(os.path.exists(archive_path + '.part'))
+        return archive_path
+
+    def assertTarContent(self, archive_path):
+        with tarfile.open(archive_path) as tar:
+            self.assertListEqual(tar.getnames(), ['episode'] + sorted(self.files))
+            for arcname, path in self.files.items():
+                with open(path, 'rb') as f:
+                    self.assertEqual(tar.extractfile(arcname).read(), f.read())
+
+    def test_tar(self):
+        for archiver in ('.tar', '.tar.gz', '.tar.xz'):
+            self.assertTarContent(self.write(archiver))
+
+    def test_parallel_gzip(self):
+        self.assertTarContent(self.write('.tar.gz', level=6, threads=4))
+
+    @unittest.skipIf(archives.zstandard is None, 'requires zstandard')
+    def test_zstd(self):
+        archive_path = self.write('.tar.zst', threads=2)
+        with open(archive_path, 'rb') as f:
+            reader = archives.zstandard.ZstdDecompressor().stream_reader(f)
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                self.assertListEqual([info.name for info in tar], ['episode'] + sorted(self.files))
+
+    def test_zip(self):
+        with zipfile.ZipFile(self.write('.zip')) as zf:
+            compress_types = dict((info.filename, info.compress_type) for info in zf.infolist())
+        # images are stored without recompression
+        self.assertEqual(compress_types, {'episode/01.png': zipfile.ZIP_STORED, 'episode/02.txt': zipfile.ZIP_DEFLATED})
+
+    @unittest.skipIf(not archives._zip_levels, 'requires python 3.7')
+    def test_zip_level(self):
+        data = ''.join('%d %s\n' % (i, 'web archiver' * (i % 7)) for i in range(20000)).encode('ascii')
+        sizes = []
+        for level in (1, 9):
+            archive_path = os.path.join(self.temp_dir, 'level%d.zip' % level)
+            with archives.ArchiveWriter(archive_path, '.zip', level=level) as writer:
+                writer.add(self.files['episode/02.txt'], 'episode/02.txt')
+                writer.add_fileobj(io.BytesIO(data), 'episode/03.txt', len(data))
+            with zipfile.ZipFile(archive_path) as zf:
+                self.assertEqual(zf.read('episode/03.txt'), data)
+                sizes.append([info.compress_size for info in zf.infolist()])
+        # both entries are smaller at level 9
+        self.assertGreater(sizes[0][0], sizes[1][0])
+        self.assertGreater(sizes[0][1], sizes[1][1])
+
+    def test_abort(self):
+        archive_path = os.path.join(self.temp_dir, 'aborted.zip')
+        with self.assertRaises(ValueError):
+            with archives.ArchiveWriter(archive_path, '.zip'):
+                raise ValueError()
+        self.assertListEqual(sorted(os.listdir(self.temp_dir)), ['large.txt'])
+
+
+class TestLinkExtractor(unittest.TestCase):
+    """
+    Testing links.LinkExtractor
+    """
+    page = """
+        <html><head>
+        <link rel="stylesheet" href="/style.css">
+        <style>body { background: url('bg.png') }</style>
+        </head><body>
+        <a href="next.html#top">next</a> <a href="javascript:void(0)">no</a> <a href="#top">top</a>
+        <img src="a.jpg" srcset="a.jpg 1x, a@2x.jpg 2x"><img data-src="lazy.jpg">
+        <base href="http://cdn.example.com/images/">
+        <div style="background-image: url(&quot;div.png&quot;)"></div>
+        <img src="b.jpg"><img src="b.jpg"><img src="data:image/png;base64,AAAA">
+        </body></html>
+    """
+
+    def test_kinds(self):
+        page_url = 'http://example.com/gallery/'
+        self.assertEqual(
+            links.extract_links(self.page, page_url, kinds=('img', 'srcset')),
+            [
+                'http://example.com/gallery/a.jpg',
+                'http://example.com/gallery/a@2x.jpg',
+                'http://example.com/gallery/lazy.jpg',
+                'http://cdn.example.com/images/b.jpg',
+            ]
+        )
+        self.assertEqual(
+            links.extract_links(self.page, page_url, kinds=('a', 'css')),
+            [
+                'http://example.com/style.css',
+                'http://example.com/gallery/bg.png',
+                'http://example.com/gallery/next.html',
+                'http://cdn.example.com/images/div.png',
+            ]
+        )
+        self.assertEqual(
+            links.extract_links(self.page, page_url, kinds=('img',), pattern=r'cdn\.'),
+            ['http://cdn.example.com/images/b.jpg']
+        )
+        self.assertRaises(ValueError, links.LinkExtractor, page_url, kinds=('video',))
+
+    def test_chunks(self):
+        page_url = 'http://example.com/gallery/'
+        chunks = [self.page[i:i + 7] for i in range(0, len(self.page), 7)]
+        self.assertEqual(
+            list(links.iter_links(chunks, page_url, kinds=('img', 'srcset', 'a', 'css'))),
+            links.extract_links(self.page, page_url, kinds=('img', 'srcset', 'a', 'css'))
+        )
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    """
+    Serves a small site: robots.txt disallows /private/, and every page links the others.
+    """
+    pages = {
+        '/': ['/a', '/b', '/private/secret', 'http://example.com/'],
+        '/a': ['/b', '/c'],
+        '/b': ['/', '/broken'],
+        '/c': ['/d'],
+    }
+
+    def do_GET(self):
+        if self.path == '/robots.txt':
+            body = 'User-agent: *\nDisallow: /private/\n'
+        elif self.path in self.pages:
+            body = ''.join('<a href="%s">link</a>' % link for link in self.pages[self.path])
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCrawler(unittest.TestCase):
+    """
+    Testing crawler.Crawler with a persistent frontier
+    """
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = get_http_test_server_thread(SiteHandler)
+        if not cls.server.is_alive():
+            cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server.is_alive():
+            cls.server.server_cleanup()
+
+    def test_crawl(self):
+        test_server = 'http://%s:%s' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        frontier_path = os.path.join(tempfile.mkdtemp(), 'frontier.sqlite')
+        visited = []
+
+        def crawl(seeds=(test_server + '/',), **kwargs):
+            frontier = crawler.Frontier(frontier_path, bloom_capacity=1000)
+            site_crawler = crawler.Crawler(
+                frontier, workers=2, delay=0, on_page=lambda url, content, depth: visited.append((url, depth)),
+                **kwargs
+            )
+            try:
+                return site_crawler.crawl(seeds)
+            finally:
+                frontier.close()
+
+        # no seeds to find the scope from
+        self.assertRaises(ValueError, crawl, seeds=())
+
+        # stopped after the first page, and resumed without seeds: the scope comes from the seeds of the frontier
+        self.assertEqual(crawl(max_pages=1), {crawler.DONE: 1, crawler.PENDING: 3})
+        counts = crawl(seeds=())
+
+        self.assertEqual(counts, {crawler.DONE: 4, crawler.SKIPPED: 1, crawler.FAILED: 1})
+        self.assertEqual(
+            sorted(visited),
+            [(test_server + path, depth) for path, depth in (('/', 0), ('/a', 1), ('/b', 1), ('/c', 2))]
+        )
+
+    def test_bloom_filter(self):
+        bloom = crawler.BloomFilter(capacity=100, error_rate=0.01)
+        self.assertTrue(bloom.add('http://example.com/'))
+        self.assertFalse(bloom.add('http://example.com/'))
+        self.assertIn('http://example.com/', bloom)
+        self.assertNotIn('http://example.com/other', bloom)
+
+
+class TestBenchmarks(unittest.TestCase):
+    """
+    Testing benchmarks, with the smallest parameters
+    """
+    def test(self):
+        results = benchmarks.run_benchmarks(
+            sizes=(1024,), counts=(2,), requests=3, workers=(2,), archivers=('.zip',), runs=3, warmup=1
+        )
+
+        self.assertListEqual(
+            [result['name'] for result in results],
+            ['url_download', 'RequestsConnector.get', 'archive_remote_urls']
+        )
+        self.assertTrue(all(result['seconds'] > 0 for result in results))
+        self.assertTrue(all(result['runs'] == 3 for result in results))
+        self.assertTrue(all(r['min_seconds'] <= r['seconds'] <= r['max_seconds'] for r in results))
+        self.assertEqual(benchmarks.median([3, 1, 2]), 2)
+        self.assertEqual(benchmarks.median([4, 1, 2, 3]), 2.5)
+
+        self.assertListEqual(benchmarks.compare(results, results), [])
+        slower = [dict(result, seconds=result['seconds'] * 2) for result in results]
+        self.assertEqual(len(benchmarks.compare(slower, results, tolerance=0.5)), 3)
+
+
+class TestHostLimiter(unittest.TestCase):
+    """
+    Testing workers.HostLimiter
+    """
+    def test(self):
+        limiter = workers.HostLimiter(2)
+        peak = {'a': 0, 'b': 0}
+        lock = threading.Lock()
+
+        def job(host):
+            limiter.acquire(host)
+            with lock:
+                peak[host] = max(peak[host], limiter.active(host))
+            time.sleep(0.02)
+            limiter.release(host)
+
+        results = workers.run_in_threads(job, [('a',), ('b',)] * 5, workers=8)
+
+        self.assertEqual([error for _, _, error in results], [None] * 10)
+        self.assertEqual(peak, {'a': 2, 'b': 2})
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    """
+    Testing adaptive.AdaptiveLimiter
+    """
+    def test(self):
+        limiter = adaptive.AdaptiveLimiter(initial=2, max_limit=4, cooldown=60)
+
+        # about one more for each round of fast responses
+        for _ in range(3):
+            limiter.observe('a.com', 0.1, 200)
+        self.assertEqual(limiter.get_limit('a.com'), 3)
+        for _ in range(20):
+            limiter.observe('a.com', 0.1, 200)
+        self.assertEqual(limiter.get_limit('a.com'), 4)
+
+        # throttled: halved, once in the cooldown
+        limiter.observe('a.com', 0.1, 429)
+        limiter.observe('a.com', None, None, 'timeout')
+        self.assertEqual(limiter.get_limit('a.com'), 2)
+        self.assertEqual(limiter.limits['a.com']['failures'], 2)
+
+        # slowing down
+        limiter(metrics.create_event('request', 'http://b.com/', status_code=200, ttfb=0.1))
+        for _ in range(10):
+            limiter(metrics.create_event('request', 'http://b.com/', status_code=200, ttfb=1.0))
+        self.assertEqual(limiter.get_limit('b.com'), 1)
+        self.assertEqual(limiter.get_limit('c.com'), 2)
+
+
+class ThrottleHandler(BaseHTTPRequestHandler):
+    """
+    Replies 429 with Retry-After to every other request.
+    """
+    requests = 0
+
+    def do_GET(self):
+        self.__class__.requests += 1
+        if self.requests % 2:
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHostRateLimiter(unittest.TestCase):
+    """
+    Testing ratelimit.HostRateLimiter
+    """
+    def test_reserve(self):
+        limiter = ratelimit.HostRateLimiter(interval=10)
+
+        self.assertEqual(limiter.reserve('a.com'), 0)
+        self.assertEqual(limiter.reserve('b.com'), 0)
+        self.assertAlmostEqual(limiter.reserve('a.com'), 10, delta=0.1)
+        self.assertAlmostEqual(limiter.reserve('a.com', interval=0), 20, delta=0.1)
+
+        limiter.block('b.com', 30)
+        self.assertAlmostEqual(limiter.reserve('b.com'), 30, delta=0.1)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(ratelimit.parse_retry_after('120'), 120)
+        self.assertEqual(ratelimit.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        self.assertIsNone(ratelimit.parse_retry_after('soon'))
+
+    def test_shared_rate_limiter(self):
+        path = os.path.join(tempfile.mkdtemp(), 'ratelimit.sqlite')
+        first = ratelimit.SharedRateLimiter(path, interval=10)
+        second = ratelimit.SharedRateLimiter(path, interval=10)
+
+        self.assertEqual(first.reserve('a.com'), 0)
+        self.assertAlmostEqual(second.reserve('a.com'), 10, delta=0.1)
+        self.assertEqual(second.reserve('b.com'), 0)
+
+        second.block('b.com', 30)
+        self.assertAlmostEqual(first.reserve('b.com'), 30, delta=0.1)
+
+    def test_throttled_request(self):
+        server = get_http_test_server_thread(ThrottleHandler)
+        server.start()
+        try:
+            ThrottleHandler.requests = 0
+            observed = []
+
+            class Limiter(ratelimit.HostRateLimiter):
+                def observe(self, host, status_code, headers):
+                    observed.append(status_code)
+                    return super(Limiter, self).observe(host, status_code, headers)
+
+            limiter = Limiter()
+            url = 'http://%s:%s/' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+            throttled = connectors.RequestsConnector(None, 0, rate_limiter=limiter, throttled_retries=0)
+            connector = connectors.RequestsConnector(None, 0, rate_limiter=limiter)
+
+            # the 429 reaches the limiter, which blocks the host for the other connector
+            throttled.get(url)
+            self.assertEqual(throttled.last_response.status_code, 429)
+            self.assertEqual(observed, [429])
+
+            started = time.time()
+            content = connector.get(url)
+
+            self.assertEqual(content, 'ok')
+            self.assertEqual(observed, [429, 200])
+            self.assertEqual(ThrottleHandler.requests, 2)
+            self.assertGreaterEqual(time.time() - started, 0.9)
+        finally:
+            server.server_cleanup()
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Testing metrics.MetricsAggregator and the metrics hooks of RequestsConnector and url_download
+    """
+    def test_aggregator(self):
+        aggregator = metrics.MetricsAggregator(max_samples=10)
+        for i in range(20):
+            host = 'slow.com' if i % 2 else 'fast.com'
+            aggregator(metrics.create_event(
+                'request', 'http://%s/%d' % (host, i), status_code=200, bytes=10, total=i if i % 2 else 0.1
+            ))
+        aggregator(metrics.create_event('request', 'http://fast.com/error', error='timeout'))
+
+        self.assertEqual(aggregator.hosts, ['fast.com', 'slow.com'])
+        self.assertEqual(
+            aggregator.get_counters('request'),
+            {'count': 21, 'errors': 1, 'bytes': 200, 'status': {200: 20}}
+        )
+        # only the last 10 samples are kept: 1, 3, ..., 19
+        self.assertEqual(aggregator.percentile('request', 'total', 50, 'slow.com'), 9)
+        self.assertEqual(aggregator.percentile('request', 'total', 100, 'slow.com'), 19)
+        self.assertIsNone(aggregator.percentile('request', 'ttfb', 50))
+        self.assertEqual([host for host, _ in aggregator.slowest_hosts()], ['slow.com', 'fast.com'])
+        self.assertEqual(aggregator.summary()['request']['*']['count'], 21)
+
+    def test_hooks(self):
+        events = []
+
+        def broken(event):
+            raise ValueError()
+
+        server = get_http_test_server_thread(CookieHandler)
+        server.start()
+        try:
+            url = 'http://%s:%s/login' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+            connector = connectors.RequestsConnector(
+                os.path.join(tempfile.mkdtemp(), 'cookie'), 0.5, rate_limiter=ratelimit.HostRateLimiter(),
+                metrics=metrics.MetricsHooks(broken, events.append)
+            )
+            connector.get(url)
+            connector.get(url)
+            webarchiver.url_download(url, io.BytesIO(), metrics=events.append)
+        finally:
+            server.server_cleanup()
+
+        self.assertEqual(
+            [(event['type'], event['status_code'], event['error']) for event in events],
+            [('request', 200, None), ('request', 200, None), ('download', 200, None)]
+        )
+        # the second request waits for the interval of the host
+        self.assertGreaterEqual(events[1]['delay'], 0.4)
+        self.assertEqual(events[1]['bytes'], len('token=secret'))
+        self.assertTrue(all(event['total'] >= event['ttfb'] >= 0 for event in events))
+
+        # errors of the callables are logged
+        with self.assertLogs('webarchiver.metrics', 'ERROR'):
+            metrics.emit(broken, metrics.create_event('request', url))
+
+
+@unittest.skipIf(aio is None, 'requires python 3 and aiohttp')
+class TestAsyncRequestsConnector(unittest.TestCase):
+    """
+    Testing aio.AsyncRequestsConnector
+    """
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = get_http_test_server_thread(CookieHandler)
+        if not cls.server.is_alive():
+            cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server.is_alive():
+            cls.server.server_cleanup()
+
+    def test(self):
+        import asyncio
+
+        test_server = 'http://%s:%s' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        cookie_file = os.path.join(tempfile.mkdtemp(), 'test_cookie.cookie')
+
+        async def crawl():
+            async with aio.AsyncRequestsConnector(cookie_file, 0) as connector:
+                await connector.get(test_server + '/login')
+                pages = await connector.gather([test_server + '/%d' % i for i in range(5)])
+                connector.save_cookie(ignore_discard=True)
+                return pages
+
+        self.assertEqual(asyncio.run(crawl()), ['token=secret'] * 5)
+
+        # cookies are saved in LWP format, and readable by RequestsConnector
+        connector = connectors.RequestsConnector(cookie_file, 0)
+        connector.load_cookie(ignore_discard=True)
+        self.assertEqual(connector.get_cookie('token'), 'secret')
+
+
+class ScriptPageHandler(BaseHTTPRequestHandler):
+    """
+    Serves a static page at '/static', a short 404 page at '/missing', and a page rendered by scripts
+    at the other paths.
+    """
+    def do_GET(self):
+        self.send_response(404 if self.path == '/missing' else 200)
+        self.send_header('Content-type', 'text/html')
+        self.end_headers()
+        if self.path == '/missing':
+            body = '<html><body>Not found</body></html>'
+        elif self.path == '/static':
+            body = '<html><body><p>%s</p></body></html>' % ('static text ' * 20)
+        else:
+            body = '<html><body><div id="root"></div><script src="/app.js"></script></body></html>'
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHybridConnector(unittest.TestCase):
+    """
+    Testing hybrid.HybridConnector with a browser double, since PhantomJS may not be installed.
+    """
+
+    class DummyBrowser(object):
+        def __init__(self):
+            self.urls = []
+            self.disconnected = False
+
+        def get(self, url, params=None, headers=None):
+            self.urls.append(url)
+            return 'rendered'
+
+        def disconnect(self):
+            self.disconnected = True
+
+    def test_detector(self):
+        detector = hybrid.BrowserDetector(min_text_length=10)
+        self.assertFalse(detector('http://a.com/', '<p>enough visible text</p><script>var a = 1;</script>'))
+        self.assertTrue(detector('http://a.com/', '<p>short</p><script>render("long long text");</script>'))
+        self.assertTrue(detector('http://a.com/', '<noscript>Please enable JavaScript.</noscript>' + 'x' * 20))
+        self.assertTrue(hybrid.BrowserDetector(0, required_patterns=['class="gallery"'])('http://a.com/', '<p></p>'))
+
+    def test_escalation(self):
+        server = get_http_test_server_thread(ScriptPageHandler)
+        server.start()
+        try:
+            test_server = 'http://%s:%s' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+            browser = self.DummyBrowser()
+            connector = hybrid.HybridConnector(
+                connectors.RequestsConnector(os.path.join(tempfile.mkdtemp(), 'cookie'), 0),
+                browser_factory=lambda: browser
+            )
+
+            self.assertIn('static text', connector.get(test_server + '/static'))
+            self.assertEqual(connector.get_engine(test_server + '/'), hybrid.REQUESTS)
+
+            self.assertEqual(connector.get(test_server + '/app', params={'page': 2}), 'rendered')
+            self.assertEqual(connector.get_engine(test_server + '/'), hybrid.BROWSER)
+
+            # the host is known to need the browser
+            self.assertEqual(connector.get(test_server + '/static'), 'rendered')
+            self.assertEqual(browser.urls, [test_server + '/app?page=2', test_server + '/static'])
+            self.assertEqual(connector.stats, {hybrid.REQUESTS: 1, hybrid.BROWSER: 2, 'escalated': 1})
+
+            connector.disconnect()
+            self.assertTrue(browser.disconnected)
+
+            # error pages decide nothing, and decisions expire
+            browser = self.DummyBrowser()
+            connector = hybrid.HybridConnector(
+                connectors.RequestsConnector(os.path.join(tempfile.mkdtemp(), 'cookie'), 0),
+                browser_factory=lambda: browser, engine_ttl=0.2
+            )
+            self.assertIn('Not found', connector.get(test_server + '/missing'))
+            self.assertIsNone(connector.get_engine(test_server + '/'))
+
+            self.assertEqual(connector.get(test_server + '/app'), 'rendered')
+            self.assertEqual(connector.get_engine(test_server + '/'), hybrid.BROWSER)
+            time.sleep(0.3)
+            self.assertIsNone(connector.get_engine(test_server + '/'))
+            self.assertIn('static text', connector.get(test_server + '/static'))
+            self.assertEqual(connector.get_engine(test_server + '/'), hybrid.REQUESTS)
+            self.assertEqual(connector.stats, {hybrid.REQUESTS: 2, hybrid.BROWSER: 1, 'escalated': 1})
+        finally:
+            server.server_cleanup()
+
+
+class TestConnectorPool(unittest.TestCase):
+    """
+    Testing pool.ConnectorPool with a connector double, since PhantomJS may not be installed.
+    """
+
+    class DummyConnector(object):
+        created = 0
+
+        def __init__(self):
+            self.__class__.created += 1
+            self.alive = True
+            self.disconnected = False
+
+        def disconnect(self):
+            self.disconnected = True
+
+    def factory(self):
+        return self.DummyConnector()
+
+    def test_reuse_and_recycle(self):
+        connector_pool = pool.ConnectorPool(self.factory, max_size=2, max_uses=2, health_check=lambda c: c.alive)
+
+        first = connector_pool.checkout()
+        connector_pool.checkin(first)
+        self.assertIs(connector_pool.checkout(), first)
+
+        # used max_uses times
+        connector_pool.checkin(first)
+        self.assertTrue(first.disconnected)
+
+        # crashed connectors are not handed out
+        second = connector_pool.checkout()
+        connector_pool.checkin(second)
+        second.alive = False
+        third = connector_pool.checkout()
+        self.assertIsNot(third, second)
+        self.assertTrue(second.disconnected)
+
+        # errors inside connector() recycle the connector
+        connector_pool.checkin(third)
+        with self.assertRaises(ValueError):
+            with connector_pool.connector() as connector:
+                raise ValueError()
+        self.assertTrue(connector.disconnected)
+        self.assertEqual(connector_pool.size, 0)
+
+    def test_max_size_and_close(self):
+        connector_pool = pool.ConnectorPool(self.factory, max_size=1, max_idle=0.05, health_check=None)
+
+        first = connector_pool.checkout()
+        with self.assertRaises(pool.PoolTimeout):
+            connector_pool.checkout(timeout=0.05)
+        connector_pool.checkin(first)
+
+        time.sleep(0.1)
+        self.assertEqual(connector_pool.reap(), 1)
+        self.assertTrue(first.disconnected)
+
+        second = connector_pool.checkout()
+        connector_pool.checkin(second)
+        connector_pool.close()
+        self.assertTrue(second.disconnected)
+        with self.assertRaises(pool.PoolClosed):
+            connector_pool.checkout()
+
+    def test_reaper(self):
+        connector_pool = pool.ConnectorPool(self.factory, max_idle=0.05, health_check=None, reap_interval=0.02)
+        connector = connector_pool.checkout()
+        connector_pool.checkin(connector)
+
+        # reaped without another checkout
+        deadline = time.time() + 5
+        while not connector.disconnected and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertTrue(connector.disconnected)
+        self.assertEqual(connector_pool.size, 0)
+
+        connector_pool.close()
+        connector_pool._reaper.join(1)
+        self.assertFalse(connector_pool._reaper.is_alive())
+
+
 class TestConnectorMixin(unittest.TestCase):
     """
     Testing connectors.ConnectorMixin
@@ -329,11 +1469,450 @@ class TestConnectorsUserAgents(unittest.TestCase):
         connector.disconnect()
 
 
+class CookieHandler(BaseHTTPRequestHandler):
+    """
+    Sets a cookie at '/login', deletes it at '/logout', sets it and redirects to '/' at '/redirect',
+    and echoes the request cookie header at the other paths.
+    """
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/')
+            self.send_header('Set-Cookie', 'token=redirected; Path=/')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        if self.path == '/login':
+            self.send_header('Set-Cookie', 'token=secret; Path=/')
+        elif self.path == '/logout':
+            self.send_header('Set-Cookie', 'token=; Path=/; Max-Age=0')
+        self.end_headers()
+        self.wfile.write((self.headers.get('cookie') or '').encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
 class TestRequestsConnectorCookie(unittest.TestCase):
     """
     Test RequestConnector's cookie settings.
     """
-    pass
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = get_http_test_server_thread(CookieHandler)
+        if not cls.server.is_alive():
+            cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server.is_alive():
+            cls.server.server_cleanup()
+
+    def test_shared_session(self):
+        """
+        Connectors sharing a session do not share their cookies.
+        """
+        test_server = 'http://%s:%s' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        cookie_file = os.path.join(tempfile.mkdtemp(), 'test_cookie.cookie')
+        session = sessions.create_session(pool_maxsize=2)
+
+        logged_in = connectors.RequestsConnector(cookie_file, 0, session=session)
+        anonymous = connectors.RequestsConnector(cookie_file, 0, session=session)
+
+        logged_in.get(test_server + '/login')
+        self.assertEqual(logged_in.get(test_server + '/'), 'token=secret')
+        self.assertEqual(anonymous.get(test_server + '/'), '')
+        self.assertEqual(len(session.cookies), 0)
+
+    def test_pooled_session(self):
+        """
+        More workers than the default pool_maxsize get a session keeping a connection for each.
+        """
+        default = sessions.get_default_session()
+        self.assertIs(sessions.get_pooled_session(10), default)
+        session = sessions.get_pooled_session(32)
+        self.assertIsNot(session, default)
+        self.assertEqual(session.get_adapter('http://')._pool_maxsize, 32)
+
+    def test_cookie_store(self):
+        """
+        Connectors opening the same store share the cookies written as they arrive.
+        """
+        test_server = 'http://%s:%s' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+        temp_dir = tempfile.mkdtemp()
+        store_path = os.path.join(temp_dir, 'cookies.sqlite')
+
+        logged_in = connectors.RequestsConnector(None, 0, cookie_store=cookiestore.CookieStore(store_path))
+        logged_in.get(test_server + '/login')
+
+        # e.g. in another process
+        store = cookiestore.CookieStore(store_path)
+        connector = connectors.RequestsConnector(None, 0, cookie_store=store)
+        self.assertIsNone(connector.get_cookie('token'))
+        self.assertEqual(connector.get(test_server + '/'), 'token=secret')
+        self.assertEqual(store.get_cookies('example.com'), [])
+
+        # changes of the store are read again, including deletions
+        logged_in.get(test_server + '/logout')
+        self.assertEqual(logged_in.get(test_server + '/'), '')
+        self.assertEqual(connector.get(test_server + '/'), '')
+        logged_in.get(test_server + '/login')
+        self.assertEqual(connector.get(test_server + '/'), 'token=secret')
+
+        # responses without cookies do not write the store, and cookies of redirects are kept
+        version = store.version
+        connector.get(test_server + '/')
+        self.assertEqual(store.version, version)
+        self.assertEqual(connector.get(test_server + '/redirect'), 'token=redirected')
+        self.assertEqual(logged_in.get(test_server + '/'), 'token=redirected')
+        logged_in.get(test_server + '/login')
+
+        # LWP import and export
+        lwp_path = os.path.join(temp_dir, 'cookie.txt')
+        store.export_lwp(lwp_path)
+        connector = connectors.RequestsConnector(lwp_path, 0)
+        connector.load_cookie(ignore_discard=True)
+        self.assertEqual(connector.get_cookie('token'), 'secret')
+        connector.set_cookie('expired', 'yes', domain='example.com', expires=1)
+        connector.set_cookie('visited', 'yes', domain='.example.com', expires=int(time.time()) + 60, discard=False)
+        connector.save_cookie(ignore_discard=True, ignore_expires=True)
+
+        store.delete()
+        self.assertEqual(store.import_lwp(lwp_path, ignore_expires=True), 2)
+        self.assertEqual([c.name for c in store.get_cookies('www.example.com')], ['visited'])
+        self.assertEqual(store.prune(session_cookies=True), 1)
+        self.assertEqual(len(store), 1)
+
+
+class TestLazyResponse(unittest.TestCase):
+    """
+    Testing RequestsConnector.fetch()
+    """
+    def test_encoding(self):
+        def create_response(content, content_type=None):
+            response = requests.Response()
+            response._content = content
+            if content_type:
+                response.headers['Content-Type'] = content_type
+                response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+            return response
+
+        text = u'\uc548\ub155 <b>hello</b>'
+        self.assertEqual(connectors.get_response_encoding(create_response(b'', 'text/html; charset=EUC-KR')), 'EUC-KR')
+        self.assertEqual(
+            connectors.get_response_encoding(create_response(b'<meta charset="euc-kr">' + text.encode('euc-kr'))),
+            'euc_kr'
+        )
+        self.assertEqual(connectors.get_response_encoding(create_response(text.encode('utf-8'))), 'utf-8')
+        self.assertEqual(connectors.get_response_text(create_response(text.encode('utf-8'))), text)
+        self.assertEqual(connectors.get_response_text(create_response(b'')), '')
+
+    def test_fetch(self):
+        server = get_http_test_server_thread(RangeHandler)
+        server.start()
+        try:
+            test_server = 'http://%s:%s' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+            connector = connectors.RequestsConnector(None, 0)
+
+            with connector.fetch(test_server + '/', stream=True) as response:
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(b''.join(response.iter_content(1000)), RangeHandler.payload)
+                # the streamed body is not kept
+                self.assertTrue(response.consumed)
+                self.assertEqual(response.text, '')
+                self.assertEqual(connector.last_content, '')
+            self.assertEqual(response.content, b'')
+
+            response = connector.fetch(test_server + '/')
+            self.assertEqual(response.content, RangeHandler.payload)
+            self.assertEqual(b''.join(response.iter_content(1000)), RangeHandler.payload)
+            self.assertEqual(connector.last_content, response.text)
+            response.release()
+            self.assertEqual(response.content, b'')
+
+            self.assertIsInstance(connector.get(test_server + '/'), type(u''))
+        finally:
+            server.server_cleanup()
+
+
+class TestBrowserConnector(unittest.TestCase):
+    """
+    Testing browsers.BrowserConnector
+    """
+    def test_cookie_conversion(self):
+        jar = requests.cookies.RequestsCookieJar()
+        jar.set('token', 'secret', domain='.example.com', path='/', expires=2000000000, rest={'HttpOnly': None})
+        jar.set('session', 'abc', domain='example.com', path='/')
+        domain_cookie, host_cookie = sorted(jar, key=lambda c: c.name, reverse=True)
+
+        item = browsers.to_webdriver_cookie(domain_cookie)
+        self.assertEqual(item, {
+            'name': 'token', 'value': 'secret', 'path': '/', 'secure': False, 'domain': '.example.com',
+            'expiry': 2000000000, 'httpOnly': True,
+        })
+        cookie = browsers.from_webdriver_cookie(item, 'www.example.com')
+        self.assertEqual((cookie.name, cookie.value, cookie.domain, cookie.expires), (
+            'token', 'secret', '.example.com', 2000000000
+        ))
+        self.assertTrue(cookie.has_nonstandard_attr('HttpOnly'))
+
+        host_cookie.domain_specified = False
+        item = browsers.to_webdriver_cookie(host_cookie)
+        self.assertNotIn('domain', item)
+        cookie = browsers.from_webdriver_cookie(item, 'example.com:8080')
+        self.assertEqual(cookie.domain, 'example.com')
+        self.assertFalse(cookie.domain_specified)
+        self.assertTrue(cookie.discard)
+
+    class Driver(object):
+        """
+        WebDriver of a browser without DevTools, loading pages at once
+        """
+        def __init__(self):
+            self.current_window_handle = 'tab-0'
+            self.window_handles = ['tab-0']
+            self.urls = {'tab-0': 'about:blank'}
+            self.loaded = []
+            self.cookies = {}  # host: cookie items
+            self.switch_to = self
+
+        def window(self, handle):
+            self.current_window_handle = handle
+
+        def execute_script(self, script, *args):
+            if 'window.open' in script:
+                handle = 'tab-%d' % len(self.window_handles)
+                self.window_handles.append(handle)
+                self.urls[handle] = 'about:blank'
+            elif 'window.location.href' in script:
+                self.get(args[0])
+            return True
+
+        def get(self, url):
+            self.urls[self.current_window_handle] = url
+            self.loaded.append(url)
+
+        @property
+        def current_url(self):
+            return self.urls[self.current_window_handle]
+
+        @property
+        def page_source(self):
+            return '<html>%s %s</html>' % (self.current_url, sorted(c['value'] for c in self.get_cookies()))
+
+        def add_cookie(self, item):
+            self.cookies.setdefault(workers.get_host(self.current_url), []).append(item)
+
+        def get_cookies(self):
+            return self.cookies.get(workers.get_host(self.current_url), [])
+
+        def quit(self):
+            pass
+
+    class ChromeDriver(Driver):
+        def __init__(self):
+            TestBrowserConnector.Driver.__init__(self)
+            self.cdp = []
+
+        def execute_cdp_cmd(self, cmd, item):
+            self.cdp.append((cmd, item))
+
+    def test_tabs(self):
+        browser = browsers.Browser('fake', max_tabs=2, driver_factory=self.Driver)
+        first = browsers.BrowserConnector(browser, poll_interval=0.01)
+        second = browsers.BrowserConnector(browser, poll_interval=0.01)
+        self.assertEqual((first.handle, second.handle), ('tab-0', 'tab-1'))
+        self.assertRaises(RuntimeError, browsers.BrowserConnector, browser)
+
+        self.assertIn('http://example.com/1', first.get('http://example.com/1'))
+        self.assertIn('http://example.com/2', second.get('http://example.com/2'))
+        self.assertEqual(first.last_url, 'http://example.com/1')
+
+        # the tab is blank, and given to the next connector
+        second.disconnect()
+        self.assertEqual(browser.driver.urls['tab-1'], 'about:blank')
+        self.assertEqual(browsers.BrowserConnector(browser).handle, 'tab-1')
+        browser.close()
+        self.assertFalse(browser.is_alive())
+
+    def test_set_cookies(self):
+        browser = browsers.Browser('fake', driver_factory=self.Driver)
+        driver = browser.driver
+        jar = requests.cookies.RequestsCookieJar()
+        jar.set('token', 'secret', domain='example.com', path='/')
+
+        # no cookies yet, e.g. before a login by HTTP
+        self.assertFalse(browser.set_cookies('tab-0', 'http://example.com/', []))
+        self.assertTrue(browser.set_cookies('tab-0', 'http://example.com/', list(jar)))
+        self.assertEqual(driver.loaded, ['http://example.com/robots.txt'])
+        self.assertEqual([c['value'] for c in driver.cookies['example.com']], ['secret'])
+        self.assertFalse(browser.set_cookies('tab-0', 'http://example.com/', list(jar)))
+
+        # changed in the jar or the store
+        jar.set('token', 'renewed', domain='example.com', path='/')
+        self.assertTrue(browser.set_cookies('tab-0', 'http://example.com/', list(jar)))
+        self.assertEqual(len(driver.loaded), 2)
+
+        browser = browsers.Browser('fake', driver_factory=self.ChromeDriver)
+        self.assertTrue(browser.set_cookies('tab-0', 'http://example.com/a', list(jar)))
+        self.assertEqual(browser.driver.loaded, [])
+        self.assertEqual(browser.driver.cdp, [('Network.setCookie', {
+            'name': 'token', 'value': 'renewed', 'path': '/', 'secure': False, 'domain': 'example.com',
+            'httpOnly': True, 'url': 'http://example.com/a',
+        })])
+
+    def test_store_cookies(self):
+        browser = browsers.Browser('fake', driver_factory=self.Driver)
+        store = cookiestore.CookieStore(os.path.join(tempfile.mkdtemp(), 'cookies.sqlite'))
+        connector = browsers.BrowserConnector(browser, cookie_store=store, poll_interval=0.01)
+        self.assertNotIn('secret', connector.get('http://example.com/'))
+
+        # logged in by HTTP after the first page
+        jar = requests.cookies.RequestsCookieJar()
+        jar.set('token', 'secret', domain='example.com', path='/')
+        store.set_cookies(jar)
+        self.assertIn('secret', connector.get('http://example.com/'))
+        browser.close()
+
+    @unittest.skipIf(which('chromedriver') is None, 'requires chromedriver')
+    def test_shared_cookies(self):
+        server = get_http_test_server_thread(CookieHandler)
+        server.start()
+        browser = browsers.Browser('chrome', max_tabs=2, service_log_path=os.devnull)
+        try:
+            test_server = 'http://%s:%s' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+            store = cookiestore.CookieStore(os.path.join(tempfile.mkdtemp(), 'cookies.sqlite'))
+
+            # logged in by HTTP
+            connectors.RequestsConnector(None, 0, cookie_store=store).get(test_server + '/login')
+
+            first = browsers.BrowserConnector(browser, cookie_store=store)
+            second = browsers.BrowserConnector(browser, cookie_store=store)
+            self.assertIn('token=secret', first.get(test_server + '/'))
+            self.assertIn('token=secret', second.get(test_server + '/1'))
+            self.assertRaises(RuntimeError, browsers.BrowserConnector, browser)
+
+            second.disconnect()
+            browsers.BrowserConnector(browser).disconnect()
+        finally:
+            browser.close()
+            server.server_cleanup()
+
+
+class TestWaits(unittest.TestCase):
+    """
+    Testing waits module
+    """
+    class Driver(object):
+        def __init__(self, elements, results=()):
+            self.elements = elements
+            self.results = list(results)  # results of execute_script()
+            self.scripts = []
+
+        def find_elements_by_css_selector(self, selector):
+            return self.elements.get(selector, [])
+
+        def execute_script(self, script, *args):
+            self.scripts.append((script, args))
+            return self.results.pop(0)
+
+    def test_conditions(self):
+        driver = self.Driver({'#list': ['list'], '.item': ['a', 'b']})
+        missing = waits.selectors('.empty')
+
+        self.assertEqual(waits.selectors('.empty', '#list')(driver), ['list'])
+        self.assertFalse(waits.selectors('.empty', '#list', match_all=True)(driver))
+        self.assertEqual(waits.selectors('#list', '.item', match_all=True)(driver), ['list', 'a', 'b'])
+        self.assertRaises(TypeError, waits.selectors, '#list', any=True)
+
+        self.assertEqual(waits.any_of(missing, waits.selectors('.item'))(driver), ['a', 'b'])
+        self.assertFalse(waits.any_of(missing)(driver))
+        self.assertFalse(waits.all_of(waits.selectors('#list'), missing)(driver))
+        self.assertEqual(waits.all_of(waits.selectors('#list'), waits.selectors('.item'))(driver), ['a', 'b'])
+
+    def test_scripts(self):
+        driver = self.Driver({}, [False, True, True])
+
+        self.assertFalse(waits.network_idle(0.5)(driver))
+        self.assertTrue(waits.network_idle(2)(driver))
+        self.assertTrue(waits.dom_quiet(0.25)(driver))
+        self.assertEqual(driver.scripts, [
+            (waits.network_idle_script, (500,)), (waits.network_idle_script, (2000,)),
+            (waits.dom_quiet_script, (250,)),
+        ])
+        self.assertIn('setResourceTimingBufferSize', waits.network_idle_script)
+        self.assertIn('XMLHttpRequest', waits.network_idle_script)
+
+    def test_profiles(self):
+        condition = waits.selectors('.result')
+        profiles = waits.WaitProfiles([
+            (r'/search\?', 20, condition),
+            (r'\.png$', 5, None),
+        ], default=(10, None))
+
+        self.assertEqual(profiles.get('http://example.com/search?q=tea'), (20, condition))
+        self.assertEqual(profiles.get('http://example.com/a.PNG'), (5, None))
+        self.assertEqual(profiles.get('http://example.com/'), (10, None))
+
+
+class TestShardedRunner(unittest.TestCase):
+    """
+    Testing sharding.ShardedRunner
+    """
+    def test(self):
+        server = get_http_test_server_thread(CookieHandler)
+        server.start()
+        try:
+            test_server = 'http://%s:%s' % (TEST_SERVER_ADDRESS[0], TEST_SERVER_ADDRESS[1])
+            runner = sharding.ShardedRunner(tempfile.mkdtemp(), processes=2, threads=2, delay=0)
+
+            # logged in before the run
+            store = cookiestore.CookieStore(runner.cookie_path)
+            connectors.RequestsConnector(None, 0, cookie_store=store).get(test_server + '/login')
+            store.close()
+
+            urls = [test_server + '/%d' % i for i in range(4)]
+            self.assertEqual(runner.run(urls), [(url, 'token=secret', None) for url in urls])
+        finally:
+            server.server_cleanup()
+
+    def test_get_shard(self):
+        self.assertEqual(sharding.get_shard('http://example.com/a', 4), sharding.get_shard('http://example.com/b', 4))
+        self.assertEqual(len(set(sharding.get_shard('http://%d.example.com/' % i, 4) for i in range(40))), 4)
+
+
+class TestResourceFilter(unittest.TestCase):
+    """
+    Test connectors.ResourceFilter
+    """
+    def test_is_blocked(self):
+        resource_filter = connectors.ResourceFilter(
+            block_types=('image', 'font'),
+            deny_patterns=(r'/track\.js',),
+            deny_hosts=('ads.example.com',),
+        )
+
+        self.assertTrue(resource_filter.blocks_images)
+        self.assertTrue(resource_filter.is_blocked('http://example.com/logo.PNG?v=1'))
+        self.assertTrue(resource_filter.is_blocked('http://example.com/fonts/a.woff2'))
+        self.assertTrue(resource_filter.is_blocked('http://example.com/track.js'))
+        self.assertTrue(resource_filter.is_blocked('http://cdn.ads.example.com/banner'))
+        self.assertFalse(resource_filter.is_blocked('http://example.com/app.js'))
+        self.assertFalse(resource_filter.is_blocked('http://example.com/style.css'))
+
+    def test_allow_hosts(self):
+        resource_filter = connectors.ResourceFilter(allow_hosts=('example.com',))
+
+        self.assertFalse(resource_filter.blocks_images)
+        self.assertFalse(resource_filter.is_blocked('http://static.example.com:8080/a.png'))
+        self.assertTrue(resource_filter.is_blocked('http://badexample.com/a.png'))
+
+    def test_unknown_type(self):
+        with self.assertRaises(ValueError):
+            connectors.ResourceFilter(block_types=('images',))
 
 
 class TestPhantomjsFactoryMixinWaits(unittest.TestCase):
@@ -0,0 +1,209 @@
+"""
+Readiness conditions for rendered pages, to return as soon as a page is ready.
+
+A condition is a callable taking the WebDriver, like those of selenium's expected_conditions,
+for until_condition of PhantomJSConnector and BrowserConnector:
+
+    connector = phantomjs_factory(until_condition=all_of(network_idle(0.5), any_of(selectors('#list', '.empty'))))
+
+WaitProfiles picks the wait and the condition by url patterns:
+
+    profiles = WaitProfiles([
+        (r'/search\\?', 20, all_of(dom_quiet(0.5), selectors('.result'))),
+        (r'\\.(png|jpe?g)$', 5, None),
+    ], default=(10, network_idle()))
+    connector = phantomjs_factory(wait_profiles=profiles)
+
+network_idle() and dom_quiet() keep their state in the page, so a condition may be shared by connectors and pages.
+"""
+from __future__ import absolute_import
+
+from re import (
+    IGNORECASE,
+    compile as re_compile,
+)
+
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    StaleElementReferenceException,
+)
+
+
+def _is_met(condition, driver):
+    try:
+        return condition(driver)
+    except (NoSuchElementException, StaleElementReferenceException):
+        return False
+
+
+def all_of(*conditions):
+    """
+    :return: condition met when all conditions are met. The result of the last one is returned
+    """
+    def condition(driver):
+        result = True
+        for item in conditions:
+            result = _is_met(item, driver)
+            if not result:
+                return False
+        return result
+    return condition
+
+
+def any_of(*conditions):
+    """
+    :return: condition met when one of conditions is met. The first result is returned
+    """
+    def condition(driver):
+        for item in conditions:
+            result = _is_met(item, driver)
+            if result:
+                return result
+        return False
+    return condition
+
+
+def selectors(*css_selectors, **kwargs):
+    """
+    :param css_selectors: CSS selectors
+    :param match_all:     keyword only. If True, every selector must match an element. One is enough by default
+    :return:              condition returning the matched elements
+    """
+    match_all = kwargs.pop('match_all', False)
+    if kwargs:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kwargs))
+
+    def condition(driver):
+        found = []
+        for selector in css_selectors:
+            elements = driver.find_elements_by_css_selector(selector)
+            if elements and not match_all:
+                return elements
+            if not elements and match_all:
+                return False
+            found.extend(elements)
+        return found or False
+    return condition
+
+
+def document_complete():
+    """
+    :return: condition met when document.readyState is 'complete'
+    """
+    def condition(driver):
+        return driver.execute_script('return document.readyState === "complete";')
+    return condition
+
+
+network_idle_script = """
+    var now = Date.now();
+    var state = window.webarchiverNetwork;
+    if (!state) {
+        state = window.webarchiverNetwork = {pending: 0, resources: -1, changedAt: now};
+        var change = function (count) {
+            state.pending += count;
+            state.changedAt = Date.now();
+        };
+        var done = function () {
+            change(-1);
+        };
+        if (window.performance && performance.setResourceTimingBufferSize) {
+            performance.setResourceTimingBufferSize(100000);
+        }
+        if (window.XMLHttpRequest) {
+            var send = XMLHttpRequest.prototype.send;
+            XMLHttpRequest.prototype.send = function () {
+                change(1);
+                this.addEventListener('loadend', done);
+                try {
+                    return send.apply(this, arguments);
+                } catch (e) {
+                    done();
+                    throw e;
+                }
+            };
+        }
+        if (window.fetch) {
+            var fetch = window.fetch;
+            window.fetch = function () {
+                change(1);
+                try {
+                    var result = fetch.apply(this, arguments);
+                } catch (e) {
+                    done();
+                    throw e;
+                }
+                result.then(done, done);
+                return result;
+            };
+        }
+    }
+    var entries = window.performance && performance.getEntriesByType ? performance.getEntriesByType('resource') : [];
+    if (state.resources !== entries.length) {
+        state.resources = entries.length;
+        state.changedAt = now;
+    }
+    return document.readyState === 'complete' && state.pending <= 0 && now - state.changedAt >= arguments[0];
+"""
+
+
+def network_idle(idle=0.5):
+    """
+    :param idle: seconds without network activity
+    :return:     condition met when the document is loaded, no XMLHttpRequest or fetch() is in flight,
+                 and no request has started or finished for idle seconds.
+
+    Finished resources are counted by the Resource Timing API, whose buffer is enlarged at the first check.
+    Requests are tracked in flight from the first check only: a request started before it counts once it
+    finishes. Without the Resource Timing API, as in old engines, resources loaded by the document itself
+    are not seen, and the condition waits idle seconds after the first check and the last tracked request.
+    """
+    def condition(driver):
+        return driver.execute_script(network_idle_script, int(idle * 1000))
+    return condition
+
+
+dom_quiet_script = """
+    var now = Date.now();
+    if (!window.webarchiverMutatedAt) {
+        window.webarchiverMutatedAt = now;
+        new MutationObserver(function () {
+            window.webarchiverMutatedAt = Date.now();
+        }).observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+    }
+    return now - window.webarchiverMutatedAt >= arguments[0];
+"""
+
+
+def dom_quiet(quiet=0.5):
+    """
+    :param quiet: seconds without a change of the document
+    :return:      condition met when the document has not changed for quiet seconds since the first check
+    """
+    def condition(driver):
+        return driver.execute_script(dom_quiet_script, int(quiet * 1000))
+    return condition
+
+
+class WaitProfiles(object):
+    """
+    Waits and conditions by url patterns. The first matching pattern wins.
+    """
+
+    def __init__(self, profiles=(), default=(10, None)):
+        """
+        :param profiles: list of (url pattern, wait, condition). A regular expression searched in the url.
+                         condition may be None not to wait after the page is loaded
+        :param default:  (wait, condition) of the other urls
+        """
+        self.profiles = [(re_compile(pattern, IGNORECASE), wait, condition) for pattern, wait, condition in profiles]
+        self.default = default
+
+    def get(self, url):
+        """
+        :return: (wait, condition) of url
+        """
+        for expr, wait, condition in self.profiles:
+            if expr.search(url):
+                return wait, condition
+        return self.default
@@ -0,0 +1,465 @@
+"""
+WARC output of fetched pages and downloads.
+
+    with WarcWriter('/data/warc', max_size=1024 ** 3) as warc:
+        connector = RequestsConnector(cookie_file, warc=warc)
+        connector.get('http://example.com/')
+        archive_remote_urls(download_path, title, urls, warc=warc)
+
+    record = warc.get('http://example.com/')
+    record.status_code, record.http_headers, record.payload
+
+Files are named <prefix>-00000.warc.gz, <prefix>-00001.warc.gz, ..., and a new file is started when the current one
+exceeds max_size. Each record is a separate gzip member. Every file begins with a warcinfo record.
+RequestsConnector and url_download write a response record and its request record. PhantomJSConnector writes
+the rendered page as a resource record.
+
+Bodies are written as requests decodes them: Content-Encoding is removed, and the headers are adjusted to match.
+
+The locations of the records are kept in <directory>/index.sqlite, so a record is read by url without scanning
+the files. export_cdx() writes the index as a CDX file.
+"""
+from __future__ import absolute_import
+
+import sqlite3
+import zlib
+
+from base64 import b32encode
+from datetime import datetime
+from gzip import GzipFile
+from hashlib import sha1
+from io import BytesIO
+from os import (
+    listdir,
+    makedirs,
+)
+from os.path import (
+    exists as path_exists,
+    join as path_join,
+)
+from re import compile as re_compile
+from threading import Lock
+from uuid import uuid4
+
+# noinspection PyUnresolvedReferences
+from six.moves.urllib.parse import urlsplit
+
+WARC_VERSION = 'WARC/1.0'
+
+# headers describing the encoded body, which requests has decoded
+hop_headers = ('content-encoding', 'transfer-encoding', 'content-length', 'connection', 'keep-alive')
+
+http_versions = {10: 'HTTP/1.0', 11: 'HTTP/1.1', 20: 'HTTP/2'}
+
+
+def get_warc_date(timestamp=None):
+    return (timestamp or datetime.utcnow()).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def get_digest(parts):
+    """
+    :return: sha1 digest in the WARC format, 'sha1:<base32>'
+    """
+    digest = sha1()
+    for chunk in iter_parts(parts):
+        digest.update(chunk)
+    return 'sha1:' + b32encode(digest.digest()).decode('ascii')
+
+
+def iter_parts(parts, chunk_size=65536):
+    """
+    :param parts: list of bytes and seekable file-like objects
+    """
+    for part in parts:
+        if isinstance(part, bytes):
+            yield part
+        else:
+            part.seek(0)
+            for chunk in iter(lambda: part.read(chunk_size), b''):
+                yield chunk
+
+
+def get_parts_length(parts):
+    length = 0
+    for part in parts:
+        if isinstance(part, bytes):
+            length += len(part)
+        else:
+            part.seek(0, 2)
+            length += part.tell()
+    return length
+
+
+def get_url_key(url):
+    """
+    CDX url key: host without 'www.', reversed and comma separated unless it is an IP address, the port if any,
+    then ')' and the path with the query. 'http://www.example.com:8080/a?b=1' is 'com,example:8080)/a?b=1'
+    """
+    parts = urlsplit(url)
+    host = parts.hostname or ''
+    if host.startswith('www.'):
+        host = host[4:]
+    if not host.replace('.', '').isdigit():
+        host = ','.join(reversed(host.split('.')))
+    if parts.port:
+        host += ':%d' % parts.port
+    key = host + ')' + (parts.path or '/')
+    if parts.query:
+        key += '?' + parts.query
+    return key.lower()
+
+
+def format_http_headers(first_line, headers):
+    lines = [first_line] + ['%s: %s' % (k, v) for k, v in headers]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1', 'replace')
+
+
+class WarcRecord(object):
+    """
+    A record read from a WARC file.
+    """
+
+    status_expr = re_compile(r'^HTTP/\S+\s+(\d+)')
+
+    def __init__(self, headers, block):
+        """
+        :param headers: list of (name, value) of the WARC header
+        :param block:   record block bytes
+        """
+        self.headers = headers
+        self.block = block
+
+        self.status_code = None
+        self.http_headers = []
+        self.payload = block
+
+        if self.get_header('content-type', '').startswith('application/http'):
+            head, _, self.payload = block.partition(b'\r\n\r\n')
+            lines = head.decode('iso-8859-1').split('\r\n')
+            match = self.status_expr.match(lines[0])
+            if match:
+                self.status_code = int(match.group(1))
+            self.http_headers = [tuple(v.strip() for v in line.split(':', 1)) for line in lines[1:] if ':' in line]
+
+    def get_header(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    @property
+    def record_type(self):
+        return self.get_header('warc-type')
+
+    @property
+    def url(self):
+        return self.get_header('warc-target-uri')
+
+
+def read_record(path, offset, length=None):
+    """
+    read a record at offset of a WARC file, compressed or not.
+    :param path:   WARC file path
+    :param offset: record offset
+    :param length: record length in the file. Read from the record header if None
+    :return:       WarcRecord
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        if path.endswith('.gz'):
+            if length is not None:
+                data = zlib.decompress(f.read(length), 16 + zlib.MAX_WBITS)
+            else:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                chunks = []
+                while not decompressor.unused_data:
+                    chunk = f.read(65536)
+                    if not chunk:
+                        break
+                    chunks.append(decompressor.decompress(chunk))
+                data = b''.join(chunks)
+            return parse_record(BytesIO(data))
+        return parse_record(f)
+
+
+def parse_record(f):
+    """
+    :param f: file-like object positioned at the start of a record
+    :return:  WarcRecord
+    """
+    header_lines = []
+    while True:
+        line = f.readline()
+        if not line or line in (b'\r\n', b'\n'):
+            break
+        header_lines.append(line.decode('utf-8').rstrip('\r\n'))
+
+    headers = [tuple(v.strip() for v in line.split(':', 1)) for line in header_lines[1:] if ':' in line]
+    length = [int(v) for k, v in headers if k.lower() == 'content-length']
+    return WarcRecord(headers, f.read(length[0] if length else 0))
+
+
+class WarcIndex(object):
+    """
+    SQLite index of records: url, time, and the file, offset and length of each record.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS records ('
+                ' url_key TEXT,'
+                ' timestamp TEXT,'
+                ' url TEXT,'
+                ' record_type TEXT,'
+                ' mime TEXT,'
+                ' status INTEGER,'
+                ' digest TEXT,'
+                ' length INTEGER,'
+                ' offset INTEGER,'
+                ' filename TEXT,'
+                ' record_id TEXT'
+                ')'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS records_url ON records (url_key, timestamp)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def add(self, url, timestamp, record_type, mime, status, digest, length, offset, filename, record_id):
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (get_url_key(url), timestamp, url, record_type, mime, status, digest, length, offset, filename,
+                     record_id)
+                )
+
+    def lookup(self, url, record_types=('response', 'resource')):
+        """
+        :return: dict of the latest record of url, or None
+        """
+        query = (
+            'SELECT url, timestamp, record_type, mime, status, digest, length, offset, filename, record_id'
+            ' FROM records WHERE url_key = ? AND record_type IN (%s)'
+            ' ORDER BY timestamp DESC, rowid DESC LIMIT 1' % ', '.join('?' * len(record_types))
+        )
+        with self._lock:
+            row = self._db.execute(query, (get_url_key(url),) + tuple(record_types)).fetchone()
+        if not row:
+            return None
+        keys = ('url', 'timestamp', 'record_type', 'mime', 'status', 'digest', 'length', 'offset', 'filename',
+                'record_id')
+        return dict(zip(keys, row))
+
+    def export_cdx(self, cdx_path):
+        """
+        write a CDX file of response and resource records: url key, timestamp, url, mime type, status code,
+        payload digest, compressed length, offset and file name, sorted by url key.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT url_key, timestamp, url, mime, status, digest, length, offset, filename FROM records'
+                ' WHERE record_type IN (?, ?) ORDER BY url_key, timestamp', ('response', 'resource')
+            ).fetchall()
+        with open(cdx_path, 'wb') as f:
+            f.write(b' CDX N b a m s k S V g\n')
+            for row in rows:
+                values = [('-' if v is None else str(v)) for v in row]
+                values[3] = values[3].split(';')[0].strip() or '-'
+                f.write((' '.join(v.replace(' ', '%20') for v in values) + '\n').encode('utf-8'))
+
+
+class WarcWriter(object):
+    """
+    Thread-safe WARC writer with size-based rotation and a record index.
+    """
+
+    def __init__(self, directory, prefix='webarchiver', max_size=1024 ** 3, compress=True, index=True):
+        """
+        :param directory: directory of WARC files
+        :param prefix:    file name prefix
+        :param max_size:  bytes of a WARC file to start the next one. 0 means no rotation
+        :param compress:  gzip each record
+        :param index:     keep <directory>/index.sqlite of records
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.max_size = max_size
+        self.compress = compress
+        self.extension = '.warc.gz' if compress else '.warc'
+
+        if not path_exists(directory):
+            makedirs(directory)
+
+        self.index = WarcIndex(path_join(directory, 'index.sqlite')) if index else None
+
+        self.filename = None
+        self._file = None
+        self._serial = self._find_serial()
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+        if self.index:
+            self.index.close()
+
+    def _find_serial(self):
+        """
+        continue after the existing files, so that a restart never overwrites them
+        """
+        serial = 0
+        start = self.prefix + '-'
+        for name in listdir(self.directory):
+            if name.startswith(start) and name.endswith(self.extension):
+                number = name[len(start):-len(self.extension)]
+                if number.isdigit():
+                    serial = max(serial, int(number) + 1)
+        return serial
+
+    def _open(self):
+        if self._file and (not self.max_size or self._file.tell() < self.max_size):
+            return
+        if self._file:
+            self._file.close()
+        self.filename = '%s-%05d%s' % (self.prefix, self._serial, self.extension)
+        self._serial += 1
+        self._file = open(path_join(self.directory, self.filename), 'ab')
+        info = 'software: webarchiver\r\nformat: WARC File Format 1.0\r\n'.encode('utf-8')
+        self._write('warcinfo', None, [info], 'application/warc-fields', [('WARC-Filename', self.filename)])
+
+    def _write(self, record_type, url, parts, content_type, extra_headers=(), status=None, payload_digest=None,
+               mime=None):
+        record_id = '<urn:uuid:%s>' % uuid4()
+        now = datetime.utcnow()
+        length = get_parts_length(parts)
+
+        headers = [
+            ('WARC-Type', record_type),
+            ('WARC-Record-ID', record_id),
+            ('WARC-Date', get_warc_date(now)),
+        ]
+        if url:
+            headers.append(('WARC-Target-URI', url))
+        headers.extend(extra_headers)
+        headers.append(('WARC-Block-Digest', get_digest(parts)))
+        if payload_digest:
+            headers.append(('WARC-Payload-Digest', payload_digest))
+        headers.append(('Content-Type', content_type))
+        headers.append(('Content-Length', str(length)))
+
+        head = '\r\n'.join([WARC_VERSION] + ['%s: %s' % h for h in headers]) + '\r\n\r\n'
+
+        offset = self._file.tell()
+        if self.compress:
+            out = GzipFile(filename='', fileobj=self._file, mode='wb')
+        else:
+            out = self._file
+        out.write(head.encode('utf-8'))
+        for chunk in iter_parts(parts):
+            out.write(chunk)
+        out.write(b'\r\n\r\n')
+        if self.compress:
+            out.close()
+        self._file.flush()
+
+        if self.index and url:
+            self.index.add(
+                url, now.strftime('%Y%m%d%H%M%S'), record_type, mime or content_type, status, payload_digest,
+                self._file.tell() - offset, offset, self.filename, record_id
+            )
+        return record_id
+
+    def write_record(self, record_type, url, parts, content_type, extra_headers=(), status=None,
+                     payload_digest=None):
+        """
+        :param record_type:    WARC-Type
+        :param url:            WARC-Target-URI
+        :param parts:          list of bytes and seekable file-like objects making the block
+        :param content_type:   Content-Type of the block
+        :param extra_headers:  list of (name, value) of other WARC headers
+        :param status:         HTTP status code for the index
+        :param payload_digest: WARC-Payload-Digest
+        :return:               WARC-Record-ID
+        """
+        with self._lock:
+            self._open()
+            return self._write(record_type, url, parts, content_type, extra_headers, status, payload_digest)
+
+    def write_response(self, response, body=None):
+        """
+        write a response record and its request record.
+        :param response: requests' Response object
+        :param body:     seekable file-like object of the body, for streamed responses. response.content if None
+        :return:         WARC-Record-ID of the response record
+        """
+        if body is None:
+            body = response.content
+
+        headers = [(k, v) for k, v in response.headers.items() if k.lower() not in hop_headers]
+        headers.append(('Content-Length', str(get_parts_length([body]))))
+        version = http_versions.get(getattr(response.raw, 'version', 11), 'HTTP/1.1')
+        head = format_http_headers('%s %d %s' % (version, response.status_code, response.reason or ''), headers)
+
+        request = response.request
+        request_body = request.body or b''
+        if not isinstance(request_body, bytes):
+            request_body = request_body.encode('utf-8') if hasattr(request_body, 'encode') else b''
+        request_headers = list(request.headers.items())
+        if not any(k.lower() == 'host' for k, _ in request_headers):
+            request_headers.insert(0, ('Host', urlsplit(request.url).netloc))
+        request_head = format_http_headers('%s %s HTTP/1.1' % (request.method, request.path_url), request_headers)
+
+        with self._lock:
+            self._open()
+            record_id = self._write(
+                'response', response.url, [head, body], 'application/http; msgtype=response',
+                status=response.status_code, payload_digest=get_digest([body]),
+                mime=response.headers.get('content-type')
+            )
+            self._write(
+                'request', request.url, [request_head, request_body], 'application/http; msgtype=request',
+                [('WARC-Concurrent-To', record_id)]
+            )
+        return record_id
+
+    def write_resource(self, url, content, content_type='text/html; charset=utf-8'):
+        """
+        write a resource record, e.g. a page rendered by a browser.
+        :param content: text or bytes
+        :return:        WARC-Record-ID
+        """
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        return self.write_record('resource', url, [content], content_type, payload_digest=get_digest([content]))
+
+    def get(self, url):
+        """
+        :return: the latest response or resource record of url, or None
+        """
+        if not self.index:
+            raise ValueError('the writer keeps no index')
+        entry = self.index.lookup(url)
+        if not entry:
+            return None
+        with self._lock:
+            if self._file:
+                self._file.flush()
+        return read_record(path_join(self.directory, entry['filename']), entry['offset'], entry['length'])
+
+    def export_cdx(self, cdx_path):
+        self.index.export_cdx(cdx_path)
@@ -0,0 +1,94 @@
+from __future__ import absolute_import
+
+from threading import (
+    Condition,
+    Lock,
+    Thread,
+)
+
+# noinspection PyUnresolvedReferences
+from six.moves.queue import Queue
+# noinspection PyUnresolvedReferences
+from six.moves.urllib.parse import urlparse
+
+
+def get_host(url):
+    """
+    return network location of the url, lower-cased.
+    :param url:
+    :return:
+    """
+    return urlparse(url).netloc.lower()
+
+
+class HostLimiter(object):
+    """
+    Caps the number of in-flight jobs per host.
+    limit 0 (or None) means no cap.
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self._active = {}
+        self._condition = Condition(Lock())
+
+    def get_limit(self, host):
+        return self.limit
+
+    def acquire(self, host):
+        with self._condition:
+            while True:
+                limit = self.get_limit(host)
+                if not limit or self._active.get(host, 0) < limit:
+                    break
+                self._condition.wait()
+            self._active[host] = self._active.get(host, 0) + 1
+
+    def release(self, host):
+        with self._condition:
+            self._active[host] -= 1
+            if not self._active[host]:
+                del self._active[host]
+            self._condition.notify_all()
+
+    def active(self, host):
+        with self._condition:
+            return self._active.get(host, 0)
+
+
+def run_in_threads(func, jobs, workers=4):
+    """
+    Run func(*job) for each job on a bounded pool of threads.
+    Exceptions do not stop the remaining jobs.
+    :param func:    callable
+    :param jobs:    iterable of argument tuples
+    :param workers: number of threads
+    :return:        list of (job, result, exception) in the order of jobs
+    """
+    jobs = list(jobs)
+    results = [None] * len(jobs)
+    queue = Queue()
+
+    for idx, job in enumerate(jobs):
+        queue.put((idx, job))
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            idx, job = item
+            try:
+                results[idx] = (job, func(*job), None)
+            except Exception as e:
+                results[idx] = (job, None, e)
+
+    threads = [Thread(target=worker) for _ in range(max(1, min(workers, len(jobs))))]
+    for t in threads:
+        queue.put(None)
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results